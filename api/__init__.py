@@ -1,7 +1,15 @@
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 
-from api import authentication, user_settings
+from api import authentication, events, journal, metrics, profiling, user_settings
 
-router = FastAPI(docs_url="/docs")
+router = FastAPI(docs_url="/docs", default_response_class=ORJSONResponse)
 router.include_router(authentication.router)
 router.include_router(user_settings.router)
+router.include_router(events.router)
+router.include_router(journal.router)
+router.include_router(metrics.router)
+router.include_router(profiling.router)
+# added first so the metrics middleware outside it times the profiler too
+router.add_middleware(profiling.ProfilerMiddleware)
+router.add_middleware(metrics.RouteMetricsMiddleware)
@@ -1,16 +1,38 @@
-from fastapi import APIRouter, HTTPException
+import typing as t
 
-from common.config import GlobalConfig
-from models.authentication import AuthSignIn, AuthStatus, AuthUriInfo
+from fastapi import APIRouter, Header, HTTPException, Response
+
+from api.caching import CachedResource
+from common.config import config_snapshot
+from models.authentication import AuthSessions, AuthSignIn, AuthStatus, AuthUriInfo
 from models.brokerage import BrokerageId
-from services.authentication import AuthenticationService
+from services.authentication import AuthenticationService, auth_status
 from services.brokerage import get_brokerage_service
 
 router = APIRouter(prefix="/auth", tags=["Authentication"])
 
+_auth_uris = CachedResource()
+_auth_status = CachedResource()
+_sessions = CachedResource()
+
+
+@router.get("/sessions", response_model=AuthSessions)
+async def get_sessions(if_none_match: t.Optional[str] = Header(None)) -> Response:
+    sessions = await AuthenticationService().get_sessions_async()
+
+    def build() -> AuthSessions:
+        return AuthSessions(
+            active=next(iter(sessions), None),
+            sessions=[auth_status(tokens) for tokens in sessions.values()],
+        )
+
+    return _sessions.response(if_none_match, (sessions, config_snapshot()), build)
+
 
 @router.get("/{brokerage_id}", response_model=AuthUriInfo)
-async def get_auth_uri(brokerage_id: BrokerageId) -> AuthUriInfo:
+async def get_auth_uri(
+    brokerage_id: BrokerageId, if_none_match: t.Optional[str] = Header(None)
+) -> Response:
     try:
         brokerage_service = get_brokerage_service(brokerage_id)
     except ValueError:
@@ -18,38 +40,41 @@ async def get_auth_uri(brokerage_id: BrokerageId) -> AuthUriInfo:
             status_code=404, detail=f"Brokerage auth URI not found for brokerage {id}"
         )
 
-    brokerage = GlobalConfig().brokerage_map[brokerage_id]
+    snapshot = config_snapshot()
 
-    return AuthUriInfo(
-        id=brokerage.id,
-        name=brokerage.name,
-        uri=brokerage_service.auth_uri,
-    )
+    def build() -> AuthUriInfo:
+        brokerage = snapshot.brokerage_map[brokerage_id]
+        return AuthUriInfo(
+            id=brokerage.id,
+            name=brokerage.name,
+            uri=brokerage_service.auth_uri,
+        )
+
+    return _auth_uris.response(if_none_match, (snapshot,), build, brokerage_id)
 
 
 @router.get("/", response_model=AuthStatus)
-async def get_auth_status() -> AuthStatus:
+async def get_auth_status(if_none_match: t.Optional[str] = Header(None)) -> Response:
     auth_service = AuthenticationService()
-    tokens = auth_service.active_tokens
-    if not tokens:
-        return AuthStatus(
-            signed_in=False,
-        )
-    brokerage = GlobalConfig().brokerage_map[tokens.brokerage_id]
-    return AuthStatus(
-        id=brokerage.id,
-        name=brokerage.name,
-        signed_in=True,
+    tokens = await auth_service.get_active_tokens_async()
+    return _auth_status.response(
+        if_none_match, (tokens, config_snapshot()), lambda: auth_status(tokens)
     )
 
 
 @router.post("/")
 async def auth_sign_in(signin_info: AuthSignIn) -> None:
     auth_service = AuthenticationService()
-    auth_service.sign_in(signin_info.id, signin_info.code)
+    await auth_service.sign_in_async(signin_info.id, signin_info.code)
 
 
 @router.delete("/")
 async def auth_sign_out() -> None:
     auth_service = AuthenticationService()
-    auth_service.sign_out()
+    await auth_service.sign_out_async()
+
+
+@router.delete("/{brokerage_id}")
+async def auth_sign_out_brokerage(brokerage_id: BrokerageId) -> None:
+    auth_service = AuthenticationService()
+    await auth_service.sign_out_async(brokerage_id)
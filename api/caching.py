@@ -0,0 +1,73 @@
+import hashlib
+import typing as t
+
+import orjson
+from fastapi import Response
+from pydantic import BaseModel
+
+JSON_MEDIA_TYPE = "application/json"
+
+
+def encode(model: BaseModel) -> bytes:
+    """serialize model to JSON with orjson, several times faster than pydantic's
+    json(), which the app's default JSON responses would otherwise go through"""
+    return orjson.dumps(model.dict())
+
+
+def etag_matches(if_none_match: t.Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates
+
+
+class _CachedBody(t.NamedTuple):
+    sources: t.Tuple[object, ...]
+    body: bytes
+    etag: str
+
+
+class CachedResource:
+    """The serialized body of a resource, rebuilt only when the objects it is
+    built from change, with conditional GET support.
+
+    Config snapshots, token snapshots and user settings are replaced rather
+    than mutated when they change, so sources are compared by identity. The
+    ETag is a hash of the body, so every worker process agrees on it.
+    """
+
+    def __init__(self) -> None:
+        # bumped every time a new body is built
+        self.version = 0
+        self._bodies: t.Dict[t.Hashable, _CachedBody] = {}
+
+    def _body(
+        self,
+        sources: t.Tuple[object, ...],
+        build: t.Callable[[], BaseModel],
+        variant: t.Hashable,
+    ) -> _CachedBody:
+        cached = self._bodies.get(variant)
+        if cached is not None and len(cached.sources) == len(sources):
+            if all(old is new for old, new in zip(cached.sources, sources)):
+                return cached
+        body = encode(build())
+        etag = f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+        cached = self._bodies[variant] = _CachedBody(sources, body, etag)
+        self.version += 1
+        return cached
+
+    def response(
+        self,
+        if_none_match: t.Optional[str],
+        sources: t.Tuple[object, ...],
+        build: t.Callable[[], BaseModel],
+        variant: t.Hashable = None,
+    ) -> Response:
+        """a 304 if the client already has the current body, else the body"""
+        cached = self._body(sources, build, variant)
+        # no-cache makes browsers revalidate every time, which costs a 304
+        headers = {"ETag": cached.etag, "Cache-Control": "no-cache"}
+        if etag_matches(if_none_match, cached.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(cached.body, media_type=JSON_MEDIA_TYPE, headers=headers)
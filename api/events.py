@@ -0,0 +1,31 @@
+import typing as t
+
+from fastapi import APIRouter
+from starlette.responses import StreamingResponse
+
+from common.config import UserSettings
+from models.events import EventType
+from services.authentication import AuthenticationService, auth_status
+from services.events import event_broker, format_event
+
+router = APIRouter(prefix="/events", tags=["Events"])
+
+
+@router.get("/", response_class=StreamingResponse)
+async def get_events() -> StreamingResponse:
+    """a text/event-stream of auth and settings changes, starting with the
+    current auth status and settings"""
+
+    async def stream() -> t.AsyncIterator[bytes]:
+        with event_broker.subscribe() as subscription:
+            tokens = await AuthenticationService().get_active_tokens_async()
+            yield format_event(EventType.AUTH, auth_status(tokens))
+            yield format_event(EventType.SETTINGS, UserSettings())
+            async for message in subscription:
+                yield message
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
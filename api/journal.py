@@ -0,0 +1,23 @@
+import datetime
+import typing as t
+
+from fastapi import APIRouter, HTTPException
+
+from common.utils import run_blocking
+from models.journal import JournalSummary
+from services.journal import journal_directory, summarize
+
+router = APIRouter(prefix="/journal", tags=["Journal"])
+
+
+@router.get("/summary", response_model=JournalSummary)
+async def get_summary(
+    start: t.Optional[datetime.datetime] = None,
+    end: t.Optional[datetime.datetime] = None,
+    symbol: t.Optional[str] = None,
+) -> JournalSummary:
+    """event counts, fills per symbol and order latency, optionally for events
+    from start up to end or for one symbol"""
+    if start is not None and end is not None and end <= start:
+        raise HTTPException(status_code=422, detail="end must be after start")
+    return await run_blocking(summarize, journal_directory(), start, end, symbol)
@@ -0,0 +1,56 @@
+import time
+
+from fastapi import APIRouter, Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from common.metrics import CONTENT_TYPE, REGISTRY, Histogram
+
+router = APIRouter(tags=["Metrics"])
+
+REQUEST_SECONDS = Histogram(
+    "mark_trader_http_request_seconds",
+    "API requests by method, route template and status",
+    ["method", "route", "status"],
+)
+
+
+@router.get("/metrics", response_class=Response)
+async def get_metrics() -> Response:
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+class RouteMetricsMiddleware:
+    """Times every HTTP request to the app, labelled with the template of the
+    route that handled it, so /auth/td-a and /auth/paper share one series"""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    @staticmethod
+    def _route(scope: Scope) -> str:
+        # the router records the route it matched in the scope
+        route = scope.get("route")
+        if route is None:
+            return "unmatched"
+        return str(getattr(route, "path", "unknown"))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = "error"
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUEST_SECONDS.labels(scope["method"], self._route(scope), status).observe(
+                time.perf_counter() - start
+            )
@@ -0,0 +1,139 @@
+import datetime
+import random
+import secrets
+import threading
+import time
+import typing as t
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from common.config import ProfilingConfig, config_snapshot
+from common.utils import BLOCKING_IO_THREAD_PREFIX, run_blocking
+from models.profiling import ProfileInfo
+from services.profiling import StackSampler, profile_store
+
+# send this header with the admin token to profile a request
+PROFILE_HEADER = b"x-profile-request"
+# streaming responses stay open for as long as the client listens
+UNPROFILED_PATHS = ("/events",)
+
+
+def _matches_admin_token(config: ProfilingConfig, token: t.Optional[str]) -> bool:
+    return (
+        config.admin_token is not None
+        and token is not None
+        and secrets.compare_digest(token.encode(), config.admin_token.encode())
+    )
+
+
+def require_admin(authorization: t.Optional[str] = Header(None)) -> None:
+    config = config_snapshot().config.profiling
+    if config.admin_token is None:
+        raise HTTPException(status_code=404, detail="Profiling admin is not enabled")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not _matches_admin_token(config, token):
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid admin token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+router = APIRouter(
+    prefix="/admin/profiles",
+    tags=["Profiling"],
+    dependencies=[Depends(require_admin)],
+)
+
+
+@router.get("/", response_model=t.List[ProfileInfo])
+async def list_profiles() -> t.List[ProfileInfo]:
+    return await run_blocking(profile_store().list)
+
+
+@router.get("/{profile_id}", response_class=Response)
+async def download_profile(profile_id: str) -> Response:
+    content = await run_blocking(profile_store().read, profile_id)
+    if content is None:
+        raise HTTPException(status_code=404, detail=f"Profile {profile_id} not found")
+    return Response(
+        content,
+        media_type="text/plain",
+        headers={"Content-Disposition": f'attachment; filename="{profile_id}.folded"'},
+    )
+
+
+class ProfilerMiddleware:
+    """Profiles a sample of requests, and requests that carry the profile header
+    with the admin token, by sampling the stacks of the event loop thread and
+    the blocking IO pool while the request runs.
+
+    When profiling is disabled a request costs one config lookup. The loop is
+    shared, so a profile also shows whatever other requests were doing.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self._active = 0
+
+    def _wanted(self, scope: Scope, config: ProfilingConfig) -> bool:
+        if self._active >= config.max_concurrent or scope["path"].startswith(
+            UNPROFILED_PATHS
+        ):
+            return False
+        for name, value in scope["headers"]:
+            if name == PROFILE_HEADER:
+                return _matches_admin_token(config, value.decode("latin-1"))
+        return random.random() < config.sample_rate
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        config = config_snapshot().config.profiling
+        if not config.enabled or not self._wanted(scope, config):
+            await self.app(scope, receive, send)
+            return
+
+        status = "error"
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        loop_thread = threading.current_thread()
+        sampler = StackSampler(
+            lambda: [
+                thread
+                for thread in threading.enumerate()
+                if thread is loop_thread
+                or thread.name.startswith(BLOCKING_IO_THREAD_PREFIX)
+            ],
+            config.interval_seconds,
+            config.max_seconds,
+        )
+        self._active += 1
+        created = datetime.datetime.now()
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # joins the sampler thread, which may be mid sample
+            stacks = await run_blocking(sampler.stop)
+            duration = time.perf_counter() - start
+            self._active -= 1
+            store = profile_store()
+            info = ProfileInfo(
+                id=store.new_id(),
+                created=created,
+                method=scope["method"],
+                path=scope["path"],
+                status=status,
+                duration_ms=duration * 1000,
+                samples=sampler.samples,
+            )
+            await run_blocking(store.save, info, stacks)
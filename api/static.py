@@ -0,0 +1,260 @@
+"""Serve the built client precompressed, from memory.
+
+Files are compressed once, at build time, by ``python -m api.static
+client/build``, which writes a .gz and, with brotli installed, a .br copy next
+to every file compression makes smaller. At startup small files and their
+copies are read into memory, large ones stay on disk. Files without copies are
+served uncompressed. Rebuilding the client needs a restart to be picked up.
+"""
+import argparse
+import gzip
+import hashlib
+import importlib
+import logging
+import mimetypes
+import re
+import typing as t
+from pathlib import Path
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, PlainTextResponse, Response
+from starlette.types import Receive, Scope, Send
+
+from api.caching import etag_matches
+from common.config import APP_NAME
+
+LOGGER = logging.getLogger(f"{APP_NAME}.static")
+
+# brotli is optional, gzip is always available
+try:
+    brotli: t.Any = importlib.import_module("brotli")
+except ImportError:
+    brotli = None
+
+# encodings in order of preference, with the suffix of their precompressed files
+ENCODINGS = {"br": ".br", "gzip": ".gz"} if brotli is not None else {"gzip": ".gz"}
+SMALL_FILE_BYTES = 512 * 1024
+MIN_COMPRESS_BYTES = 1024
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/javascript",
+    "application/json",
+    "application/manifest+json",
+    "application/xml",
+    "image/svg+xml",
+    "image/x-icon",
+    "image/vnd.microsoft.icon",
+)
+# the build puts a content hash in asset names, e.g. main.8f1a2b3c.js
+HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.")
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return t.cast(bytes, brotli.compress(data, quality=11))
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+# types mimetypes doesn't know on every platform
+EXTRA_TYPES = {".map": "application/json", ".webmanifest": "application/manifest+json"}
+
+
+def _content_type(path: Path) -> str:
+    content_type = (
+        EXTRA_TYPES.get(path.suffix)
+        or mimetypes.guess_type(path.name)[0]
+        or "application/octet-stream"
+    )
+    if content_type.startswith("text/") or content_type == "application/javascript":
+        content_type += "; charset=utf-8"
+    return content_type
+
+
+def _compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def accepted_encoding(accept_encoding: str, available: t.Iterable[str]) -> str:
+    """the available encoding the client weighs highest, or identity. ties go
+    to the earlier available encoding"""
+    weights: t.Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        weight = 1.0
+        if params.strip().startswith("q="):
+            try:
+                weight = float(params.strip()[2:])
+            except ValueError:
+                continue
+        weights[name.strip().lower()] = weight
+    best, best_weight = "identity", 0.0
+    for encoding in available:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+class _Variant(t.NamedTuple):
+    """one encoding of a file, in memory if body is set, else on disk at path"""
+
+    body: t.Optional[bytes]
+    path: Path
+    size: int
+    etag: str
+
+
+class _Asset(t.NamedTuple):
+    content_type: str
+    cache_control: str
+    variants: t.Dict[str, _Variant]
+
+
+def load_asset(path: Path) -> _Asset:
+    content_type = _content_type(path)
+    stat = path.stat()
+    data = path.read_bytes() if stat.st_size <= SMALL_FILE_BYTES else None
+    if data is not None:
+        tag = hashlib.blake2b(data, digest_size=12).hexdigest()
+    else:
+        tag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+    variants = {"identity": _Variant(data, path, stat.st_size, f'"{tag}"')}
+
+    if _compressible(content_type) and stat.st_size >= MIN_COMPRESS_BYTES:
+        for encoding, suffix in ENCODINGS.items():
+            precompressed = path.with_name(path.name + suffix)
+            if not precompressed.exists():
+                continue
+            size = precompressed.stat().st_size
+            body = precompressed.read_bytes() if data is not None else None
+            if size < stat.st_size:
+                etag = f'"{tag}-{encoding}"'
+                variants[encoding] = _Variant(body, precompressed, size, etag)
+
+    cache_control = IMMUTABLE if HASHED_NAME.search(path.name) else REVALIDATE
+    return _Asset(content_type, cache_control, variants)
+
+
+def _precompressed_copy(path: Path) -> bool:
+    return any(
+        path.name.endswith(suffix)
+        and path.with_name(path.name[: -len(suffix)]).exists()
+        for suffix in (".gz", ".br")
+    )
+
+
+class PrecompressedStaticFiles:
+    """An ASGI app serving a directory like StaticFiles(html=True), with the
+    copies precompress wrote at build time picked by Accept-Encoding.
+
+    Assets with a content hash in their name are cached by browsers forever.
+    Everything else, index.html included, is revalidated with its ETag on every
+    load, which costs a 304 when nothing changed.
+    """
+
+    def __init__(self, directory: t.Union[str, Path]) -> None:
+        self.directory = Path(directory)
+        if not self.directory.is_dir():
+            raise RuntimeError(f"Directory '{directory}' does not exist")
+        self._assets: t.Dict[str, _Asset] = {}
+        for path in sorted(self.directory.rglob("*")):
+            if path.is_file() and not _precompressed_copy(path):
+                key = path.relative_to(self.directory).as_posix()
+                self._assets[key] = load_asset(path)
+        in_memory = sum(
+            variant.size
+            for asset in self._assets.values()
+            for variant in asset.variants.values()
+            if variant.body is not None
+        )
+        LOGGER.info(
+            f"Serving {len(self._assets)} files from {self.directory}, "
+            f"{in_memory} bytes in memory"
+        )
+
+    def _lookup(self, path: str) -> t.Tuple[t.Optional[_Asset], int]:
+        key = path.strip("/")
+        asset = self._assets.get(key)
+        if asset is None:
+            asset = self._assets.get(f"{key}/index.html" if key else "index.html")
+        if asset is not None:
+            return asset, 200
+        return self._assets.get("404.html"), 404
+
+    def response(self, method: str, path: str, headers: Headers) -> Response:
+        if method not in ("GET", "HEAD"):
+            return PlainTextResponse("Method Not Allowed", status_code=405)
+        asset, status_code = self._lookup(path)
+        if asset is None:
+            return PlainTextResponse("Not Found", status_code=404)
+
+        encoding = accepted_encoding(
+            headers.get("accept-encoding", ""),
+            (encoding for encoding in ENCODINGS if encoding in asset.variants),
+        )
+        variant = asset.variants[encoding]
+        response_headers = {
+            "Cache-Control": asset.cache_control,
+            "Content-Type": asset.content_type,
+            "ETag": variant.etag,
+            "Vary": "Accept-Encoding",
+        }
+        if encoding != "identity":
+            response_headers["Content-Encoding"] = encoding
+
+        if status_code == 200 and etag_matches(
+            headers.get("if-none-match"), variant.etag
+        ):
+            return Response(status_code=304, headers=response_headers)
+
+        if variant.body is None:
+            return FileResponse(
+                variant.path,
+                status_code=status_code,
+                headers=response_headers,
+                method=method,
+            )
+        response_headers["Content-Length"] = str(variant.size)
+        return Response(
+            variant.body if method == "GET" else b"",
+            status_code=status_code,
+            headers=response_headers,
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        assert scope["type"] == "http"
+        response = self.response(scope["method"], scope["path"], Headers(scope=scope))
+        await response(scope, receive, send)
+
+
+def precompress(directory: Path) -> int:
+    """write .gz, and .br if brotli is installed, next to every compressible file
+    in directory that compression makes smaller. returns how many were written"""
+    written = 0
+    for path in sorted(directory.rglob("*")):
+        if not path.is_file() or _precompressed_copy(path):
+            continue
+        if not _compressible(_content_type(path)):
+            continue
+        data = path.read_bytes()
+        if len(data) < MIN_COMPRESS_BYTES:
+            continue
+        for encoding, suffix in ENCODINGS.items():
+            compressed = compress(data, encoding)
+            if len(compressed) < len(data):
+                path.with_name(path.name + suffix).write_bytes(compressed)
+                written += 1
+    return written
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("directory", type=Path, nargs="?", default=Path("client/build"))
+    args = parser.parse_args()
+    print(f"wrote {precompress(args.directory)} precompressed files")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
-from fastapi import APIRouter, HTTPException
+import typing as t
+
+from fastapi import APIRouter, Header, HTTPException, Response
 from pydantic import ValidationError
 
+from api.caching import CachedResource
 from common.config import UserSettings
 from models.user_settings import UserSettingsPatch
 from services.authentication import AuthenticationService
@@ -8,9 +11,15 @@ from services.authentication import AuthenticationService
 router = APIRouter(prefix="/userSettings", tags=["User Settings"])
 
 
+_user_settings = CachedResource()
+
+
 @router.get("/", response_model=UserSettingsPatch)
-async def get_user_settings() -> UserSettings:
-    return UserSettings()
+async def get_user_settings(if_none_match: t.Optional[str] = Header(None)) -> Response:
+    user_settings = UserSettings()
+    return _user_settings.response(
+        if_none_match, (user_settings,), lambda: user_settings
+    )
 
 
 @router.patch("/", response_model=UserSettingsPatch)
@@ -22,7 +31,10 @@ async def update_user_settings(settings_patch: UserSettingsPatch) -> UserSetting
     enable_automated_trading = args.get("enable_automated_trading")
 
     if enable_automated_trading is not None:
-        if enable_automated_trading and not auth_service.active_tokens:
+        if (
+            enable_automated_trading
+            and not await auth_service.get_active_tokens_async()
+        ):
             raise HTTPException(
                 status_code=422,
                 detail="Cannot enable automated trading. Application does not have an active brokerage",
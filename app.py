@@ -1,22 +1,85 @@
 import uvicorn
 from fastapi import FastAPI
-from starlette.staticfiles import StaticFiles
 
 import api
-from common.config import GlobalConfig
-from services import authentication
+from api.static import PrecompressedStaticFiles
+from common.config import (
+    GLOBAL_CONFIG_FILE,
+    USER_SETTINGS_FILE,
+    GlobalConfig,
+    UserSettings,
+    reload_global_config,
+)
+from common.utils import FileWatcher, LeaderServices, run_blocking
+from services import (
+    authentication,
+    brokerage,
+    events,
+    journal,
+    market_data,
+    orders,
+    positions,
+)
 
 app = FastAPI()
 app.mount("/api/v1", api.router)
-app.mount("/", StaticFiles(directory="./client/build", html=True), name="static")
+app.mount("/", PrecompressedStaticFiles("./client/build"), name="static")
+
+
+@app.on_event("startup")
+async def start_background_tasks() -> None:
+    app.state.config_watcher = FileWatcher(
+        GLOBAL_CONFIG_FILE,
+        reload_global_config,
+        GlobalConfig().config_watch_interval_seconds,
+    )
+    app.state.config_watcher.start()
+    app.state.user_settings_watcher = FileWatcher(
+        USER_SETTINGS_FILE,
+        UserSettings.reload,
+        GlobalConfig().config_watch_interval_seconds,
+    )
+    app.state.user_settings_watcher.start()
+    app.state.token_watcher = authentication.token_watcher()
+    app.state.token_watcher.start()
+    events.event_broker.start()
+    journal.trade_journal.start()
+    authentication.token_refresh_scheduler.start()
+    # with several workers, only one polls quotes, trades and places orders
+    app.state.leader_services = LeaderServices(
+        GlobalConfig().data_dir / "MARK_TRADER.services.leader.lock",
+        [
+            market_data.market_data_engine,
+            positions.position_tracker,
+            orders.order_pipeline,
+        ],
+        GlobalConfig().authentication.leader_poll_seconds,
+    )
+    app.state.leader_services.start()
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks() -> None:
+    await app.state.leader_services.stop()
+    await authentication.token_refresh_scheduler.stop()
+    await app.state.token_watcher.stop()
+    await app.state.config_watcher.stop()
+    await app.state.user_settings_watcher.stop()
+    await events.event_broker.stop()
+    journal.trade_journal.stop()
+    await brokerage.close_brokerage_services()
+    await run_blocking(UserSettings.flush)
+
 
 if __name__ == "__main__":
-    authentication.start_daemon()
+    workers = GlobalConfig().server.workers
     uvicorn.run(
         "app:app",
         host="0.0.0.0",
         port=GlobalConfig().server.port,
-        reload=True,
+        # uvicorn can't reload with several workers
+        reload=workers == 1,
+        workers=workers,
         ssl_keyfile="./key.pem",
         ssl_certfile="cert.pem",
     )
@@ -0,0 +1,55 @@
+"""Measure the per-request config work of GET /auth/{brokerage_id}.
+
+Run with ``python -m benchmarks.config``. Compares rebuilding the brokerage
+map and re-quoting the OAuth URI on every call with the precomputed config
+snapshot.
+"""
+import argparse
+import timeit
+from urllib.parse import quote_plus
+
+from confz import ConfZDataSource
+
+from common.config import GlobalConfig, config_snapshot
+from models.brokerage import BrokerageId
+from services.brokerage import TDAmeritradeBrokerageService
+
+CONFIG = {
+    "server": {"port": 8089, "host": "https://localhost"},
+    "brokerages": [{"id": "td-a", "name": "TD Ameritrade", "client_id": "CLIENT"}],
+}
+
+
+def per_request_rebuild() -> str:
+    brokerage = {b.id: b for b in GlobalConfig().brokerages}[BrokerageId.TD]
+    brokerage_map = {b.id: b for b in GlobalConfig().brokerages}
+    return TDAmeritradeBrokerageService.OAUTH_URI_FORMATTER.format(
+        redirect_uri=quote_plus(GlobalConfig().server.redirect_uri),
+        client_id=quote_plus(brokerage_map[brokerage.id].client_id),
+    )
+
+
+def snapshot() -> str:
+    config_snapshot().brokerage_map[BrokerageId.TD]
+    return config_snapshot().auth_uri(
+        BrokerageId.TD, TDAmeritradeBrokerageService.OAUTH_URI_FORMATTER
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=100_000)
+    args = parser.parse_args()
+
+    with GlobalConfig.change_config_sources(ConfZDataSource(data=CONFIG)):
+        assert per_request_rebuild() == snapshot()
+        for name, func in [
+            ("per-request rebuild", per_request_rebuild),
+            ("config snapshot", snapshot),
+        ]:
+            seconds = timeit.timeit(func, number=args.iterations)
+            print(f"{name:<20} {seconds / args.iterations * 1e6:8.2f}us per request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Measure indicator update throughput for large watchlists.
+
+Run with ``python -m benchmarks.indicators``. Each tick updates SMA, EMA, RSI,
+VWAP and Bollinger bands for every symbol. The batched incremental update is
+compared with recomputing the indicators from each symbol's history in Python.
+"""
+import argparse
+import time
+import typing as t
+
+import numpy as np
+
+from services.indicators import (
+    EMA,
+    RSI,
+    SMA,
+    VWAP,
+    BollingerBands,
+    FloatArray,
+    IndicatorSet,
+)
+
+PERIOD = 20
+
+
+def indicator_set(symbols: t.List[str]) -> IndicatorSet:
+    return IndicatorSet(
+        {
+            "sma": SMA(PERIOD),
+            "ema": EMA(PERIOD),
+            "rsi": RSI(14),
+            "vwap": VWAP(),
+            "bollinger": BollingerBands(PERIOD),
+        },
+        symbols,
+    )
+
+
+def recompute(prices: t.List[float], volumes: t.List[float]) -> t.Tuple[float, ...]:
+    window = prices[-PERIOD:]
+    sma = sum(window) / len(window)
+    deviation = (sum((p - sma) ** 2 for p in window) / len(window)) ** 0.5
+    ema = prices[0]
+    for price in prices[1:]:
+        ema += 2 / (PERIOD + 1) * (price - ema)
+    gain = loss = 0.0
+    for prev, price in zip(prices[-15:], prices[-14:]):
+        gain += max(price - prev, 0)
+        loss += max(prev - price, 0)
+    rsi = 100 - 100 / (1 + gain / loss) if loss else 100.0
+    vwap = sum(p * v for p, v in zip(prices, volumes)) / sum(volumes)
+    return sma, ema, rsi, vwap, sma + 2 * deviation, sma - 2 * deviation
+
+
+def random_ticks(n_symbols: int, n_ticks: int) -> t.Tuple[FloatArray, FloatArray]:
+    rng = np.random.default_rng(0)
+    prices = 100 + np.cumsum(rng.normal(size=(n_ticks, n_symbols)), axis=0)
+    volumes = rng.integers(1, 1000, size=(n_ticks, n_symbols)).astype(np.float64)
+    return prices, volumes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ticks", type=int, default=500)
+    parser.add_argument("--history", type=int, default=390)
+    parser.add_argument("--symbols", type=int, nargs="+", default=[100, 1000, 5000])
+    args = parser.parse_args()
+
+    for n_symbols in args.symbols:
+        symbols = [f"SYM{i}" for i in range(n_symbols)]
+        prices, volumes = random_ticks(n_symbols, args.ticks)
+
+        indicators = indicator_set(symbols)
+        start = time.perf_counter()
+        for i in range(args.ticks):
+            indicators.update(prices[i], volumes[i])
+        batched = time.perf_counter() - start
+
+        # one tick of recomputing every symbol over a trading day of history
+        history, history_volumes = random_ticks(n_symbols, args.history)
+        columns = [
+            (history[:, j].tolist(), history_volumes[:, j].tolist())
+            for j in range(n_symbols)
+        ]
+        start = time.perf_counter()
+        for column_prices, column_volumes in columns:
+            recompute(column_prices, column_volumes)
+        naive = time.perf_counter() - start
+
+        print(
+            f"{n_symbols:>5} symbols  "
+            f"batched {args.ticks / batched:9.0f} ticks/s "
+            f"({n_symbols * args.ticks / batched:12.0f} symbol updates/s)  "
+            f"python recompute {1 / naive:9.1f} ticks/s "
+            f"({n_symbols / naive:12.0f} symbol updates/s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
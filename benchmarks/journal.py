@@ -0,0 +1,110 @@
+"""Compare the trade journal with a JSON lines log of the same fills.
+
+Run with ``python -m benchmarks.journal``. Times appending every fill, then
+totalling fills per symbol: the journal scans its mapped columns, the log is
+parsed line by line.
+"""
+import argparse
+import collections
+import datetime
+import random
+import tempfile
+import time
+import typing as t
+from pathlib import Path
+
+from confz import ConfZDataSource
+
+from common.config import GlobalConfig
+from models.trading import Fill, OrderSide
+from services.journal import TradeJournal, journal_directory, summarize
+
+START = datetime.datetime(2022, 12, 1, 9, 30)
+
+
+def _fills(count: int, symbols: int) -> t.List[Fill]:
+    rng = random.Random(0)
+    return [
+        Fill(
+            symbol=f"SYM{rng.randrange(symbols)}",
+            side=rng.choice([OrderSide.BUY, OrderSide.SELL]),
+            quantity=rng.randint(1, 100),
+            price=rng.uniform(10, 500),
+            fill_time=START + datetime.timedelta(seconds=i),
+            commission=0.65,
+        )
+        for i in range(count)
+    ]
+
+
+def _json_cash_flow(path: Path) -> t.Dict[str, float]:
+    cash_flow: t.Dict[str, float] = collections.defaultdict(float)
+    with open(path) as log:
+        for line in log:
+            fill = Fill.parse_raw(line)
+            sign = 1 if fill.side == OrderSide.BUY else -1
+            cash_flow[fill.symbol] -= (
+                sign * fill.quantity * fill.price + fill.commission
+            )
+    return cash_flow
+
+
+def _report(name: str, events: int, append: float, query: float) -> None:
+    print(
+        f"{name:<10} append {append / events * 1e6:8.2f}us/event  "
+        f"query {query * 1e3:10.1f}ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=500000)
+    parser.add_argument("--symbols", type=int, default=50)
+    parser.add_argument("--records-per-segment", type=int, default=262144)
+    args = parser.parse_args()
+
+    fills = _fills(args.events, args.symbols)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        journal_config = {"records_per_segment": args.records_per_segment}
+        with GlobalConfig.change_config_sources(
+            ConfZDataSource(
+                data={
+                    "server": {"port": 8089, "host": "https://localhost"},
+                    "brokerages": [],
+                    "data_dir": tmp_dir,
+                    "journal": journal_config,
+                }
+            )
+        ):
+            journal = TradeJournal()
+            start = time.perf_counter()
+            for fill in fills:
+                journal.record_fill(fill)
+            append = time.perf_counter() - start
+            journal.close()
+
+            start = time.perf_counter()
+            summary = summarize(journal_directory())
+            query = time.perf_counter() - start
+            _report("journal", args.events, append, query)
+
+        log_path = Path(tmp_dir) / "fills.jsonl"
+        start = time.perf_counter()
+        with open(log_path, "w") as log:
+            for fill in fills:
+                log.write(fill.json() + "\n")
+        append = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cash_flow = _json_cash_flow(log_path)
+        query = time.perf_counter() - start
+        _report("json lines", args.events, append, query)
+
+    for symbol in summary.symbols:
+        assert abs(symbol.cash_flow - cash_flow[symbol.symbol]) < 1e-3 * max(
+            1, abs(symbol.cash_flow)
+        )
+
+
+if __name__ == "__main__":
+    main()
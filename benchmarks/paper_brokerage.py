@@ -0,0 +1,113 @@
+"""Load test the brokerage operations against the paper trading brokerage.
+
+Run with ``python -m benchmarks.paper_brokerage``. Sign in, token refresh,
+quotes and orders run concurrently with the simulated latency and error rate
+given on the command line, on the real clock, without network access.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import typing as t
+
+from confz import ConfZDataSource
+
+from common.config import GlobalConfig
+from models.authentication import AuthTokens
+from models.brokerage import BrokerageId
+from models.trading import Order, OrderSide
+from services.brokerage import close_brokerage_services, get_async_brokerage_service
+
+SYMBOLS = [f"SYM{i}" for i in range(100)]
+
+
+def config(args: argparse.Namespace) -> t.Dict[str, t.Any]:
+    return {
+        "server": {"port": 8089, "host": "https://localhost"},
+        "brokerages": [
+            {
+                "id": "paper",
+                "name": "Paper Trading",
+                "client_id": "paper",
+                "paper": {
+                    "latency_seconds": args.latency_ms / 1000,
+                    "latency_jitter_seconds": args.jitter_ms / 1000,
+                    "error_rate": args.error_rate,
+                    "seed": 1,
+                },
+            }
+        ],
+    }
+
+
+async def measure(
+    name: str,
+    operation: t.Callable[[int], t.Awaitable[t.Any]],
+    args: argparse.Namespace,
+) -> None:
+    samples: t.List[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def timed(i: int) -> None:
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await operation(i)
+            except RuntimeError:
+                errors += 1
+            samples.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed(i) for i in range(args.operations)))
+    elapsed = time.perf_counter() - start
+    samples_ms = sorted(s * 1e3 for s in samples)
+    print(
+        f"{name:<14} {args.operations / elapsed:9.0f} ops/s  "
+        f"p50 {statistics.median(samples_ms):8.2f}ms  "
+        f"p99 {samples_ms[int(len(samples_ms) * 0.99) - 1]:8.2f}ms  "
+        f"errors {errors}"
+    )
+
+
+async def run(args: argparse.Namespace) -> None:
+    brokerage = get_async_brokerage_service(BrokerageId.PAPER)
+    tokens: AuthTokens = await brokerage.get_access_tokens("paper")
+    try:
+        await measure("sign in", lambda i: brokerage.get_access_tokens("paper"), args)
+        await measure("refresh", lambda i: brokerage.refresh_tokens(tokens), args)
+        await measure(
+            "100 quotes", lambda i: brokerage.get_quotes(tokens, SYMBOLS), args
+        )
+        await measure(
+            "orders",
+            lambda i: brokerage.place_order(
+                tokens,
+                Order(
+                    symbol=SYMBOLS[i % len(SYMBOLS)],
+                    side=OrderSide.BUY if i % 2 else OrderSide.SELL,
+                    quantity=1,
+                ),
+            ),
+            args,
+        )
+    finally:
+        await close_brokerage_services()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--operations", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--jitter-ms", type=float, default=5)
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    with GlobalConfig.change_config_sources(ConfZDataSource(data=config(args))):
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Compare warm restart time of the position store against replaying every fill.
+
+Run with ``python -m benchmarks.positions``. A warm restart loads the position
+snapshot and records the fills a delta query would return: the ones missed
+while stopped plus the already recorded ones in the reconcile overlap.
+"""
+import argparse
+import datetime
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import typing as t
+from pathlib import Path
+
+from models.brokerage import BrokerageId
+from models.trading import Fill, OrderSide
+from services.positions import RECONCILE_OVERLAP, Portfolio, PositionStore
+
+START = datetime.datetime(2022, 12, 1, 9, 30)
+
+
+def _fills(
+    count: int, symbols: int, rng: random.Random, first: int = 0
+) -> t.List[Fill]:
+    return [
+        Fill(
+            symbol=f"SYM{rng.randrange(symbols)}",
+            side=rng.choice([OrderSide.BUY, OrderSide.SELL]),
+            quantity=rng.randint(1, 100),
+            price=rng.uniform(10, 500),
+            fill_time=START + datetime.timedelta(seconds=i),
+            commission=0.65,
+            fill_id=f"fill-{i}",
+        )
+        for i in range(first, first + count)
+    ]
+
+
+def _warm_restart(path: Path, delta: t.List[Fill]) -> None:
+    store = PositionStore(path)
+    store.load()
+    store.record_fills(BrokerageId.PAPER, delta)
+    store.close()
+
+
+def _replay(path: Path, delta: t.List[Fill]) -> None:
+    store = PositionStore(path)
+    portfolio = Portfolio()
+    # what a restart without a snapshot costs: every fill ever, in order
+    for (
+        symbol,
+        side,
+        quantity,
+        price,
+        commission,
+        fill_time,
+    ) in store._connection.execute(
+        "SELECT symbol, side, quantity, price, commission, fill_time"
+        " FROM fills ORDER BY fill_time"
+    ):
+        portfolio.apply(
+            Fill(
+                symbol=symbol,
+                side=OrderSide(side),
+                quantity=quantity,
+                price=price,
+                commission=commission,
+                fill_time=datetime.datetime.fromtimestamp(fill_time),
+            )
+        )
+    for fill in delta:
+        portfolio.apply(fill)
+    store.close()
+
+
+def _time(
+    func: t.Callable[[], None], iterations: int, setup: t.Callable[[], None]
+) -> float:
+    samples = []
+    for _ in range(iterations):
+        setup()
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1e3
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--symbols", type=int, default=50)
+    parser.add_argument(
+        "--missed", type=int, default=20, help="fills made while stopped"
+    )
+    parser.add_argument("--iterations", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'fills':>8} {'warm restart':>14} {'replay':>12}")
+    for size in args.sizes:
+        rng = random.Random(size)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            saved, path = Path(tmp_dir) / "saved.db", Path(tmp_dir) / "positions.db"
+            history = _fills(size, args.symbols, rng)
+            store = PositionStore(saved)
+            store.record_fills(BrokerageId.PAPER, history)
+            store.close()
+
+            def restore() -> None:
+                # each run starts from the state at shutdown
+                shutil.copyfile(saved, path)
+
+            overlap = int(RECONCILE_OVERLAP.total_seconds())
+            delta = history[-overlap:] + _fills(args.missed, args.symbols, rng, size)
+            warm = _time(lambda: _warm_restart(path, delta), args.iterations, restore)
+            replay = _time(lambda: _replay(path, delta), args.iterations, restore)
+        print(f"{size:>8} {warm:>12.2f}ms {replay:>10.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
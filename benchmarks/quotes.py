@@ -0,0 +1,157 @@
+"""Compare polling quotes one symbol at a time with batched quote requests.
+
+Run with ``python -m benchmarks.quotes``. Requests go to a local stub of the
+TD Ameritrade quotes endpoint that adds a fixed server latency, so the numbers
+show how HTTP calls per poll cycle and cycle latency grow with the watchlist.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import statistics
+import threading
+import time
+import typing as t
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from confz import ConfZDataSource
+
+from common.config import GlobalConfig
+from models.authentication import AuthTokens
+from models.brokerage import BrokerageId
+from services.brokerage import AsyncTDAmeritradeBrokerageService
+
+CONFIG = {
+    "server": {"port": 8089, "host": "https://localhost"},
+    "brokerages": [{"id": "td-a", "name": "TD Ameritrade", "client_id": "CLIENT"}],
+}
+
+
+class StubQuotesServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency_seconds: float) -> None:
+        super().__init__(("127.0.0.1", 0), _StubQuotesHandler)
+        self.latency_seconds = latency_seconds
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def uri(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host!s}:{port}/v1/marketdata/quotes"
+
+    def count_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+
+class _StubQuotesHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: StubQuotesServer
+
+    def do_GET(self) -> None:
+        self.server.count_request()
+        time.sleep(self.server.latency_seconds)
+        symbols = parse_qs(urlparse(self.path).query)["symbol"][0].split(",")
+        quote_time = int(time.time() * 1000)
+        body = json.dumps(
+            {
+                symbol: {
+                    "symbol": symbol,
+                    "lastPrice": 100.0,
+                    "bidPrice": 99.9,
+                    "askPrice": 100.1,
+                    "totalVolume": 1000,
+                    "quoteTimeInLong": quote_time,
+                }
+                for symbol in symbols
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: t.Any) -> None:
+        pass
+
+
+async def per_symbol(
+    service: AsyncTDAmeritradeBrokerageService,
+    tokens: AuthTokens,
+    symbols: t.List[str],
+) -> None:
+    await asyncio.gather(*(service.get_quote(tokens, symbol) for symbol in symbols))
+
+
+async def batched(
+    service: AsyncTDAmeritradeBrokerageService,
+    tokens: AuthTokens,
+    symbols: t.List[str],
+) -> None:
+    await service.get_quotes(tokens, symbols)
+
+
+async def run(args: argparse.Namespace, server: StubQuotesServer) -> None:
+    class StubTDAmeritradeBrokerageService(AsyncTDAmeritradeBrokerageService):
+        QUOTES_URI = server.uri
+
+    service = StubTDAmeritradeBrokerageService()
+    tokens = AuthTokens(
+        brokerage_id=BrokerageId.TD,
+        access_token="access",
+        access_expiry=datetime.datetime.now() + datetime.timedelta(minutes=30),
+        refresh_token="refresh",
+        refresh_expiry=datetime.datetime.now() + datetime.timedelta(days=90),
+    )
+    print(
+        f"server latency {args.latency_ms}ms, "
+        f"max {service.MAX_QUOTE_SYMBOLS} symbols per request"
+    )
+    try:
+        for size in args.symbols:
+            symbols = [f"SYM{i}" for i in range(size)]
+            for name, poll in [("per-symbol", per_symbol), ("batched", batched)]:
+                server.requests = 0
+                samples = []
+                for _ in range(args.iterations):
+                    start = time.perf_counter()
+                    await poll(service, tokens, symbols)
+                    samples.append(time.perf_counter() - start)
+                samples_ms = sorted(s * 1e3 for s in samples)
+                print(
+                    f"{size:>5} symbols  {name:<10} "
+                    f"calls/cycle {server.requests / args.iterations:7.1f}  "
+                    f"mean {statistics.mean(samples_ms):9.1f}ms  "
+                    f"max {samples_ms[-1]:9.1f}ms"
+                )
+    finally:
+        await service.aclose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument(
+        "--symbols", type=int, nargs="+", default=[10, 100, 250, 500, 1000]
+    )
+    args = parser.parse_args()
+
+    server = StubQuotesServer(args.latency_ms / 1000)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with GlobalConfig.change_config_sources(ConfZDataSource(data=CONFIG)):
+            asyncio.run(run(args, server))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""Compare serving the client build with StaticFiles and PrecompressedStaticFiles.
+
+Run with ``python -m benchmarks.static_assets``. Both apps are called in
+process, so the numbers are bytes on the wire and server time. Time to first
+paint is estimated from those, a bandwidth and a round trip time: index.html
+takes one round trip, and the scripts and stylesheets it loads another.
+
+Without a real build in client/build, a synthetic one the size of a typical
+create-react-app bundle is generated.
+"""
+import argparse
+import asyncio
+import random
+import re
+import tempfile
+import time
+import typing as t
+from pathlib import Path
+
+import httpx
+from starlette.staticfiles import StaticFiles
+from starlette.types import ASGIApp
+
+from api.static import PrecompressedStaticFiles, precompress
+
+ACCEPT_ENCODING = "gzip, deflate, br"
+ASSET_LINK = re.compile(r'(?:src|href)="/?(static/[^"]+\.(?:js|css))"')
+
+
+def _synthetic_source(rng: random.Random, size: int, css: bool) -> str:
+    words = ["state", "props", "render", "quote", "order", "price", "symbol", "view"]
+    parts: t.List[str] = []
+    while sum(map(len, parts)) < size:
+        name = f"{rng.choice(words)}{rng.choice(words).title()}{rng.randrange(999)}"
+        if css:
+            parts.append(f".{name}{{margin:{rng.randrange(32)}px;display:flex}}")
+        else:
+            parts.append(
+                f"function {name}(e,t){{return e.{rng.choice(words)}"
+                f"?t({rng.randrange(10**6)}):null}}"
+            )
+    return "".join(parts)
+
+
+def synthetic_build(directory: Path) -> None:
+    rng = random.Random(0)
+    files = {
+        "static/js/main.3f9a1c2e.js": (500_000, False),
+        "static/js/787.8b1d0f4a.chunk.js": (150_000, False),
+        "static/css/main.a1b2c3d4.css": (30_000, True),
+    }
+    links = []
+    for name, (size, css) in files.items():
+        path = directory / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(_synthetic_source(rng, size, css))
+        if "chunk" not in name:
+            tag = (
+                f'<link href="/{name}" rel="stylesheet">'
+                if css
+                else f'<script defer="defer" src="/{name}"></script>'
+            )
+            links.append(tag)
+    (directory / "index.html").write_text(
+        "<!doctype html><html lang='en'><head><meta charset='utf-8'>"
+        f"<title>MarkTrader</title>{''.join(links)}</head>"
+        "<body><div id='root'></div></body></html>"
+    )
+    (directory / "favicon.ico").write_bytes(
+        bytes(rng.randrange(256) for _ in range(3870))
+    )
+
+
+class Visit(t.NamedTuple):
+    requests: int
+    round_trips: int
+    bytes: int
+    server_seconds: float
+
+    def first_paint(self, bandwidth_mbps: float, rtt_ms: float) -> float:
+        transfer = self.bytes * 8 / (bandwidth_mbps * 1e6)
+        return self.round_trips * rtt_ms / 1000 + transfer + self.server_seconds
+
+
+async def _get(
+    client: httpx.AsyncClient, path: str, etag: t.Optional[str]
+) -> t.Tuple[httpx.Response, int, float]:
+    headers = {"Accept-Encoding": ACCEPT_ENCODING}
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    start = time.perf_counter()
+    response = await client.get(path, headers=headers)
+    elapsed = time.perf_counter() - start
+    header_bytes = sum(len(k) + len(v) + 4 for k, v in response.headers.raw)
+    return response, header_bytes + response.num_bytes_downloaded, elapsed
+
+
+async def visit(app: ASGIApp, cache: t.Dict[str, t.Tuple[str, httpx.Headers]]) -> Visit:
+    """load index.html and the assets it links, revalidating anything in cache
+    and skipping anything cached as immutable. fills cache for the next visit"""
+    requests = round_trips = total_bytes = 0
+    server_seconds = 0.0
+    transport = httpx.ASGITransport(app=app)  # type: ignore[arg-type]
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        paths = ["/"]
+        while paths:
+            fetch = []
+            for path in paths:
+                cached = cache.get(path)
+                if cached and "immutable" in cached[1].get("cache-control", ""):
+                    continue
+                fetch.append((path, cached[1].get("etag") if cached else None))
+            results = await asyncio.gather(
+                *(_get(client, path, etag) for path, etag in fetch)
+            )
+            if fetch:
+                round_trips += 1
+                server_seconds += max(elapsed for _, _, elapsed in results)
+            next_paths = []
+            for (path, _), (response, size, _) in zip(fetch, results):
+                requests += 1
+                total_bytes += size
+                if response.status_code == 200:
+                    cache[path] = (response.text, response.headers)
+            if paths == ["/"]:
+                next_paths = [f"/{link}" for link in ASSET_LINK.findall(cache["/"][0])]
+            paths = next_paths
+    return Visit(requests, round_trips, total_bytes, server_seconds)
+
+
+async def run(args: argparse.Namespace, directory: Path) -> None:
+    apps: t.List[t.Tuple[str, ASGIApp]] = [
+        ("StaticFiles", StaticFiles(directory=directory, html=True)),
+        ("precompressed", PrecompressedStaticFiles(directory)),
+    ]
+    print(f"{directory}: {args.bandwidth_mbps}Mbps, {args.rtt_ms}ms round trips")
+    for name, app in apps:
+        cache: t.Dict[str, t.Tuple[str, httpx.Headers]] = {}
+        for label in ("first visit", "repeat visit"):
+            result = await visit(app, cache)
+            print(
+                f"{name:<14} {label:<13} requests {result.requests:3d}  "
+                f"round trips {result.round_trips}  "
+                f"bytes {result.bytes:9d}  "
+                f"first paint ~{result.first_paint(args.bandwidth_mbps, args.rtt_ms) * 1e3:7.1f}ms"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--directory", type=Path, default=Path("client/build"))
+    parser.add_argument("--bandwidth-mbps", type=float, default=10)
+    parser.add_argument("--rtt-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = args.directory
+        if not (directory / "static").is_dir():
+            directory = Path(tmp)
+            synthetic_build(directory)
+            precompress(directory)
+        asyncio.run(run(args, directory))
+
+
+if __name__ == "__main__":
+    main()
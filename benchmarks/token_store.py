@@ -0,0 +1,84 @@
+"""Compare read and write latency of the token store backends.
+
+Run with ``python -m benchmarks.token_store``. The keyring backend is whatever
+keyring resolves on this machine.
+"""
+import argparse
+import datetime
+import statistics
+import tempfile
+import time
+import typing as t
+from pathlib import Path
+
+import keyring
+
+from models.authentication import AuthTokens
+from models.brokerage import BrokerageId
+from services.token_store import (
+    BaseTokenStore,
+    EncryptedFileTokenStore,
+    KeyringTokenStore,
+)
+
+SYSTEM = "MARK_TRADER_BENCHMARK"
+
+
+def _time_calls(func: t.Callable[[], t.Any], iterations: int) -> t.List[float]:
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def _report(name: str, operation: str, samples: t.List[float]) -> None:
+    samples_us = sorted(s * 1e6 for s in samples)
+    p99 = samples_us[int(len(samples_us) * 0.99) - 1]
+    print(
+        f"{name:<16} {operation:<6} "
+        f"mean {statistics.mean(samples_us):10.1f}us  "
+        f"p50 {statistics.median(samples_us):10.1f}us  "
+        f"p99 {p99:10.1f}us"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    tokens = AuthTokens(
+        brokerage_id=BrokerageId.TD,
+        access_token="a" * 1024,
+        access_expiry=datetime.datetime.now() + datetime.timedelta(minutes=30),
+        refresh_token="r" * 1024,
+        refresh_expiry=datetime.datetime.now() + datetime.timedelta(days=90),
+    )
+
+    print(f"keyring backend: {keyring.get_keyring()}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        stores: t.Dict[str, BaseTokenStore] = {
+            "keyring": KeyringTokenStore(SYSTEM),
+            "encrypted-file": EncryptedFileTokenStore(
+                SYSTEM, Path(tmp_dir) / "benchmark.tokens"
+            ),
+        }
+        for name, store in stores.items():
+            _report(
+                name, "write", _time_calls(lambda: store.set(tokens), args.iterations)
+            )
+            _report(
+                name,
+                "read",
+                _time_calls(lambda: store.get(BrokerageId.TD), args.iterations),
+            )
+            store.delete(BrokerageId.TD)
+
+    if keyring.get_password(SYSTEM, "TOKEN_FILE_KEY") is not None:
+        keyring.delete_password(SYSTEM, "TOKEN_FILE_KEY")
+
+
+if __name__ == "__main__":
+    main()
@@ -54,4 +54,61 @@ async function setUserSettings(data: Record<string, unknown>): Promise<UserSetti
     return resJson as UserSettings;
 }
 
-export {getAuthUri, getSignInStatus, signOut, signIn, getUserSettings, setUserSettings};
+type EventListener<T> = (data: T) => void;
+
+// every event carrying an AuthStatus, starting with the status when connected
+const AUTH_EVENTS = ['auth', 'sign_in', 'sign_out', 'token_refresh'];
+const SETTINGS_EVENTS = ['settings'];
+
+// one connection is shared by every subscriber and closed with the last one
+let eventSource: EventSource | null = null;
+let eventSubscribers = 0;
+const latestEvents = new Map<string, unknown>();
+
+function openEvents(): EventSource {
+    if (eventSource === null) {
+        const source = new EventSource(new URL('/api/v1/events/', window.location.origin));
+        const remember = (group: string) => (event: MessageEvent) => latestEvents.set(group, JSON.parse(event.data));
+        AUTH_EVENTS.forEach(type => source.addEventListener(type, remember('auth')));
+        SETTINGS_EVENTS.forEach(type => source.addEventListener(type, remember('settings')));
+        eventSource = source;
+    }
+    eventSubscribers++;
+    return eventSource;
+}
+
+function closeEvents(): void {
+    eventSubscribers--;
+    if (eventSubscribers === 0 && eventSource !== null) {
+        eventSource.close();
+        eventSource = null;
+        latestEvents.clear();
+    }
+}
+
+function subscribe<T>(group: string, eventTypes: string[], listener: EventListener<T>): () => void {
+    const source = openEvents();
+    const handler = (event: MessageEvent) => listener(JSON.parse(event.data) as T);
+    eventTypes.forEach(type => source.addEventListener(type, handler));
+    // subscribers joining an open connection start from the last event it delivered
+    if (latestEvents.has(group)) {
+        listener(latestEvents.get(group) as T);
+    }
+    return () => {
+        eventTypes.forEach(type => source.removeEventListener(type, handler));
+        closeEvents();
+    };
+}
+
+function subscribeToAuthStatus(listener: EventListener<AuthStatus>): () => void {
+    return subscribe('auth', AUTH_EVENTS, listener);
+}
+
+function subscribeToUserSettings(listener: EventListener<UserSettings>): () => void {
+    return subscribe('settings', SETTINGS_EVENTS, listener);
+}
+
+export {
+    getAuthUri, getSignInStatus, signOut, signIn, getUserSettings, setUserSettings,
+    subscribeToAuthStatus, subscribeToUserSettings
+};
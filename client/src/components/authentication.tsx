@@ -1,6 +1,6 @@
 import { Button, Stack } from '@mui/material';
 import React from 'react';
-import { getAuthUri, getSignInStatus, signOut } from '../common/apiClient';
+import { getAuthUri, getSignInStatus, signOut, subscribeToAuthStatus } from '../common/apiClient';
 import './authentication.css';
 
 interface AuthenticatorState {
@@ -16,6 +16,8 @@ function AuthenticatorStatus(props: AuthenticatorState) {
 }
 
 export default class Authenticator extends React.Component<Record<string, unknown>, AuthenticatorState> {
+    private unsubscribe: (() => void) | null = null;
+
     constructor(props: Record<string, unknown>) {
         super(props);
         this.state = {
@@ -24,8 +26,16 @@ export default class Authenticator extends React.Component<Record<string, unknow
 
         this.updateStatus = this.updateStatus.bind(this);
         this.signOut = this.signOut.bind(this);
+    }
+
+    componentDidMount(): void {
+        // the server pushes the status on connect and whenever it changes
+        this.unsubscribe = subscribeToAuthStatus(authStatus => this.setState({['isSignedIn']: authStatus.signed_in}));
+    }
 
-        this.updateStatus();
+    componentWillUnmount(): void {
+        this.unsubscribe?.();
+        this.unsubscribe = null;
     }
 
     render(): React.ReactNode {
@@ -4,9 +4,11 @@ import './index.css';
 import Authenticator from './components/authentication';
 import UserSettingsPanel from './components/userSettingsPanel';
 import { UserSettings } from './common/models';
-import { getUserSettings, setUserSettings, signIn } from './common/apiClient';
+import { setUserSettings, signIn, subscribeToUserSettings } from './common/apiClient';
 
 class Application extends React.Component<Record<string, unknown>, UserSettings> {
+    private unsubscribe: (() => void) | null = null;
+
     constructor(props: Record<string, unknown>) {
         super(props);
         this.state = {
@@ -18,15 +20,24 @@ class Application extends React.Component<Record<string, unknown>, UserSettings>
         };
         if (window.location.search) {
             const params = new URLSearchParams(window.location.search);
-            signIn('td-a', params.get('code') as string).then(
+            signIn(params.get('state') ?? 'td-a', params.get('code') as string).then(
                 () => {
                     window.location.replace(window.location.origin);
                 });
         }
-        getUserSettings().then((settings: UserSettings) => this.setState(settings));
         this.handleUpdateUserSettings = this.handleUpdateUserSettings.bind(this);
     }
 
+    componentDidMount(): void {
+        // settings arrive on connect and again whenever they change, in any tab
+        this.unsubscribe = subscribeToUserSettings((settings: UserSettings) => this.setState(settings));
+    }
+
+    componentWillUnmount(): void {
+        this.unsubscribe?.();
+        this.unsubscribe = null;
+    }
+
     handleUpdateUserSettings(data: Record<string, unknown>) {
         setUserSettings(data).then((settings: UserSettings) => this.setState(settings));
     }
@@ -1,50 +1,290 @@
+import contextlib
+import logging
 import threading
 import typing as t
 from pathlib import Path
+from types import MappingProxyType
+from urllib.parse import quote_plus
 
 import yaml
 from confz import ConfZ, ConfZDataSource, ConfZFileSource
-from pydantic import Field
+from confz.exceptions import ConfZException
+from pydantic import Field, ValidationError
 
+from common.metrics import Histogram
+from common.utils import FileLock, atomic_write
+from models.authentication import TokenStoreType
 from models.brokerage import BrokerageId
 
 APP_NAME = "mark_trader"
+GLOBAL_CONFIG_FILE = Path("./config.yml")
+USER_SETTINGS_FILE = Path("./user-settings.yml")
+
+LOGGER = logging.getLogger(f"{APP_NAME}.config")
 
 user_settings_update_lock = threading.Lock()
 
+USER_SETTINGS_UPDATE_SECONDS = Histogram(
+    "mark_trader_user_settings_update_seconds",
+    "UserSettings.update calls, including subscriber callbacks",
+)
+USER_SETTINGS_WRITE_SECONDS = Histogram(
+    "mark_trader_user_settings_write_seconds",
+    "Writes of pending user settings changes to the settings file",
+)
+
 
 class ServerConfig(ConfZ):
     port: int
     host: str
+    # worker processes for python app.py. one of them refreshes tokens for all
+    workers: int = Field(default=1, gt=0)
 
     @property
     def redirect_uri(self) -> str:
         return f"{self.host}:{self.port}/"
 
 
+class HttpClientConfig(ConfZ):
+    max_connections: int = 10
+    max_keepalive_connections: int = 5
+    keepalive_expiry_seconds: float = 60
+    connect_timeout_seconds: float = 5
+    timeout_seconds: float = 15
+    http2: bool = True
+
+
+class PaperBrokerageConfig(ConfZ):
+    """settings for the simulated paper trading brokerage"""
+
+    latency_seconds: float = Field(default=0.05, ge=0)
+    latency_jitter_seconds: float = Field(default=0, ge=0)
+    error_rate: float = Field(default=0, ge=0, le=1)
+    seed: t.Optional[int] = None
+    # replay SYMBOL.csv bars from this directory instead of a synthetic random walk
+    feed_dir: t.Optional[Path] = None
+    start_price: float = Field(default=100, gt=0)
+    volatility: float = Field(default=0.0005, ge=0)
+    spread: float = Field(default=0.01, ge=0)
+    commission: float = Field(default=0, ge=0)
+    access_token_seconds: int = Field(default=30 * 60, gt=0)
+    refresh_token_seconds: int = Field(default=90 * 24 * 60 * 60, gt=0)
+
+
+class RateLimitConfig(ConfZ):
+    requests_per_second: float = Field(default=2, gt=0)
+    burst: int = Field(default=10, gt=0)
+
+
+class RetryConfig(ConfZ):
+    """retries of brokerage calls that failed with a timeout, a dropped
+    connection, 429 or 5xx. waits are random up to an exponential cap"""
+
+    max_attempts: int = Field(default=3, gt=0)
+    base_delay_seconds: float = Field(default=0.25, ge=0)
+    max_delay_seconds: float = Field(default=4, ge=0)
+
+
+class CircuitBreakerConfig(ConfZ):
+    """fail calls to an endpoint fast after failure_threshold failures in a
+    row, then let one call through every reset_timeout_seconds to probe it"""
+
+    failure_threshold: int = Field(default=5, gt=0)
+    reset_timeout_seconds: float = Field(default=30, gt=0)
+
+
 class BrokerageConfig(ConfZ):
     id: BrokerageId
     name: str
     client_id: str
+    http: HttpClientConfig = HttpClientConfig()
+    order_rate_limit: RateLimitConfig = RateLimitConfig()
+    retry: RetryConfig = RetryConfig()
+    circuit_breaker: CircuitBreakerConfig = CircuitBreakerConfig()
+    paper: PaperBrokerageConfig = PaperBrokerageConfig()
 
 
 class AuthenticationConfig(ConfZ):
     login_check_delay_seconds: int = 5 * 60
     refresh_buffer_seconds: int = 5 * 60
+    token_store: TokenStoreType = TokenStoreType.KEYRING
+    # how often a worker that isn't refreshing tokens checks if the leader is gone
+    leader_poll_seconds: float = Field(default=5.0, gt=0)
+    # how often workers check the token store for changes made by other workers
+    token_watch_interval_seconds: float = Field(default=2.0, gt=0)
+
+
+class MarketDataConfig(ConfZ):
+    buffer_size: int = Field(default=4096, gt=0)
+
+
+class OrdersConfig(ConfZ):
+    queue_size: int = Field(default=1000, gt=0)
+    workers: int = Field(default=4, gt=0)
+
+
+class ProfilingConfig(ConfZ):
+    """request profiling, off unless enabled. sampled requests are profiled at
+    random, and any request can ask for a profile with the admin token"""
+
+    enabled: bool = False
+    sample_rate: float = Field(default=0, ge=0, le=1)
+    interval_seconds: float = Field(default=0.005, gt=0)
+    max_profiles: int = Field(default=100, gt=0)
+    max_concurrent: int = Field(default=2, gt=0)
+    # sampling stops after this long, the rest of a longer request goes unprofiled
+    max_seconds: float = Field(default=30, gt=0)
+    # bearer token for the profile admin endpoints, which are off without it
+    admin_token: t.Optional[str] = None
+
+
+class JournalConfig(ConfZ):
+    """the trade journal. each worker process writes its own segments, and
+    starts a new one when the current one is full or older than rotate_seconds"""
+
+    enabled: bool = True
+    records_per_segment: int = Field(default=262144, gt=0)
+    rotate_seconds: float = Field(default=86400, gt=0)
 
 
 class GlobalConfig(ConfZ):
     server: ServerConfig
     authentication: AuthenticationConfig = AuthenticationConfig()
+    market_data: MarketDataConfig = MarketDataConfig()
+    orders: OrdersConfig = OrdersConfig()
+    profiling: ProfilingConfig = ProfilingConfig()
+    journal: JournalConfig = JournalConfig()
     brokerages: t.List[BrokerageConfig]
+    data_dir: Path = Path("./data")
+    config_watch_interval_seconds: float = 2.0
+    user_settings_write_delay_seconds: float = 0.5
 
-    CONFIG_SOURCES = ConfZFileSource(file=Path("./config.yml"))
+    CONFIG_SOURCES = ConfZFileSource(file=GLOBAL_CONFIG_FILE)
 
     @property
-    def brokerage_map(self) -> t.Dict[BrokerageId, BrokerageConfig]:
+    def brokerage_map(self) -> t.Mapping[BrokerageId, BrokerageConfig]:
+        snapshot = config_snapshot()
+        if snapshot.config is self:
+            return snapshot.brokerage_map
         return {b.id: b for b in self.brokerages}
 
 
+class ConfigSnapshot:
+    """Values derived from one GlobalConfig instance, computed once and never mutated"""
+
+    def __init__(self, config: GlobalConfig) -> None:
+        self.config = config
+        self.brokerage_map: t.Mapping[BrokerageId, BrokerageConfig] = MappingProxyType(
+            {b.id: b for b in config.brokerages}
+        )
+        self.quoted_redirect_uri = quote_plus(config.server.redirect_uri)
+        self._auth_uris: t.Dict[t.Tuple[BrokerageId, str], str] = {}
+
+    def auth_uri(self, brokerage_id: BrokerageId, formatter: str) -> str:
+        """render a brokerage's OAuth URI once per snapshot"""
+        key = (brokerage_id, formatter)
+        uri = self._auth_uris.get(key)
+        if uri is None:
+            uri = self._auth_uris[key] = formatter.format(
+                redirect_uri=self.quoted_redirect_uri,
+                client_id=quote_plus(self.brokerage_map[brokerage_id].client_id),
+            )
+        return uri
+
+
+_config_snapshot: t.Optional[ConfigSnapshot] = None
+
+
+def config_snapshot() -> ConfigSnapshot:
+    """the snapshot of the current GlobalConfig, rebuilt only when the config changes"""
+    global _config_snapshot
+    config = GlobalConfig()
+    snapshot = _config_snapshot
+    if snapshot is None or snapshot.config is not config:
+        snapshot = _config_snapshot = ConfigSnapshot(config)
+    return snapshot
+
+
+def reload_global_config() -> bool:
+    """re-read the global config sources and swap in a new snapshot if they are valid"""
+    global _config_snapshot
+    try:
+        config = GlobalConfig(config_sources=GlobalConfig.CONFIG_SOURCES)
+    except (ConfZException, ValidationError, yaml.YAMLError):
+        LOGGER.exception("Invalid global config, keeping the current config")
+        return False
+    snapshot = ConfigSnapshot(config)
+    GlobalConfig.confz_instance = config
+    _config_snapshot = snapshot
+    LOGGER.info("Global config reloaded")
+    return True
+
+
+class _UserSettingsWriter:
+    """Coalesces settings changes for one file and persists them after a delay.
+
+    Only the changed keys are merged into the file, under a lock shared with
+    other processes, so workers updating different settings don't clobber each
+    other. The file is replaced atomically.
+    """
+
+    def __init__(
+        self, path: Path, on_written: t.Callable[[Path, t.Dict[str, t.Any]], None]
+    ) -> None:
+        self.path = path
+        self._on_written = on_written
+        self._lock_path = path.with_name(f".{path.name}.lock")
+        self._pending: t.Dict[str, t.Any] = {}
+        self._timer: t.Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    @property
+    def pending(self) -> t.Dict[str, t.Any]:
+        with self._lock:
+            return dict(self._pending)
+
+    def schedule(self, changes: t.Dict[str, t.Any], delay_seconds: float) -> None:
+        with self._lock:
+            self._pending.update(changes)
+            if self._timer is None:
+                self._timer = threading.Timer(delay_seconds, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                changes, self._pending = self._pending, {}
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if not changes:
+                return
+
+            with USER_SETTINGS_WRITE_SECONDS.time(), FileLock(self._lock_path):
+                try:
+                    with open(self.path) as f:
+                        data = yaml.safe_load(f) or {}
+                except FileNotFoundError:
+                    data = {}
+                data.update(changes)
+                atomic_write(self.path, yaml.dump(data).encode())
+            LOGGER.info(f"User settings saved to {self.path}")
+            self._on_written(self.path, data)
+
+
+class UserSettingsChange(t.NamedTuple):
+    old: "UserSettings"
+    new: "UserSettings"
+    changed: t.FrozenSet[str]
+    # made by this process, not read from a file another process wrote
+    local: bool = True
+
+
+UserSettingsSubscriber = t.Callable[[UserSettingsChange], None]
+
+
 class UserSettings(ConfZ):
     symbols: t.List[str] = Field(unique_items=True)
     end_of_day_exit: bool = False
@@ -52,20 +292,131 @@ class UserSettings(ConfZ):
     trading_frequency_seconds: int = Field(default=5, gte=1)
     position_size: float = Field(default=10, gt=0)
 
-    CONFIG_SOURCES = ConfZFileSource(file=Path("./user-settings.yml"))
+    CONFIG_SOURCES = ConfZFileSource(file=USER_SETTINGS_FILE)
+
+    _writers: t.ClassVar[t.Dict[Path, _UserSettingsWriter]] = {}
+    _subscribers: t.ClassVar[
+        t.List[t.Tuple[UserSettingsSubscriber, t.Optional[t.FrozenSet[str]]]]
+    ] = []
+
+    @classmethod
+    def subscribe(
+        cls,
+        subscriber: UserSettingsSubscriber,
+        fields: t.Optional[t.Iterable[str]] = None,
+    ) -> t.Callable[[], None]:
+        """call subscriber with the change whenever settings change, optionally only
+        when one of fields changes. subscribers run on the thread that made the change
+        and should return quickly. returns a function that unsubscribes"""
+        entry = (subscriber, frozenset(fields) if fields is not None else None)
+        cls._subscribers.append(entry)
+
+        def unsubscribe() -> None:
+            with contextlib.suppress(ValueError):
+                cls._subscribers.remove(entry)
+
+        return unsubscribe
+
+    @classmethod
+    def _publish(
+        cls, old: "UserSettings", new: "UserSettings", local: bool = True
+    ) -> None:
+        changed = frozenset(
+            name for name in cls.__fields__ if getattr(old, name) != getattr(new, name)
+        )
+        if not changed:
+            return
+        change = UserSettingsChange(old, new, changed, local)
+        for subscriber, fields in list(cls._subscribers):
+            if fields is not None and not fields & changed:
+                continue
+            try:
+                subscriber(change)
+            except Exception:
+                LOGGER.exception(f"User settings subscriber {subscriber} failed")
+
+    @classmethod
+    def _validate_changes(
+        cls, update_data: t.Dict[str, t.Union[int, float, bool, t.List[str]]]
+    ) -> t.Dict[str, t.Any]:
+        """validate only the fields being changed"""
+        changes: t.Dict[str, t.Any] = {}
+        errors = []
+        for name, value in update_data.items():
+            field = cls.__fields__.get(name)
+            if field is None:
+                continue
+            if name == "symbols":
+                value = [s.upper() for s in t.cast(t.List[str], value)]
+            validated, error = field.validate(value, changes, loc=name, cls=cls)
+            if error:
+                errors.append(error)
+            else:
+                changes[name] = validated
+        if errors:
+            raise ValidationError(errors, cls)
+        return changes
+
+    @classmethod
+    def _writer(cls) -> t.Optional[_UserSettingsWriter]:
+        if not isinstance(cls.CONFIG_SOURCES, ConfZFileSource):
+            return None
+        path = Path(t.cast(str, cls.CONFIG_SOURCES.file))
+        writer = cls._writers.get(path)
+        if writer is None:
+            writer = cls._writers[path] = _UserSettingsWriter(path, cls._on_written)
+        return writer
+
+    @classmethod
+    def _on_written(cls, path: Path, data: t.Dict[str, t.Any]) -> None:
+        # pick up settings other workers or external edits put in the file
+        with user_settings_update_lock:
+            writer = cls._writer()
+            if writer is None or writer.path != path:
+                return
+            old = cls.__call__()
+            data = {**data, **writer.pending}
+            try:
+                new = cls(config_sources=ConfZDataSource(data=data))
+            except ValidationError:
+                LOGGER.exception(f"Invalid user settings in {path}, keeping current")
+                return
+            cls.confz_instance = new
+        cls._publish(old, new, local=False)
+
+    @classmethod
+    def reload(cls) -> None:
+        """re-read the settings file after it was edited outside this process"""
+        writer = cls._writer()
+        if writer is None:
+            return
+        try:
+            with open(writer.path) as f:
+                data = yaml.safe_load(f) or {}
+        except (FileNotFoundError, yaml.YAMLError):
+            LOGGER.exception(f"Unable to read user settings {writer.path}")
+            return
+        cls._on_written(writer.path, data)
 
     @classmethod
     def update(
         cls, update_data: t.Dict[str, t.Union[int, float, bool, t.List[str]]]
     ) -> None:
-        with user_settings_update_lock:
-            existing = cls.__call__().dict()
-            existing.update(update_data)
-            existing["symbols"] = [s.upper() for s in existing["symbols"]]
-            cfg_file = cls.CONFIG_SOURCES.file
-            with UserSettings.change_config_sources(ConfZDataSource(data=existing)):
-                # access the updated settings to validate.
-                UserSettings()
-                with open(cfg_file, mode="w") as f:
-                    yaml.dump(cls.confz_instance.dict(), f)
-            cls.confz_instance = None
+        """apply validated changes in memory right away and persist them shortly after"""
+        with USER_SETTINGS_UPDATE_SECONDS.time():
+            with user_settings_update_lock:
+                changes = cls._validate_changes(update_data)
+                old = cls.__call__()
+                new = cls.confz_instance = old.copy(update=changes)
+                writer = cls._writer()
+                if writer is not None:
+                    writer.schedule(
+                        changes, GlobalConfig().user_settings_write_delay_seconds
+                    )
+            cls._publish(old, new)
+
+    @classmethod
+    def flush(cls) -> None:
+        """persist pending changes now"""
+        for writer in list(cls._writers.values()):
+            writer.flush()
@@ -0,0 +1,257 @@
+"""Counters, gauges and latency histograms exported in the Prometheus text format.
+
+Recording a sample is a dictionary lookup for the labels and an addition under
+a lock, cheap enough to leave on in production. Metrics are declared at module
+level next to the code they measure and register themselves with REGISTRY.
+"""
+import bisect
+import contextlib
+import enum
+import math
+import threading
+import time
+import typing as t
+
+# seconds, from a fast keyring read to a slow brokerage call
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Sample = t.Tuple[str, t.Tuple[t.Tuple[str, str], ...], float]
+
+
+def _label_value(value: t.Any) -> str:
+    return str(value.value if isinstance(value, enum.Enum) else value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class _CounterValue:
+    def __init__(self) -> None:
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        if amount < 0:
+            raise ValueError("counters can only increase")
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeValue:
+    def __init__(self) -> None:
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.inc(-amount)
+
+
+class _HistogramValue:
+    def __init__(self, buckets: t.Sequence[float]) -> None:
+        self.buckets = buckets
+        # the last count is for samples above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextlib.contextmanager
+    def time(self) -> t.Iterator[None]:
+        """observe the seconds spent in the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+V = t.TypeVar("V")
+
+
+class _Metric(t.Generic[V]):
+    type_name = ""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: t.Sequence[str] = (),
+        registry: t.Optional["Registry"] = None,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: t.Dict[t.Tuple[str, ...], V] = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _new_value(self) -> V:
+        raise NotImplementedError
+
+    def labels(self, *values: t.Any) -> V:
+        """the series for these label values, in the order of labelnames"""
+        key = tuple(_label_value(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(key, self._new_value())
+        return child
+
+    def _series(self) -> t.List[t.Tuple[t.Tuple[t.Tuple[str, str], ...], V]]:
+        with self._lock:
+            children = list(self._children.items())
+        return [(tuple(zip(self.labelnames, key)), child) for key, child in children]
+
+    def samples(self) -> t.Iterator[Sample]:
+        raise NotImplementedError
+
+
+class Counter(_Metric[_CounterValue]):
+    type_name = "counter"
+
+    def _new_value(self) -> _CounterValue:
+        return _CounterValue()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def samples(self) -> t.Iterator[Sample]:
+        for labels, child in self._series():
+            yield self.name, labels, child.value
+
+
+class Gauge(_Metric[_GaugeValue]):
+    """A value that goes up and down. A gauge without labels can instead read
+    its value from function when exported."""
+
+    type_name = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: t.Sequence[str] = (),
+        registry: t.Optional["Registry"] = None,
+        function: t.Optional[t.Callable[[], float]] = None,
+    ) -> None:
+        if function is not None and labelnames:
+            raise ValueError("only gauges without labels can read a function")
+        self._function = function
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_value(self) -> _GaugeValue:
+        return _GaugeValue()
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def samples(self) -> t.Iterator[Sample]:
+        if self._function is not None:
+            yield self.name, (), float(self._function())
+            return
+        for labels, child in self._series():
+            yield self.name, labels, child.value
+
+
+class Histogram(_Metric[_HistogramValue]):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: t.Sequence[str] = (),
+        registry: t.Optional["Registry"] = None,
+        buckets: t.Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_value(self) -> _HistogramValue:
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self) -> t.ContextManager[None]:
+        return self.labels().time()
+
+    def samples(self) -> t.Iterator[Sample]:
+        for labels, child in self._series():
+            with child._lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                le = (("le", _format_value(bound)),)
+                yield f"{self.name}_bucket", labels + le, cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: t.Dict[str, _Metric[t.Any]] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric[t.Any]) -> None:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """every metric in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+                    name = f"{name}{{{label_text}}}"
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
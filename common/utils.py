@@ -1,6 +1,435 @@
+import abc
+import asyncio
+import contextlib
+import datetime
+import fcntl
+import functools
+import heapq
+import itertools
+import logging
+import os
 import time
+import typing as t
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
+T = t.TypeVar("T")
 
-def safe_sleep(seconds: int) -> None:
-    """a call to sleep that can be easily mocked"""
-    time.sleep(seconds)
+LOGGER = logging.getLogger("mark_trader.utils")
+
+# bounded pool for blocking calls (keyring, token files) made from the event loop
+BLOCKING_IO_WORKERS = 4
+BLOCKING_IO_THREAD_PREFIX = "blocking-io"
+_blocking_io_executor = ThreadPoolExecutor(
+    max_workers=BLOCKING_IO_WORKERS, thread_name_prefix=BLOCKING_IO_THREAD_PREFIX
+)
+
+
+_blocking_calls_in_flight = 0
+
+
+async def run_blocking(func: t.Callable[..., T], *args: t.Any, **kwargs: t.Any) -> T:
+    """run a blocking call on the bounded blocking IO pool without blocking the event loop"""
+    global _blocking_calls_in_flight
+    _blocking_calls_in_flight += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            _blocking_io_executor, functools.partial(func, *args, **kwargs)
+        )
+    finally:
+        _blocking_calls_in_flight -= 1
+
+
+async def _wait_for_event(
+    event: asyncio.Event, timer: t.Optional["asyncio.Future[t.Any]"]
+) -> bool:
+    waiter: "asyncio.Future[t.Any]" = asyncio.ensure_future(event.wait())
+    try:
+        done, _ = await asyncio.wait(
+            {waiter} if timer is None else {waiter, timer},
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+    finally:
+        waiter.cancel()
+        if timer is not None:
+            timer.cancel()
+    return waiter in done
+
+
+class Clock(abc.ABC):
+    """The source of time for services, so simulations can replace the wall clock"""
+
+    @abc.abstractmethod
+    def time(self) -> float:
+        """seconds since the epoch"""
+        raise NotImplemented
+
+    def now(self) -> datetime.datetime:
+        """local time, like datetime.datetime.now()"""
+        return datetime.datetime.fromtimestamp(self.time())
+
+    @abc.abstractmethod
+    def sleep_blocking(self, seconds: float) -> None:
+        raise NotImplemented
+
+    @abc.abstractmethod
+    async def sleep(self, seconds: float) -> None:
+        raise NotImplemented
+
+    @abc.abstractmethod
+    async def wait_for_event(
+        self, event: asyncio.Event, timeout: t.Optional[float]
+    ) -> bool:
+        raise NotImplemented
+
+
+class RealClock(Clock):
+    def time(self) -> float:
+        return time.time()
+
+    def sleep_blocking(self, seconds: float) -> None:
+        time.sleep(seconds)
+
+    async def sleep(self, seconds: float) -> None:
+        await asyncio.sleep(seconds)
+
+    async def wait_for_event(
+        self, event: asyncio.Event, timeout: t.Optional[float]
+    ) -> bool:
+        timer = None
+        if timeout is not None:
+            timer = asyncio.ensure_future(asyncio.sleep(timeout))
+        return await _wait_for_event(event, timer)
+
+
+class _VirtualTimer(t.NamedTuple):
+    when: float
+    seq: int
+    future: "asyncio.Future[None]"
+
+
+class VirtualClock(Clock):
+    """A discrete event clock for simulations.
+
+    Time stands still while tasks run. run_until() lets the event loop settle,
+    then jumps straight to the next sleep or wait timeout that is due, so hours
+    of timers run in milliseconds. The loop counts as settled once a number of
+    loop iterations pass with no new timers and no run_blocking calls in flight;
+    tasks waiting on anything else (sockets, real sleeps) are not waited for.
+    """
+
+    SETTLE_ITERATIONS = 20
+
+    def __init__(self, start: t.Optional[datetime.datetime] = None) -> None:
+        self._time = (start or datetime.datetime.now()).timestamp()
+        self._timers: t.List[_VirtualTimer] = []
+        self._seq = itertools.count()
+
+    def time(self) -> float:
+        return self._time
+
+    def sleep_blocking(self, seconds: float) -> None:
+        # nothing else runs on this thread meanwhile, so just move time on
+        self._time += max(seconds, 0)
+
+    def _timer(self, seconds: float) -> "asyncio.Future[None]":
+        future: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        timer = _VirtualTimer(self._time + max(seconds, 0), next(self._seq), future)
+        heapq.heappush(self._timers, timer)
+        return future
+
+    async def sleep(self, seconds: float) -> None:
+        if seconds <= 0:
+            await asyncio.sleep(0)
+            return
+        await self._timer(seconds)
+
+    async def wait_for_event(
+        self, event: asyncio.Event, timeout: t.Optional[float]
+    ) -> bool:
+        return await _wait_for_event(
+            event, self._timer(timeout) if timeout is not None else None
+        )
+
+    @property
+    def next_wakeup(self) -> t.Optional[float]:
+        while self._timers and self._timers[0].future.done():
+            heapq.heappop(self._timers)
+        return self._timers[0].when if self._timers else None
+
+    async def _settle(self) -> None:
+        idle = 0
+        while idle < self.SETTLE_ITERATIONS:
+            timers = len(self._timers)
+            if _blocking_calls_in_flight:
+                await asyncio.sleep(0.001)
+                idle = 0
+                continue
+            await asyncio.sleep(0)
+            idle = idle + 1 if len(self._timers) == timers else 0
+
+    async def run_until(self, deadline: t.Union[float, datetime.datetime]) -> None:
+        """fire every timer due up to deadline, in order, then move time to deadline"""
+        if isinstance(deadline, datetime.datetime):
+            deadline = deadline.timestamp()
+        while True:
+            await self._settle()
+            when = self.next_wakeup
+            if when is None or when > deadline:
+                break
+            timer = heapq.heappop(self._timers)
+            self._time = max(self._time, timer.when)
+            timer.future.set_result(None)
+        self._time = max(self._time, deadline)
+        await self._settle()
+
+    async def advance(self, seconds: float) -> None:
+        await self.run_until(self._time + seconds)
+
+
+_clock: Clock = RealClock()
+
+
+def get_clock() -> Clock:
+    return _clock
+
+
+def set_clock(clock: Clock) -> Clock:
+    """make clock the source of time for every service, returning the previous clock"""
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+
+@contextlib.contextmanager
+def use_clock(clock: Clock) -> t.Iterator[Clock]:
+    previous = set_clock(clock)
+    try:
+        yield clock
+    finally:
+        set_clock(previous)
+
+
+def safe_sleep(seconds: float) -> None:
+    """sleep on the current clock"""
+    get_clock().sleep_blocking(seconds)
+
+
+async def wait_for_event(event: asyncio.Event, timeout: t.Optional[float]) -> bool:
+    """wait up to timeout seconds on the current clock for event, returning whether
+    it was set.
+
+    unlike asyncio.wait_for, cancelling the caller is never swallowed when the
+    event is set at the same moment.
+    """
+    return await get_clock().wait_for_event(event, timeout)
+
+
+def atomic_write(path: Path, data: bytes) -> None:
+    """write to a temporary file and rename it over path so readers never see a partial file"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, mode="wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class FileLock:
+    """An exclusive lock shared between processes, held with flock on a lock file"""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._fd: t.Optional[int] = None
+
+    def __enter__(self) -> "FileLock":
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        return self
+
+    def __exit__(self, *exc_info: t.Any) -> None:
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+class LeaderLock:
+    """Leadership among the processes sharing a lock file, held with a
+    non-blocking flock for as long as the leader runs.
+
+    The kernel drops the lock when its holder exits, however it exits, so a
+    follower takes over at its next try_acquire.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._fd: t.Optional[int] = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        except BaseException:
+            os.close(fd)
+            raise
+        # the holder's pid, for whoever wonders which worker is leading
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+class BackgroundService(t.Protocol):
+    def start(self) -> None:
+        ...
+
+    async def stop(self) -> None:
+        ...
+
+
+class LeaderServices:
+    """Runs services that must run in only one worker process, in whichever
+    worker holds the leader lock at path. The others try the lock every
+    poll_seconds and start the services when the leader exits."""
+
+    def __init__(
+        self,
+        path: Path,
+        services: t.Sequence[BackgroundService],
+        poll_seconds: float,
+    ) -> None:
+        self._leader = LeaderLock(path)
+        self._services = services
+        self._poll_seconds = poll_seconds
+        self._task: t.Optional[asyncio.Task[None]] = None
+
+    @property
+    def leader(self) -> bool:
+        return self._leader.held
+
+    def start(self) -> None:
+        if self._task is not None and not self._task.done():
+            return
+        self._task = asyncio.get_running_loop().create_task(
+            self._run(), name=f"LEADER_SERVICES {self._leader.path}"
+        )
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    async def _run(self) -> None:
+        try:
+            while not self._leader.try_acquire():
+                await get_clock().sleep(self._poll_seconds)
+            LOGGER.info(f"Leading {self._leader.path}")
+            for service in self._services:
+                service.start()
+            # run until stopped
+            await asyncio.Event().wait()
+        finally:
+            for service in reversed(self._services):
+                await service.stop()
+            self._leader.release()
+
+
+class VersionStamp:
+    """An opaque version shared between processes through a small file.
+
+    Writers call bump() after changing the data the stamp guards. Readers compare
+    read() with the stamp they cached alongside their copy of the data.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def read(self) -> str:
+        try:
+            return self.path.read_text()
+        except FileNotFoundError:
+            return ""
+
+    def bump(self) -> str:
+        version = f"{time.time_ns()}-{os.getpid()}-{uuid.uuid4().hex}"
+        atomic_write(self.path, version.encode())
+        return version
+
+
+class FileWatcher:
+    """Polls a file's modification time from the event loop and calls on_change
+    on the blocking IO pool whenever the file is replaced or edited."""
+
+    def __init__(
+        self,
+        path: Path,
+        on_change: t.Callable[[], t.Any],
+        interval_seconds: float = 2.0,
+    ) -> None:
+        self.path = path
+        self._on_change = on_change
+        self._interval_seconds = interval_seconds
+        self._last_stat: t.Optional[t.Tuple[int, int, int]] = None
+        self._task: t.Optional[asyncio.Task[None]] = None
+
+    def _stat(self) -> t.Optional[t.Tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def start(self) -> None:
+        if self._task is not None and not self._task.done():
+            return
+        self._last_stat = self._stat()
+        self._task = asyncio.get_running_loop().create_task(
+            self._run(), name=f"FILE_WATCHER {self.path}"
+        )
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval_seconds)
+            stat = self._stat()
+            if stat == self._last_stat:
+                continue
+            self._last_stat = stat
+            LOGGER.info(f"{self.path} changed")
+            try:
+                await run_blocking(self._on_change)
+            except Exception:
+                LOGGER.exception(f"Failed to handle change to {self.path}")
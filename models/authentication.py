@@ -1,11 +1,17 @@
 import datetime
-from typing import Optional
+from enum import Enum
+from typing import List, Optional
 
 from pydantic import BaseModel
 
 from models.brokerage import BrokerageId
 
 
+class TokenStoreType(Enum):
+    KEYRING = "keyring"
+    ENCRYPTED_FILE = "encrypted-file"
+
+
 class AuthTokens(BaseModel):
     brokerage_id: BrokerageId
     access_token: str
@@ -26,6 +32,13 @@ class AuthStatus(BaseModel):
     signed_in: bool
 
 
+class AuthSessions(BaseModel):
+    """every signed in brokerage. market data and orders go through active"""
+
+    active: Optional[BrokerageId]
+    sessions: List[AuthStatus]
+
+
 class AuthSignIn(BaseModel):
     id: BrokerageId
     code: str
@@ -3,3 +3,4 @@ from enum import Enum
 
 class BrokerageId(Enum):
     TD = "td-a"
+    PAPER = "paper"
@@ -0,0 +1,12 @@
+from enum import Enum
+
+
+class EventType(Enum):
+    """server sent events. auth events carry an AuthStatus and settings events
+    the full UserSettings"""
+
+    AUTH = "auth"
+    SIGN_IN = "sign_in"
+    SIGN_OUT = "sign_out"
+    TOKEN_REFRESH = "token_refresh"
+    SETTINGS = "settings"
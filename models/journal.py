@@ -0,0 +1,37 @@
+import datetime
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+
+
+class SymbolSummary(BaseModel):
+    symbol: str
+    fills: int
+    volume: float
+    net_quantity: float
+    commission: float
+    # money in less money out, net of commissions
+    cash_flow: float
+    last_price: float
+    # cash flow with the net quantity marked at the last fill price
+    pnl: float
+
+
+class LatencySummary(BaseModel):
+    """seconds from queueing an order to its fill. None without orders"""
+
+    orders: int
+    failed: int
+    mean: Optional[float]
+    p50: Optional[float]
+    p99: Optional[float]
+    max: Optional[float]
+
+
+class JournalSummary(BaseModel):
+    start: Optional[datetime.datetime]
+    end: Optional[datetime.datetime]
+    # event counts by kind
+    events: Dict[str, int]
+    symbols: List[SymbolSummary]
+    order_latency: LatencySummary
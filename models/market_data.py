@@ -0,0 +1,13 @@
+import datetime
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class Quote(BaseModel):
+    symbol: str
+    last_price: float
+    bid_price: Optional[float]
+    ask_price: Optional[float]
+    volume: int = 0
+    quote_time: datetime.datetime
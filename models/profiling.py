@@ -0,0 +1,13 @@
+import datetime
+
+from pydantic import BaseModel
+
+
+class ProfileInfo(BaseModel):
+    id: str
+    created: datetime.datetime
+    method: str
+    path: str
+    status: str
+    duration_ms: float
+    samples: int
@@ -0,0 +1,74 @@
+import datetime
+from enum import Enum
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+class OrderSide(Enum):
+    BUY = "buy"
+    SELL = "sell"
+
+
+class Order(BaseModel):
+    symbol: str
+    side: OrderSide
+    quantity: float
+    is_exit: bool = False
+    # brokerages fill an order at most once per client order ID
+    client_order_id: Optional[str] = None
+
+
+class Fill(BaseModel):
+    symbol: str
+    side: OrderSide
+    quantity: float
+    price: float
+    fill_time: datetime.datetime
+    commission: float = 0
+    # the brokerage's ID for the execution, unique per brokerage
+    fill_id: Optional[str] = None
+
+
+class Trade(BaseModel):
+    """a position from entry until it was closed"""
+
+    symbol: str
+    quantity: float
+    entry_time: datetime.datetime
+    entry_price: float
+    exit_time: datetime.datetime
+    exit_price: float
+    pnl: float
+
+
+class SymbolBacktest(BaseModel):
+    symbol: str
+    bars: int
+    trades: List[Trade]
+    pnl: float
+    max_drawdown: float
+    # placed on the last bar, with no next bar to fill them
+    unfilled_orders: List[Order] = []
+
+
+class BacktestReport(BaseModel):
+    symbols: List[SymbolBacktest]
+
+    @property
+    def trades(self) -> List[Trade]:
+        return [trade for result in self.symbols for trade in result.trades]
+
+    @property
+    def pnl(self) -> float:
+        return sum(result.pnl for result in self.symbols)
+
+    @property
+    def win_rate(self) -> float:
+        trades = self.trades
+        return sum(trade.pnl > 0 for trade in trades) / len(trades) if trades else 0
+
+    @property
+    def average_trade_pnl(self) -> float:
+        trades = self.trades
+        return sum(trade.pnl for trade in trades) / len(trades) if trades else 0
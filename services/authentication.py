@@ -1,173 +1,398 @@
+import asyncio
+import contextlib
 import datetime
+import heapq
+import itertools
 import logging
-import multiprocessing
+import threading
+import types
 import typing as t
+from pathlib import Path
 
-import keyring
-
-from common.config import APP_NAME, GlobalConfig
-from common.utils import safe_sleep
-from models.authentication import AuthTokens
+from common.config import APP_NAME, GlobalConfig, config_snapshot
+from common.metrics import Counter, Gauge, Histogram
+from common.utils import (
+    FileWatcher,
+    LeaderLock,
+    VersionStamp,
+    get_clock,
+    run_blocking,
+    wait_for_event,
+)
+from models.authentication import AuthStatus, AuthTokens
 from models.brokerage import BrokerageId
-from services.brokerage import get_brokerage_service
+from models.events import EventType
+from services.brokerage import get_async_brokerage_service, get_brokerage_service
+from services.events import event_broker
+from services.token_store import BaseTokenStore, get_token_store
 
 LOGGER = logging.getLogger(f"{APP_NAME}.auth_service")
 
-signin_lock = multiprocessing.RLock()
-daemon_lock = multiprocessing.Lock()
-daemon_proc = None
+signin_lock = threading.RLock()
+
+TOKEN_REFRESH_LAG_SECONDS = Histogram(
+    "mark_trader_token_refresh_lag_seconds",
+    "How late the token refresh scheduler woke up for a scheduled refresh",
+)
+TOKEN_REFRESHES = Counter(
+    "mark_trader_token_refreshes_total",
+    "Token refreshes by brokerage and result",
+    ["brokerage", "result"],
+)
+
+
+def auth_status(auth_tokens: t.Optional[AuthTokens]) -> AuthStatus:
+    if not auth_tokens:
+        return AuthStatus(signed_in=False)
+    brokerage = config_snapshot().brokerage_map[auth_tokens.brokerage_id]
+    return AuthStatus(id=brokerage.id, name=brokerage.name, signed_in=True)
+
+
+class _TokenSnapshot(t.NamedTuple):
+    version: str
+    sessions: t.Mapping[BrokerageId, AuthTokens]
 
 
 class AuthenticationService:
-    _ACTIVE_BROKERAGE_KEY = "ACTIVE_BROKERAGE"
-    _ACCESS_TOKEN_KEY = "ACCESS_TOKEN"
-    _REFRESH_TOKEN_KEY = "REFRESH_TOKEN"
-    _ACCESS_EXPIRY_KEY = "ACCESS_EXPIRY"
-    _REFRESH_EXPIRY_KEY = "REFRESH_EXPIRY"
-
-    _ALL_KEYS = [
-        _ACTIVE_BROKERAGE_KEY,
-        _ACCESS_TOKEN_KEY,
-        _ACCESS_EXPIRY_KEY,
-        _REFRESH_TOKEN_KEY,
-        _REFRESH_EXPIRY_KEY,
-    ]
+    """Sessions with any number of brokerages, one set of tokens each. The
+    active brokerage, which market data and orders go through, is the first
+    signed in brokerage in BrokerageId order."""
+
+    # sessions cached per version stamp file, valid while the stamp is unchanged.
+    # every process that writes tokens bumps the stamp, so hot reads skip the token store
+    _snapshots: t.Dict[Path, _TokenSnapshot] = {}
+    # the newest version per stamp file whose change this process has handled,
+    # by writing it itself or through the token watcher
+    _handled_versions: t.Dict[Path, str] = {}
 
     def __init__(self, system: str = "MARK_TRADER") -> None:
         self._SYSTEM = system
 
+    @property
+    def _version_stamp(self) -> VersionStamp:
+        return VersionStamp(GlobalConfig().data_dir / f"{self._SYSTEM}.tokens.version")
+
+    @property
+    def _token_store(self) -> BaseTokenStore:
+        return get_token_store(self._SYSTEM)
+
     @property
     def active_brokerage(self) -> t.Optional[BrokerageId]:
-        with signin_lock:
-            brokerage_id = keyring.get_password(
-                self._SYSTEM, self._ACTIVE_BROKERAGE_KEY
-            )
-            return BrokerageId(brokerage_id) if brokerage_id is not None else None
+        tokens = self.active_tokens
+        return tokens.brokerage_id if tokens else None
 
     @property
     def active_tokens(self) -> t.Optional[AuthTokens]:
+        return next(iter(self.sessions.values()), None)
+
+    @property
+    def sessions(self) -> t.Mapping[BrokerageId, AuthTokens]:
+        """tokens for every signed in brokerage, in BrokerageId order"""
+        version_stamp = self._version_stamp
+        snapshot = self._snapshots.get(version_stamp.path)
+        if snapshot is not None and snapshot.version == version_stamp.read():
+            return snapshot.sessions
+
         with signin_lock:
-            if self.active_brokerage:
-                return AuthTokens(
-                    brokerage_id=self.active_brokerage,
-                    access_token=keyring.get_password(
-                        self._SYSTEM, self._ACCESS_TOKEN_KEY
-                    ),
-                    access_expiry=datetime.datetime.fromtimestamp(
-                        float(
-                            keyring.get_password(self._SYSTEM, self._ACCESS_EXPIRY_KEY)
-                        )
-                    ),
-                    refresh_token=keyring.get_password(
-                        self._SYSTEM, self._REFRESH_TOKEN_KEY
-                    ),
-                    refresh_expiry=datetime.datetime.fromtimestamp(
-                        float(
-                            keyring.get_password(self._SYSTEM, self._REFRESH_EXPIRY_KEY)
-                        )
-                    ),
-                )
-            return None
+            # read the version before the store so a concurrent write forces a reload
+            version = version_stamp.read()
+            sessions = self._read_sessions()
+            self._snapshots[version_stamp.path] = _TokenSnapshot(version, sessions)
+            return sessions
+
+    def _read_sessions(self) -> t.Mapping[BrokerageId, AuthTokens]:
+        token_store = self._token_store
+        sessions = {}
+        for brokerage_id in BrokerageId:
+            tokens = token_store.get(brokerage_id)
+            if tokens is not None:
+                sessions[brokerage_id] = tokens
+        return types.MappingProxyType(sessions)
+
+    def _invalidate(self) -> None:
+        version_stamp = self._version_stamp
+        self._snapshots.pop(version_stamp.path, None)
+        previous = version_stamp.read()
+        version = version_stamp.bump()
+        with signin_lock:
+            handled = self._handled_versions.setdefault(version_stamp.path, previous)
+            # a change from another worker not handled yet still is by the watcher
+            if handled == previous:
+                self._handled_versions[version_stamp.path] = version
+        token_refresh_scheduler.reschedule()
+
+    def _handle_version(self) -> bool:
+        """mark the current version handled, returning False if it already was"""
+        version_stamp = self._version_stamp
+        version = version_stamp.read()
+        with signin_lock:
+            if self._handled_versions.get(version_stamp.path) == version:
+                return False
+            self._handled_versions[version_stamp.path] = version
+            return True
 
     def sign_in(self, brokerage_id: BrokerageId, access_code: str) -> None:
+        """start a session with brokerage_id, replacing any it already had.
+        sessions with other brokerages are kept"""
         LOGGER.info(
             f"Brokerage {brokerage_id}: retrieve access and refresh tokens",
             extra={"brokerage_id": brokerage_id},
         )
 
-        self.sign_out()
-
         brokerage = get_brokerage_service(brokerage_id)
         access_tokens = brokerage.get_access_tokens(access_code)
         self.set_access_keys(access_tokens)
-        start_daemon()
+        # the new session is only active if no earlier brokerage is signed in
+        event_broker.publish(EventType.SIGN_IN, auth_status(self.active_tokens))
+
+    async def get_active_tokens_async(self) -> t.Optional[AuthTokens]:
+        return await run_blocking(lambda: self.active_tokens)
+
+    async def get_sessions_async(self) -> t.Mapping[BrokerageId, AuthTokens]:
+        return await run_blocking(lambda: self.sessions)
+
+    async def sign_in_async(self, brokerage_id: BrokerageId, access_code: str) -> None:
+        LOGGER.info(
+            f"Brokerage {brokerage_id}: retrieve access and refresh tokens",
+            extra={"brokerage_id": brokerage_id},
+        )
+
+        brokerage = get_async_brokerage_service(brokerage_id)
+        access_tokens = await brokerage.get_access_tokens(access_code)
+        await run_blocking(self.set_access_keys, access_tokens)
+        active_tokens = await self.get_active_tokens_async()
+        event_broker.publish(EventType.SIGN_IN, auth_status(active_tokens))
+
+    async def sign_out_async(
+        self, brokerage_id: t.Optional[BrokerageId] = None
+    ) -> None:
+        await run_blocking(self.sign_out, brokerage_id)
 
     def set_access_keys(self, access_tokens: AuthTokens) -> None:
         with signin_lock:
-            keyring.set_password(
-                self._SYSTEM,
-                self._ACTIVE_BROKERAGE_KEY,
-                t.cast(str, access_tokens.brokerage_id.value),
-            )
-            keyring.set_password(
-                self._SYSTEM, self._ACCESS_TOKEN_KEY, access_tokens.access_token
-            )
-            keyring.set_password(
-                self._SYSTEM,
-                self._ACCESS_EXPIRY_KEY,
-                str(access_tokens.access_expiry.timestamp()),
-            )
-            keyring.set_password(
-                self._SYSTEM, self._REFRESH_TOKEN_KEY, access_tokens.refresh_token
-            )
-            keyring.set_password(
-                self._SYSTEM,
-                self._REFRESH_EXPIRY_KEY,
-                str(access_tokens.refresh_expiry.timestamp()),
-            )
+            self._token_store.set(access_tokens)
+            self._invalidate()
 
         LOGGER.info(
-            f"Brokerage {access_tokens.brokerage_id}: authentication information saved to keyring",
+            f"Brokerage {access_tokens.brokerage_id}: authentication information saved to token store",
             extra={"brokerage_id": access_tokens.brokerage_id},
         )
 
-    def sign_out(self) -> None:
-        brokerage_id = keyring.get_password(self._SYSTEM, self._ACTIVE_BROKERAGE_KEY)
-        if brokerage_id is None:
-            LOGGER.warning("No active brokeage. signout is a no-op")
-        else:
-            LOGGER.info(f"Signing out of brokerage {brokerage_id}")
-            with signin_lock:
-                for key in self._ALL_KEYS:
-                    LOGGER.debug(f"Removing {key} from keyring")
-                    keyring.delete_password(self._SYSTEM, key)
-        start_daemon()
-
-
-# The token daemon is responsible for keeping the active brokerage signed in
-def refresh_access(auth_service: AuthenticationService) -> None:
-    auth_tokens = auth_service.active_tokens
-    if not auth_tokens:
-        LOGGER.info("No active brokerage")
-        safe_sleep(GlobalConfig().authentication.login_check_delay_seconds)
-    else:
-        now = datetime.datetime.now()
-        access_remaining = auth_tokens.access_expiry - now
-        refresh_remaining = auth_tokens.refresh_expiry - now
-
-        update_refresh_token = refresh_remaining <= access_remaining
-
-        to_wait = max(
-            0,
-            int(min(access_remaining, refresh_remaining).total_seconds())
-            - GlobalConfig().authentication.refresh_buffer_seconds,
-        )
+    def sign_out(self, brokerage_id: t.Optional[BrokerageId] = None) -> None:
+        """end the session with brokerage_id, or with every brokerage if None"""
+        with signin_lock:
+            sessions = self.sessions
+            brokerage_ids = list(sessions) if brokerage_id is None else [brokerage_id]
+            brokerage_ids = [b for b in brokerage_ids if b in sessions]
+            if not brokerage_ids:
+                LOGGER.warning("No active brokeage. signout is a no-op")
+                return
+            for signed_in in brokerage_ids:
+                LOGGER.info(f"Signing out of brokerage {signed_in}")
+                self._token_store.delete(signed_in)
+            self._invalidate()
+            event_broker.publish(EventType.SIGN_OUT, auth_status(self.active_tokens))
+
+
+def refresh_schedule(auth_tokens: AuthTokens) -> t.Tuple[int, bool]:
+    """seconds until the tokens should be refreshed, and whether the refresh token is due"""
+    now = get_clock().now()
+    access_remaining = auth_tokens.access_expiry - now
+    refresh_remaining = auth_tokens.refresh_expiry - now
+
+    update_refresh_token = refresh_remaining <= access_remaining
+
+    to_wait = max(
+        0,
+        int(min(access_remaining, refresh_remaining).total_seconds())
+        - GlobalConfig().authentication.refresh_buffer_seconds,
+    )
+    return to_wait, update_refresh_token
+
+
+async def refresh_access(
+    auth_service: AuthenticationService,
+    auth_tokens: AuthTokens,
+    update_refresh_token: bool,
+) -> AuthTokens:
+    brokerage_service = get_async_brokerage_service(auth_tokens.brokerage_id)
+    new_auth_tokens = await brokerage_service.refresh_tokens(
+        auth_tokens, update_refresh_token=update_refresh_token
+    )
+    await run_blocking(auth_service.set_access_keys, new_auth_tokens)
+    event_broker.publish(EventType.TOKEN_REFRESH, auth_status(new_auth_tokens))
+    return new_auth_tokens
+
+
+class _ScheduledRefresh(t.NamedTuple):
+    due: float
+    # breaks ties between sessions due at once, so tokens are never compared
+    seq: int
+    tokens: AuthTokens
+    update_refresh_token: bool
+
+
+# The token refresh scheduler is responsible for keeping every brokerage signed in.
+# It runs as a task on the app's event loop and is woken whenever the tokens change.
+# Each session's next refresh sits in a min-heap, so however many brokerages are
+# signed in the scheduler waits on one timer, for the refresh due first.
+# With several worker processes only the one holding the leader lock refreshes,
+# so workers never race to spend the same refresh token. The others wait to
+# take over and read the tokens the leader writes from the shared token store.
+class TokenRefreshScheduler:
+    def __init__(self, system: str = "MARK_TRADER") -> None:
+        self._system = system
+        self._auth_service = AuthenticationService(system)
+        self._leader: t.Optional[LeaderLock] = None
+        self._loop: t.Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: t.Optional[asyncio.Event] = None
+        self._task: t.Optional[asyncio.Task[None]] = None
+        self._heap: t.List[_ScheduledRefresh] = []
+        # the current refresh of each session. heap entries that aren't are stale
+        self._scheduled: t.Dict[BrokerageId, _ScheduledRefresh] = {}
+        self._seq = itertools.count()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def leader(self) -> bool:
+        """whether this process is the one refreshing tokens"""
+        return self._leader is not None and self._leader.held
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = self._loop.create_task(self._run(), name="TOKEN_REFRESH_SCHEDULER")
+
+    async def stop(self) -> None:
+        task, self._task, self._loop = self._task, None, None
+        if task is not None:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._heap.clear()
+        self._scheduled.clear()
 
-        LOGGER.info(f"Refresh tokens in {to_wait} seconds")
-        LOGGER.info(f"Update refresh token? {update_refresh_token}")
+    def reschedule(self) -> None:
+        """wake the scheduler so it re-reads the tokens. safe to call from any thread"""
+        loop, wakeup = self._loop, self._wakeup
+        if loop is not None and wakeup is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(wakeup.set)
 
-        safe_sleep(to_wait)
-        brokerage_service = get_brokerage_service(auth_tokens.brokerage_id)
-        new_auth_tokens = brokerage_service.refresh_tokens(
-            auth_tokens, update_refresh_token=update_refresh_token
+    async def _wait(self, seconds: float) -> bool:
+        """wait up to seconds, returning True if woken early by reschedule"""
+        assert self._wakeup is not None
+        return await wait_for_event(self._wakeup, seconds)
+
+    async def _run(self) -> None:
+        leader = LeaderLock(GlobalConfig().data_dir / f"{self._system}.leader.lock")
+        self._leader = leader
+        try:
+            # try_acquire never waits on the lock, so it runs on the loop. off the
+            # loop, a cancelled stop() could race an acquire and leak the lock
+            while not leader.try_acquire():
+                await get_clock().sleep(
+                    GlobalConfig().authentication.leader_poll_seconds
+                )
+            LOGGER.info("Leading token refresh")
+            await self._refresh_tokens()
+        finally:
+            leader.release()
+
+    def _schedule(self, tokens: AuthTokens, delay: t.Optional[float] = None) -> None:
+        to_wait, update_refresh_token = refresh_schedule(tokens)
+        if delay is None:
+            LOGGER.info(
+                f"Brokerage {tokens.brokerage_id}: refresh tokens in {to_wait} seconds, "
+                f"update refresh token? {update_refresh_token}",
+                extra={"brokerage_id": tokens.brokerage_id},
+            )
+            delay = to_wait
+        refresh = _ScheduledRefresh(
+            get_clock().time() + delay, next(self._seq), tokens, update_refresh_token
         )
-        auth_service.set_access_keys(new_auth_tokens)
+        self._scheduled[tokens.brokerage_id] = refresh
+        heapq.heappush(self._heap, refresh)
+
+    def _sync(self, sessions: t.Mapping[BrokerageId, AuthTokens]) -> None:
+        """schedule sessions whose tokens changed and forget signed out ones"""
+        for brokerage_id in self._scheduled.keys() - sessions.keys():
+            del self._scheduled[brokerage_id]
+        for brokerage_id, tokens in sessions.items():
+            scheduled = self._scheduled.get(brokerage_id)
+            if scheduled is None or scheduled.tokens != tokens:
+                self._schedule(tokens)
+        while self._heap and (
+            self._scheduled.get(self._heap[0].tokens.brokerage_id) is not self._heap[0]
+        ):
+            heapq.heappop(self._heap)
 
+    async def _refresh_tokens(self) -> None:
+        assert self._wakeup is not None
+        while True:
+            self._wakeup.clear()
+            self._sync(await self._auth_service.get_sessions_async())
+            if not self._heap:
+                LOGGER.info("No active brokerage")
+                await self._wait(
+                    GlobalConfig().authentication.login_check_delay_seconds
+                )
+                continue
+
+            refresh = self._heap[0]
+            if await self._wait(max(refresh.due - get_clock().time(), 0)):
+                continue
+            heapq.heappop(self._heap)
+            TOKEN_REFRESH_LAG_SECONDS.observe(max(get_clock().time() - refresh.due, 0))
 
-def _daemon_loop() -> None:
+            brokerage_id = refresh.tokens.brokerage_id
+            try:
+                new_tokens = await refresh_access(
+                    self._auth_service, refresh.tokens, refresh.update_refresh_token
+                )
+                TOKEN_REFRESHES.labels(brokerage_id, "success").inc()
+                self._schedule(new_tokens)
+            except Exception:
+                TOKEN_REFRESHES.labels(brokerage_id, "failure").inc()
+                LOGGER.exception(
+                    f"Brokerage {brokerage_id}: token refresh failed",
+                    extra={"brokerage_id": brokerage_id},
+                )
+                # retry later with the same tokens, other sessions carry on meanwhile
+                self._schedule(
+                    refresh.tokens,
+                    GlobalConfig().authentication.login_check_delay_seconds,
+                )
+
+
+token_refresh_scheduler = TokenRefreshScheduler()
+
+
+def _on_tokens_changed() -> None:
     auth_service = AuthenticationService()
-    while True:
-        refresh_access(auth_service)
-
-
-def start_daemon() -> None:
-    global daemon_proc
-    with daemon_lock:
-        if daemon_proc is not None:
-            daemon_proc.terminate()
-        daemon_proc = multiprocessing.Process(
-            target=_daemon_loop,
-            daemon=True,
-            name="ACCESS_TOKEN_DAEMON",
-        )
-        daemon_proc.start()
+    # this worker's own writes already rescheduled and published their event
+    if not auth_service._handle_version():
+        return
+    token_refresh_scheduler.reschedule()
+    event_broker.publish(EventType.AUTH, auth_status(auth_service.active_tokens))
+
+
+def token_watcher() -> FileWatcher:
+    """a watcher for token changes made by other workers. it wakes the refresh
+    scheduler and tells this worker's event subscribers"""
+    return FileWatcher(
+        AuthenticationService()._version_stamp.path,
+        _on_tokens_changed,
+        GlobalConfig().authentication.token_watch_interval_seconds,
+    )
+
+
+TOKEN_REFRESH_LEADER = Gauge(
+    "mark_trader_token_refresh_leader",
+    "1 if this worker refreshes tokens for every worker, else 0",
+    function=lambda: int(token_refresh_scheduler.leader),
+)
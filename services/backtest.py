@@ -0,0 +1,197 @@
+"""Replay historical bars through a strategy.
+
+Run with ``python -m services.backtest data/AMZN.csv data/IBM.csv``. Each CSV
+has a header row and time, open, high, low, close, volume columns, with time
+in ISO 8601 or epoch seconds. The symbol is taken from the file name.
+"""
+import argparse
+import datetime
+import functools
+import logging
+import os
+import typing as t
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from common.config import APP_NAME, UserSettings
+from models.trading import BacktestReport, Fill, Order, SymbolBacktest
+from services.indicators import FloatArray
+from services.strategy import (
+    MarketSnapshot,
+    MovingAverageCrossover,
+    Strategy,
+    TradingSession,
+)
+
+LOGGER = logging.getLogger(f"{APP_NAME}.backtest")
+
+
+class Bars(t.NamedTuple):
+    """OHLCV bars for one symbol, oldest first. times are epoch seconds"""
+
+    times: FloatArray
+    open: FloatArray
+    high: FloatArray
+    low: FloatArray
+    close: FloatArray
+    volume: FloatArray
+
+
+class BacktestSettings(t.NamedTuple):
+    position_size: float
+    end_of_day_exit: bool = False
+    commission: float = 0
+
+
+BarSource = t.Union[Path, Bars]
+StrategyFactory = t.Callable[[], Strategy]
+
+
+def load_bars(path: Path) -> Bars:
+    data = np.genfromtxt(path, delimiter=",", names=True, dtype=None, encoding="utf-8")
+    data = np.atleast_1d(data)
+    times = data["time"]
+    if times.dtype.kind in "US":
+        times = times.astype("datetime64[s]").astype(np.int64)
+    return Bars(
+        times=times.astype(np.float64),
+        **{
+            column: data[column].astype(np.float64)
+            for column in ("open", "high", "low", "close", "volume")
+        },
+    )
+
+
+def end_of_day(times: FloatArray) -> t.Any:
+    """True for the last bar of each UTC day"""
+    days = times.astype("datetime64[s]").astype("datetime64[D]")
+    return np.append(days[1:] != days[:-1], True)
+
+
+def backtest_symbol(
+    symbol: str,
+    source: BarSource,
+    strategy_factory: StrategyFactory,
+    settings: BacktestSettings,
+) -> SymbolBacktest:
+    """Run one symbol through a fresh strategy and session.
+
+    Orders placed on a bar fill at the next bar's open. End of day exits fill
+    at the close of the day's last bar. Orders placed on the last bar are
+    reported as unfilled, and anything still open after it is closed at its
+    close, so every position ends up in the trades and P&L.
+    """
+    bars = load_bars(source) if isinstance(source, Path) else source
+    session = TradingSession(
+        strategy_factory(), settings.position_size, settings.end_of_day_exit
+    )
+    session.strategy.set_symbols([symbol])
+    symbols = [symbol]
+    last_bar_of_day = end_of_day(bars.times)
+    equity = np.zeros(len(bars.times))
+    pending: t.List[Order] = []
+
+    def fill(orders: t.List[Order], price: float, time: datetime.datetime) -> None:
+        for order in orders:
+            session.apply_fill(
+                Fill(
+                    symbol=order.symbol,
+                    side=order.side,
+                    quantity=order.quantity,
+                    price=price,
+                    fill_time=time,
+                    commission=settings.commission,
+                )
+            )
+
+    for i in range(len(bars.times)):
+        time = datetime.datetime.fromtimestamp(bars.times[i], datetime.timezone.utc)
+        fill(pending, bars.open[i], time)
+        snapshot = MarketSnapshot(
+            time, symbols, bars.close[i : i + 1], bars.volume[i : i + 1]
+        )
+        orders = session.step(snapshot, bool(last_bar_of_day[i]))
+        if last_bar_of_day[i] and settings.end_of_day_exit:
+            fill(orders, bars.close[i], time)
+            orders = []
+        pending = orders
+        equity[i] = session.realized_pnl + session.unrealized_pnl(
+            {symbol: bars.close[i]}
+        )
+
+    if pending:
+        LOGGER.info(f"{symbol}: {len(pending)} orders from the last bar not filled")
+    if len(bars.times):
+        fill(session.exit_orders(), bars.close[-1], time)
+        equity[-1] = session.realized_pnl
+
+    drawdown = np.maximum.accumulate(np.append(0, equity)) - np.append(0, equity)
+    return SymbolBacktest(
+        symbol=symbol,
+        bars=len(bars.times),
+        trades=session.trades,
+        pnl=session.realized_pnl,
+        max_drawdown=float(drawdown.max()),
+        unfilled_orders=pending,
+    )
+
+
+def run_backtest(
+    sources: t.Mapping[str, BarSource],
+    strategy_factory: StrategyFactory,
+    settings: BacktestSettings,
+    processes: t.Optional[int] = None,
+) -> BacktestReport:
+    """Backtest every symbol independently, in parallel worker processes.
+
+    strategy_factory and the sources are sent to the workers, so they must be
+    picklable: a class or functools.partial, and paths rather than bars for
+    large data sets. processes=1 runs everything in this process.
+    """
+    processes = processes or min(len(sources), os.cpu_count() or 1)
+    run = functools.partial(
+        backtest_symbol, strategy_factory=strategy_factory, settings=settings
+    )
+    if processes <= 1:
+        results = [run(symbol, source) for symbol, source in sources.items()]
+    else:
+        with ProcessPoolExecutor(processes) as executor:
+            results = list(executor.map(run, sources.keys(), sources.values()))
+    return BacktestReport(symbols=results)
+
+
+def main() -> None:
+    defaults = UserSettings.__fields__
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("files", type=Path, nargs="+")
+    parser.add_argument(
+        "--position-size", type=float, default=defaults["position_size"].default
+    )
+    parser.add_argument("--end-of-day-exit", action="store_true")
+    parser.add_argument("--commission", type=float, default=0)
+    parser.add_argument("--fast", type=int, default=10)
+    parser.add_argument("--slow", type=int, default=30)
+    parser.add_argument("--processes", type=int)
+    args = parser.parse_args()
+
+    report = run_backtest(
+        {path.stem.upper(): path for path in args.files},
+        functools.partial(MovingAverageCrossover, args.fast, args.slow),
+        BacktestSettings(args.position_size, args.end_of_day_exit, args.commission),
+        args.processes,
+    )
+    for result in report.symbols:
+        print(
+            f"{result.symbol:<8} bars {result.bars:>9}  trades {len(result.trades):>6}  "
+            f"pnl {result.pnl:12.2f}  max drawdown {result.max_drawdown:10.2f}"
+        )
+    print(
+        f"total pnl {report.pnl:.2f}, {len(report.trades)} trades, "
+        f"win rate {report.win_rate:.1%}, average trade {report.average_trade_pnl:.2f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
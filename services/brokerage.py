@@ -1,21 +1,55 @@
 import abc
+import asyncio
 import datetime
+import importlib.util
+import itertools
 import logging
+import threading
+import time
 import typing as t
 from abc import ABC
-from urllib.parse import quote_plus
 
-import requests
+import httpx
 
-from common.config import APP_NAME, GlobalConfig
+from common.config import APP_NAME, RetryConfig, config_snapshot
+from common.metrics import Histogram
+from common.utils import get_clock
 from models.authentication import AuthTokens
 from models.brokerage import BrokerageId
+from models.market_data import Quote
+from models.trading import Fill, Order
+from services.resilience import (
+    BROKERAGE_RETRIES,
+    CircuitBreaker,
+    backoff_delay,
+    can_retry,
+    circuit_breaker,
+    retry_after_seconds,
+    retryable_error,
+    retryable_status,
+)
 
 LOGGER = logging.getLogger(f"{APP_NAME}.brokerage_service")
 
+# httpx only negotiates HTTP/2 when the optional h2 package is installed
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
 
-class BaseBrokerageService(ABC):
+BROKERAGE_REQUEST_SECONDS = Histogram(
+    "mark_trader_brokerage_request_seconds",
+    "Brokerage HTTP requests by endpoint and status, error if no response arrived",
+    ["brokerage", "endpoint", "status"],
+)
+
+
+class OrdersNotSupportedError(NotImplementedError):
+    pass
+
+
+class _BrokerageServiceBase(ABC):
     brokerage_id: t.Optional[BrokerageId] = None
+    # whether place_order and get_fills are implemented. callers check this up
+    # front instead of failing on every call
+    SUPPORTS_ORDERS = False
 
     def __init__(self) -> None:
         self.validate()
@@ -24,6 +58,157 @@ class BaseBrokerageService(ABC):
         if self.brokerage_id is None:
             raise RuntimeError("brokerage_id must not be None")
 
+    def _http_client_options(self) -> t.Dict[str, t.Any]:
+        brokerage_id = t.cast(BrokerageId, self.brokerage_id)
+        http_config = config_snapshot().brokerage_map[brokerage_id].http
+        return {
+            "limits": httpx.Limits(
+                max_connections=http_config.max_connections,
+                max_keepalive_connections=http_config.max_keepalive_connections,
+                keepalive_expiry=http_config.keepalive_expiry_seconds,
+            ),
+            "timeout": httpx.Timeout(
+                http_config.timeout_seconds,
+                connect=http_config.connect_timeout_seconds,
+            ),
+            "http2": http_config.http2 and HTTP2_AVAILABLE,
+        }
+
+    def _resilience(self, endpoint: str) -> t.Tuple[CircuitBreaker, RetryConfig]:
+        brokerage_id = t.cast(BrokerageId, self.brokerage_id)
+        config = config_snapshot().brokerage_map[brokerage_id]
+        breaker = circuit_breaker(brokerage_id, endpoint, config.circuit_breaker)
+        return breaker, config.retry
+
+    def _log_retry(self, endpoint: str, attempt: int) -> None:
+        BROKERAGE_RETRIES.labels(self.brokerage_id, endpoint).inc()
+        LOGGER.warning(
+            f"Brokerage {self.brokerage_id}: {endpoint} attempt {attempt + 1} failed, retrying",
+            extra={"brokerage_id": self.brokerage_id},
+        )
+
+    # _request sends through the endpoint's circuit breaker, retrying failures with
+    # backoff. calls that aren't idempotent are only retried if never sent. the
+    # sync and async services only differ in how they send and sleep, so both
+    # hand every outcome to these
+
+    def _retry_after_error(
+        self,
+        endpoint: str,
+        breaker: CircuitBreaker,
+        retry: RetryConfig,
+        attempt: int,
+        error: BaseException,
+        idempotent: bool,
+    ) -> float:
+        """record a send that raised, returning the delay before retrying it.
+        raises error if it isn't retried"""
+        if not isinstance(error, httpx.TransportError):
+            breaker.abandon()
+            raise error
+        breaker.record_failure()
+        if not (
+            retryable_error(error, idempotent) and can_retry(retry, attempt, breaker)
+        ):
+            raise error
+        self._log_retry(endpoint, attempt)
+        return backoff_delay(retry, attempt)
+
+    def _retry_after_response(
+        self,
+        endpoint: str,
+        breaker: CircuitBreaker,
+        retry: RetryConfig,
+        attempt: int,
+        response: httpx.Response,
+        idempotent: bool,
+    ) -> t.Optional[float]:
+        """record a response, returning the delay before retrying the request,
+        or None if the response should be returned"""
+        if not retryable_status(response.status_code):
+            breaker.record_success()
+            return None
+        breaker.record_failure()
+        if not (idempotent and can_retry(retry, attempt, breaker)):
+            return None
+        self._log_retry(endpoint, attempt)
+        return backoff_delay(retry, attempt, retry_after_seconds(response))
+
+    @property
+    @abc.abstractmethod
+    def auth_uri(self) -> str:
+        raise NotImplemented
+
+
+def _single_quote(quotes: t.Dict[str, Quote], symbol: str) -> Quote:
+    if symbol not in quotes:
+        raise RuntimeError(f"no quote returned for {symbol}")
+    return quotes[symbol]
+
+
+class BaseBrokerageService(_BrokerageServiceBase):
+    def __init__(self) -> None:
+        super().__init__()
+        self._client: t.Optional[httpx.Client] = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self) -> httpx.Client:
+        """a long lived, pooled HTTP client so connections are reused between calls"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = httpx.Client(**self._http_client_options())
+        return self._client
+
+    def close(self) -> None:
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def _send(
+        self, endpoint: str, method: str, url: str, **kwargs: t.Any
+    ) -> httpx.Response:
+        """call the pooled client's method, get or post, timed per endpoint"""
+        status = "error"
+        start = time.perf_counter()
+        try:
+            response: httpx.Response = getattr(self.client, method)(url, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            BROKERAGE_REQUEST_SECONDS.labels(
+                self.brokerage_id, endpoint, status
+            ).observe(time.perf_counter() - start)
+
+    def _request(
+        self,
+        endpoint: str,
+        method: str,
+        url: str,
+        idempotent: bool = True,
+        **kwargs: t.Any,
+    ) -> httpx.Response:
+        """_send behind the endpoint's circuit breaker, retrying failures"""
+        breaker, retry = self._resilience(endpoint)
+        for attempt in itertools.count():
+            breaker.before_call()
+            try:
+                response = self._send(endpoint, method, url, **kwargs)
+            except BaseException as e:
+                delay = self._retry_after_error(
+                    endpoint, breaker, retry, attempt, e, idempotent
+                )
+            else:
+                retry_delay = self._retry_after_response(
+                    endpoint, breaker, retry, attempt, response, idempotent
+                )
+                if retry_delay is None:
+                    return response
+                delay = retry_delay
+            get_clock().sleep_blocking(delay)
+        raise AssertionError("unreachable")
+
     @abc.abstractmethod
     def get_access_tokens(self, access_code: str) -> AuthTokens:
         raise NotImplemented
@@ -36,104 +221,400 @@ class BaseBrokerageService(ABC):
     ) -> AuthTokens:
         raise NotImplemented
 
+    @abc.abstractmethod
+    def get_quotes(
+        self, auth_tokens: AuthTokens, symbols: t.Sequence[str]
+    ) -> t.Dict[str, Quote]:
+        """quotes for all symbols in as few requests as the brokerage allows.
+        symbols the brokerage has no quote for are left out"""
+        raise NotImplemented
+
+    def get_quote(self, auth_tokens: AuthTokens, symbol: str) -> Quote:
+        return _single_quote(self.get_quotes(auth_tokens, [symbol]), symbol)
+
+    def place_order(self, auth_tokens: AuthTokens, order: Order) -> Fill:
+        """place a market order, returning its fill"""
+        raise OrdersNotSupportedError(f"{self.brokerage_id} does not support orders")
+
+    def get_fills(
+        self, auth_tokens: AuthTokens, since: t.Optional[datetime.datetime]
+    ) -> t.List[Fill]:
+        """the account's fills at or after since, or all of them if None, oldest first"""
+        raise OrdersNotSupportedError(f"{self.brokerage_id} does not support orders")
+
+
+class AsyncBaseBrokerageService(_BrokerageServiceBase):
+    """The same operations as BaseBrokerageService as coroutines for use on the event loop"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._client: t.Optional[httpx.AsyncClient] = None
+
     @property
+    def client(self) -> httpx.AsyncClient:
+        """a long lived, pooled HTTP client so connections are reused between calls"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(**self._http_client_options())
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _send(
+        self, endpoint: str, method: str, url: str, **kwargs: t.Any
+    ) -> httpx.Response:
+        """call the pooled client's method, get or post, timed per endpoint"""
+        status = "error"
+        start = time.perf_counter()
+        try:
+            response: httpx.Response = await getattr(self.client, method)(url, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            BROKERAGE_REQUEST_SECONDS.labels(
+                self.brokerage_id, endpoint, status
+            ).observe(time.perf_counter() - start)
+
+    async def _request(
+        self,
+        endpoint: str,
+        method: str,
+        url: str,
+        idempotent: bool = True,
+        **kwargs: t.Any,
+    ) -> httpx.Response:
+        """_send behind the endpoint's circuit breaker, retrying failures"""
+        breaker, retry = self._resilience(endpoint)
+        for attempt in itertools.count():
+            breaker.before_call()
+            try:
+                response = await self._send(endpoint, method, url, **kwargs)
+            except BaseException as e:
+                delay = self._retry_after_error(
+                    endpoint, breaker, retry, attempt, e, idempotent
+                )
+            else:
+                retry_delay = self._retry_after_response(
+                    endpoint, breaker, retry, attempt, response, idempotent
+                )
+                if retry_delay is None:
+                    return response
+                delay = retry_delay
+            await get_clock().sleep(delay)
+        raise AssertionError("unreachable")
+
     @abc.abstractmethod
-    def auth_uri(self) -> str:
+    async def get_access_tokens(self, access_code: str) -> AuthTokens:
         raise NotImplemented
 
+    @abc.abstractmethod
+    async def refresh_tokens(
+        self,
+        auth_tokens: AuthTokens,
+        update_refresh_token: bool = False,
+    ) -> AuthTokens:
+        raise NotImplemented
 
-class TDAmeritradeBrokerageService(BaseBrokerageService):
+    @abc.abstractmethod
+    async def get_quotes(
+        self, auth_tokens: AuthTokens, symbols: t.Sequence[str]
+    ) -> t.Dict[str, Quote]:
+        """quotes for all symbols in as few requests as the brokerage allows.
+        symbols the brokerage has no quote for are left out"""
+        raise NotImplemented
+
+    async def get_quote(self, auth_tokens: AuthTokens, symbol: str) -> Quote:
+        return _single_quote(await self.get_quotes(auth_tokens, [symbol]), symbol)
+
+    async def place_order(self, auth_tokens: AuthTokens, order: Order) -> Fill:
+        """place a market order, returning its fill"""
+        raise OrdersNotSupportedError(f"{self.brokerage_id} does not support orders")
+
+    async def get_fills(
+        self, auth_tokens: AuthTokens, since: t.Optional[datetime.datetime]
+    ) -> t.List[Fill]:
+        """the account's fills at or after since, or all of them if None, oldest first"""
+        raise OrdersNotSupportedError(f"{self.brokerage_id} does not support orders")
+
+
+class _TDAmeritradeMixin(_BrokerageServiceBase):
     brokerage_id = BrokerageId.TD
 
     OAUTH_URI_FORMATTER = "https://auth.tdameritrade.com/auth?response_type=code&redirect_uri={redirect_uri}&client_id={client_id}%40AMER.OAUTHAP"
+    TOKEN_URI = "https://api.tdameritrade.com/v1/oauth2/token"
+    TOKEN_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+    QUOTES_URI = "https://api.tdameritrade.com/v1/marketdata/quotes"
+    # keeps the comma separated symbol list well inside URL length limits
+    MAX_QUOTE_SYMBOLS = 200
 
-    def get_access_tokens(self, access_code: str) -> AuthTokens:
+    @property
+    def auth_uri(self) -> str:
+        return config_snapshot().auth_uri(self.brokerage_id, self.OAUTH_URI_FORMATTER)
+
+    def _access_tokens_body(self, access_code: str) -> t.Dict[str, str]:
         LOGGER.info(
             f"Brokerage {self.brokerage_id}: Get access tokens",
             extra={"brokerage_id": self.brokerage_id},
         )
 
-        brokerage = GlobalConfig().brokerage_map[self.brokerage_id]
+        snapshot = config_snapshot()
 
-        body = {
+        return {
             "grant_type": "authorization_code",
             "access_type": "offline",
             "code": access_code,
-            "client_id": brokerage.client_id,
-            "redirect_uri": GlobalConfig().server.redirect_uri,
+            "client_id": snapshot.brokerage_map[self.brokerage_id].client_id,
+            "redirect_uri": snapshot.config.server.redirect_uri,
         }
 
-        return self._make_access_token_request(body)
-
-    def refresh_tokens(
-        self,
-        auth_tokens: AuthTokens,
-        update_refresh_token: bool = False,
-    ) -> AuthTokens:
-        brokerage = GlobalConfig().brokerage_map[self.brokerage_id]
+    def _refresh_tokens_body(
+        self, auth_tokens: AuthTokens, update_refresh_token: bool
+    ) -> t.Dict[str, str]:
+        snapshot = config_snapshot()
         body = {
             "grant_type": "refresh_token",
-            "client_id": brokerage.client_id,
-            "redirect_uri": GlobalConfig().server.redirect_uri,
+            "client_id": snapshot.brokerage_map[self.brokerage_id].client_id,
+            "redirect_uri": snapshot.config.server.redirect_uri,
             "refresh_token": auth_tokens.refresh_token,
         }
         if update_refresh_token:
             body["access_type"] = "offline"
+        return body
 
-        return self._make_access_token_request(body, auth_tokens)
-
-    @property
-    def auth_uri(self) -> str:
-        brokerage = GlobalConfig().brokerage_map[self.brokerage_id]
-        return self.OAUTH_URI_FORMATTER.format(
-            redirect_uri=quote_plus(GlobalConfig().server.redirect_uri),
-            client_id=quote_plus(brokerage.client_id),
-        )
-
-    def _make_access_token_request(
-        self, body: t.Dict[str, str], old_tokens: t.Optional[AuthTokens] = None
+    def _parse_access_token_response(
+        self,
+        status_code: int,
+        content: bytes,
+        json: t.Callable[[], t.Any],
+        old_tokens: t.Optional[AuthTokens] = None,
     ) -> AuthTokens:
-        response = requests.post(
-            "https://api.tdameritrade.com/v1/oauth2/token",
-            data=body,
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-        )
-        if response.status_code != 200:
+        if status_code != 200:
             LOGGER.error(
-                f"unexpected response for post access token: ({response.status_code}) {str(response.content)}",
+                f"unexpected response for post access token: ({status_code}) {str(content)}",
                 extra={
-                    "status_code": response.status_code,
-                    "content": response.content,
+                    "status_code": status_code,
+                    "content": content,
                 },
             )
             raise RuntimeError("unexpected response for post access token")
 
-        response_body = response.json()
+        response_body = json()
         LOGGER.info(
             f"Brokerage {self.brokerage_id}: Login successful",
             extra={"brokerage_id": self.brokerage_id},
         )
+        now = get_clock().now()
         if old_tokens:
             default_refresh_token = old_tokens.refresh_token
             default_refresh_expiry = old_tokens.refresh_expiry
         else:
             default_refresh_token = None
-            default_refresh_expiry = datetime.datetime.now()
+            default_refresh_expiry = now
 
         return AuthTokens(
             brokerage_id=self.brokerage_id,
             access_token=response_body["access_token"],
-            access_expiry=datetime.datetime.now()
-            + datetime.timedelta(seconds=response_body["expires_in"]),
+            access_expiry=now + datetime.timedelta(seconds=response_body["expires_in"]),
             refresh_token=response_body.get("refresh_token", default_refresh_token),
-            refresh_expiry=datetime.datetime.now()
+            refresh_expiry=now
             + datetime.timedelta(seconds=response_body["refresh_token_expires_in"])
             if "refresh_token_expires_in" in response_body
             else default_refresh_expiry,
         )
 
+    def _quote_requests(self, symbols: t.Sequence[str]) -> t.Iterator[t.Dict[str, str]]:
+        """query params for each chunk of at most MAX_QUOTE_SYMBOLS unique symbols"""
+        unique = list(dict.fromkeys(symbols))
+        for i in range(0, len(unique), self.MAX_QUOTE_SYMBOLS):
+            yield {"symbol": ",".join(unique[i : i + self.MAX_QUOTE_SYMBOLS])}
 
-def get_brokerage_service(brokerage_id: BrokerageId) -> BaseBrokerageService:
+    @staticmethod
+    def _auth_headers(auth_tokens: AuthTokens) -> t.Dict[str, str]:
+        return {"Authorization": f"Bearer {auth_tokens.access_token}"}
+
+    def _parse_quotes_response(
+        self, status_code: int, content: bytes, json: t.Callable[[], t.Any]
+    ) -> t.Dict[str, Quote]:
+        if status_code != 200:
+            LOGGER.error(
+                f"unexpected response for get quotes: ({status_code}) {str(content)}",
+                extra={
+                    "status_code": status_code,
+                    "content": content,
+                },
+            )
+            raise RuntimeError("unexpected response for get quotes")
+
+        return {
+            symbol: Quote(
+                symbol=symbol,
+                last_price=quote["lastPrice"],
+                bid_price=quote.get("bidPrice"),
+                ask_price=quote.get("askPrice"),
+                volume=quote.get("totalVolume", 0),
+                quote_time=datetime.datetime.fromtimestamp(
+                    quote["quoteTimeInLong"] / 1000
+                ),
+            )
+            for symbol, quote in json().items()
+        }
+
+
+class TDAmeritradeBrokerageService(_TDAmeritradeMixin, BaseBrokerageService):
+    def get_access_tokens(self, access_code: str) -> AuthTokens:
+        return self._make_access_token_request(self._access_tokens_body(access_code))
+
+    def refresh_tokens(
+        self,
+        auth_tokens: AuthTokens,
+        update_refresh_token: bool = False,
+    ) -> AuthTokens:
+        return self._make_access_token_request(
+            self._refresh_tokens_body(auth_tokens, update_refresh_token), auth_tokens
+        )
+
+    def _make_access_token_request(
+        self, body: t.Dict[str, str], old_tokens: t.Optional[AuthTokens] = None
+    ) -> AuthTokens:
+        response = self._request(
+            "token",
+            "post",
+            self.TOKEN_URI,
+            # an access code works once, a refresh token until it expires
+            idempotent=old_tokens is not None,
+            data=body,
+            headers=self.TOKEN_HEADERS,
+        )
+        return self._parse_access_token_response(
+            response.status_code, response.content, response.json, old_tokens
+        )
+
+    def get_quotes(
+        self, auth_tokens: AuthTokens, symbols: t.Sequence[str]
+    ) -> t.Dict[str, Quote]:
+        quotes: t.Dict[str, Quote] = {}
+        for params in self._quote_requests(symbols):
+            response = self._request(
+                "quotes",
+                "get",
+                self.QUOTES_URI,
+                params=params,
+                headers=self._auth_headers(auth_tokens),
+            )
+            quotes.update(
+                self._parse_quotes_response(
+                    response.status_code, response.content, response.json
+                )
+            )
+        return quotes
+
+
+class AsyncTDAmeritradeBrokerageService(_TDAmeritradeMixin, AsyncBaseBrokerageService):
+    async def get_access_tokens(self, access_code: str) -> AuthTokens:
+        return await self._make_access_token_request(
+            self._access_tokens_body(access_code)
+        )
+
+    async def refresh_tokens(
+        self,
+        auth_tokens: AuthTokens,
+        update_refresh_token: bool = False,
+    ) -> AuthTokens:
+        return await self._make_access_token_request(
+            self._refresh_tokens_body(auth_tokens, update_refresh_token), auth_tokens
+        )
+
+    async def _make_access_token_request(
+        self, body: t.Dict[str, str], old_tokens: t.Optional[AuthTokens] = None
+    ) -> AuthTokens:
+        response = await self._request(
+            "token",
+            "post",
+            self.TOKEN_URI,
+            # an access code works once, a refresh token until it expires
+            idempotent=old_tokens is not None,
+            data=body,
+            headers=self.TOKEN_HEADERS,
+        )
+        return self._parse_access_token_response(
+            response.status_code, response.content, response.json, old_tokens
+        )
+
+    async def get_quotes(
+        self, auth_tokens: AuthTokens, symbols: t.Sequence[str]
+    ) -> t.Dict[str, Quote]:
+        headers = self._auth_headers(auth_tokens)
+        responses = await asyncio.gather(
+            *(
+                self._request(
+                    "quotes", "get", self.QUOTES_URI, params=params, headers=headers
+                )
+                for params in self._quote_requests(symbols)
+            )
+        )
+        quotes: t.Dict[str, Quote] = {}
+        for response in responses:
+            quotes.update(
+                self._parse_quotes_response(
+                    response.status_code, response.content, response.json
+                )
+            )
+        return quotes
+
+
+_brokerage_services: t.Dict[BrokerageId, BaseBrokerageService] = {}
+_async_brokerage_services: t.Dict[BrokerageId, AsyncBaseBrokerageService] = {}
+_brokerage_services_lock = threading.Lock()
+
+
+def _service_classes(
+    brokerage_id: BrokerageId,
+) -> t.Tuple[t.Type[BaseBrokerageService], t.Type[AsyncBaseBrokerageService]]:
     if brokerage_id == BrokerageId.TD:
-        return TDAmeritradeBrokerageService()
+        return TDAmeritradeBrokerageService, AsyncTDAmeritradeBrokerageService
+    if brokerage_id == BrokerageId.PAPER:
+        # imported here because the paper brokerage builds on this module
+        from services.paper_brokerage import (
+            AsyncPaperBrokerageService,
+            PaperBrokerageService,
+        )
+
+        return PaperBrokerageService, AsyncPaperBrokerageService
     raise ValueError(f"unrecognized brokerage ID {brokerage_id}")
+
+
+def get_brokerage_service(brokerage_id: BrokerageId) -> BaseBrokerageService:
+    service = _brokerage_services.get(brokerage_id)
+    if service is None:
+        with _brokerage_services_lock:
+            service = _brokerage_services.get(brokerage_id)
+            if service is None:
+                service = _service_classes(brokerage_id)[0]()
+                _brokerage_services[brokerage_id] = service
+    return service
+
+
+def get_async_brokerage_service(brokerage_id: BrokerageId) -> AsyncBaseBrokerageService:
+    service = _async_brokerage_services.get(brokerage_id)
+    if service is None:
+        with _brokerage_services_lock:
+            service = _async_brokerage_services.get(brokerage_id)
+            if service is None:
+                service = _service_classes(brokerage_id)[1]()
+                _async_brokerage_services[brokerage_id] = service
+    return service
+
+
+async def close_brokerage_services() -> None:
+    """close the pooled connections of every brokerage service created so far"""
+    with _brokerage_services_lock:
+        services = list(_brokerage_services.values())
+        async_services = list(_async_brokerage_services.values())
+        _brokerage_services.clear()
+        _async_brokerage_services.clear()
+    for service in services:
+        service.close()
+    for async_service in async_services:
+        await async_service.aclose()
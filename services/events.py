@@ -0,0 +1,171 @@
+import asyncio
+import contextlib
+import logging
+import typing as t
+
+from pydantic import BaseModel
+
+from common.config import APP_NAME, UserSettings, UserSettingsChange
+from common.metrics import Gauge
+from common.utils import get_clock
+from models.events import EventType
+
+LOGGER = logging.getLogger(f"{APP_NAME}.events")
+
+KEEPALIVE = b": keepalive\n\n"
+
+EventListener = t.Callable[[EventType, BaseModel], None]
+
+
+def format_event(event_type: EventType, data: BaseModel) -> bytes:
+    """an event in the text/event-stream format"""
+    return f"event: {event_type.value}\ndata: {data.json()}\n\n".encode()
+
+
+class EventSubscription:
+    """The events for one connected client. A client that falls more than
+    max_pending events behind is disconnected, and reconnects with fresh state."""
+
+    def __init__(self, max_pending: int) -> None:
+        self.max_pending = max_pending
+        self._queue: "asyncio.Queue[t.Optional[bytes]]" = asyncio.Queue()
+        self.closed = False
+
+    def put(self, message: bytes) -> None:
+        if self.closed:
+            return
+        if self._queue.qsize() >= self.max_pending:
+            LOGGER.warning("Event subscriber fell behind, disconnecting it")
+            self.close()
+            return
+        self._queue.put_nowait(message)
+
+    def close(self) -> None:
+        self.closed = True
+        self._queue.put_nowait(None)
+
+    async def __aiter__(self) -> t.AsyncIterator[bytes]:
+        while True:
+            message = await self._queue.get()
+            if message is None:
+                return
+            yield message
+
+
+class EventBroker:
+    """Fans events out to every connected client.
+
+    Each event is serialized once, on the thread that published it, and the
+    same bytes are queued for every subscriber on the event loop. Idle
+    connections cost a queue each, plus a shared keepalive.
+    """
+
+    MAX_PENDING = 100
+    KEEPALIVE_SECONDS = 15
+
+    def __init__(self) -> None:
+        self._subscriptions: t.Set[EventSubscription] = set()
+        self._loop: t.Optional[asyncio.AbstractEventLoop] = None
+        self._task: t.Optional[asyncio.Task[None]] = None
+        self._unsubscribe: t.Optional[t.Callable[[], None]] = None
+        self._listeners: t.List[t.Tuple[EventListener, t.FrozenSet[EventType]]] = []
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscriptions)
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._unsubscribe = UserSettings.subscribe(self._on_settings_change)
+        self._task = self._loop.create_task(self._keepalive(), name="EVENT_BROKER")
+
+    async def stop(self) -> None:
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+            self._unsubscribe = None
+        task, self._task, self._loop = self._task, None, None
+        if task is not None:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        for subscription in list(self._subscriptions):
+            subscription.close()
+        self._subscriptions.clear()
+
+    @contextlib.contextmanager
+    def subscribe(self) -> t.Iterator[EventSubscription]:
+        """subscribe on the event loop for as long as the with block runs"""
+        subscription = EventSubscription(self.MAX_PENDING)
+        self._subscriptions.add(subscription)
+        try:
+            yield subscription
+        finally:
+            self._subscriptions.discard(subscription)
+
+    def listen(
+        self, listener: EventListener, event_types: t.Iterable[EventType]
+    ) -> t.Callable[[], None]:
+        """call listener with every event of event_types published in this
+        process, whether or not the broker is running. listeners run on the
+        thread that published and should return quickly. returns a function
+        that stops listening"""
+        entry = (listener, frozenset(event_types))
+        self._listeners.append(entry)
+
+        def unlisten() -> None:
+            with contextlib.suppress(ValueError):
+                self._listeners.remove(entry)
+
+        return unlisten
+
+    def _fan_out(self, message: bytes) -> None:
+        for subscription in list(self._subscriptions):
+            subscription.put(message)
+            if subscription.closed:
+                self._subscriptions.discard(subscription)
+
+    def publish(self, event_type: EventType, data: BaseModel) -> None:
+        """send an event to every subscriber. safe to call from any thread"""
+        for listener, event_types in list(self._listeners):
+            if event_type not in event_types:
+                continue
+            try:
+                listener(event_type, data)
+            except Exception:
+                LOGGER.exception(f"Event listener {listener} failed")
+        loop = self._loop
+        if loop is None or loop.is_closed() or not self._subscriptions:
+            return
+        message = format_event(event_type, data)
+        try:
+            on_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._fan_out(message)
+        else:
+            loop.call_soon_threadsafe(self._fan_out, message)
+
+    def _on_settings_change(self, change: UserSettingsChange) -> None:
+        self.publish(EventType.SETTINGS, change.new)
+
+    async def _keepalive(self) -> None:
+        # comments keep proxies from timing out idle connections
+        while True:
+            await get_clock().sleep(self.KEEPALIVE_SECONDS)
+            self._fan_out(KEEPALIVE)
+
+
+event_broker = EventBroker()
+
+EVENT_SUBSCRIBERS = Gauge(
+    "mark_trader_event_subscribers",
+    "Clients connected to the event stream",
+    function=lambda: event_broker.subscribers,
+)
@@ -0,0 +1,317 @@
+import abc
+import typing as t
+
+import numpy as np
+import numpy.typing as npt
+
+FloatArray = npt.NDArray[np.float64]
+IntArray = npt.NDArray[np.int64]
+
+
+class Indicator(abc.ABC):
+    """Incremental state for one indicator over a batch of symbols.
+
+    State arrays keep one column per symbol, so every tick updates all symbols
+    with a handful of vectorized operations and constant work per symbol.
+    """
+
+    def __init__(self, n_symbols: int = 0) -> None:
+        self._set_state(self._new_state(n_symbols))
+
+    @property
+    def n_symbols(self) -> int:
+        return len(self.value)
+
+    @property
+    @abc.abstractmethod
+    def value(self) -> FloatArray:
+        """the current value per symbol, NaN until enough ticks have been seen"""
+        raise NotImplemented
+
+    @abc.abstractmethod
+    def _new_state(self, n_symbols: int) -> t.Dict[str, npt.NDArray[t.Any]]:
+        """fresh state arrays by attribute name, symbols on the last axis"""
+        raise NotImplemented
+
+    @abc.abstractmethod
+    def _update(
+        self, cols: IntArray, prices: FloatArray, volumes: t.Optional[FloatArray]
+    ) -> None:
+        raise NotImplemented
+
+    def _set_state(self, state: t.Dict[str, npt.NDArray[t.Any]]) -> None:
+        for name, array in state.items():
+            setattr(self, name, array)
+
+    def update(
+        self,
+        prices: FloatArray,
+        volumes: t.Optional[FloatArray] = None,
+        cols: t.Optional[IntArray] = None,
+    ) -> None:
+        """apply one tick per symbol. symbols with a NaN price are left unchanged.
+        cols, the indices of the prices that aren't NaN, can be passed in when
+        they are already known"""
+        if cols is None:
+            cols = np.flatnonzero(~np.isnan(prices))
+        if len(cols):
+            self._update(
+                cols, prices[cols], volumes[cols] if volumes is not None else None
+            )
+
+    def reset(self) -> None:
+        self._set_state(self._new_state(self.n_symbols))
+
+    def reindex(self, take: IntArray) -> None:
+        """rearrange the symbol columns. column i takes the state of old column
+        take[i], or starts fresh if take[i] is negative"""
+        state = self._new_state(len(take))
+        keep = take >= 0
+        for name, array in state.items():
+            array[..., keep] = getattr(self, name)[..., take[keep]]
+        self._set_state(state)
+
+
+class SMA(Indicator):
+    """simple moving average over the last period ticks"""
+
+    _ring: FloatArray
+    _pos: IntArray
+    _count: IntArray
+    _sum: FloatArray
+
+    def __init__(self, period: int, n_symbols: int = 0) -> None:
+        if period < 1:
+            raise ValueError("period must be at least 1")
+        self.period = period
+        super().__init__(n_symbols)
+
+    @property
+    def value(self) -> FloatArray:
+        return np.where(self._count >= self.period, self._sum / self.period, np.nan)
+
+    def _new_state(self, n_symbols: int) -> t.Dict[str, npt.NDArray[t.Any]]:
+        return {
+            "_ring": np.zeros((self.period, n_symbols)),
+            "_pos": np.zeros(n_symbols, dtype=np.int64),
+            "_count": np.zeros(n_symbols, dtype=np.int64),
+            "_sum": np.zeros(n_symbols),
+        }
+
+    def _update(
+        self, cols: IntArray, prices: FloatArray, volumes: t.Optional[FloatArray]
+    ) -> None:
+        pos = self._pos[cols]
+        old = self._ring[pos, cols]
+        self._ring[pos, cols] = prices
+        self._sum[cols] += prices - old
+        self._add_sums(cols, prices, old)
+        self._count[cols] = np.minimum(self._count[cols] + 1, self.period)
+        pos = (pos + 1) % self.period
+        self._pos[cols] = pos
+        # re-add the window once per lap so floating point error can't build up
+        wrapped = cols[pos == 0]
+        if len(wrapped):
+            self._resum(wrapped)
+
+    def _add_sums(self, cols: IntArray, prices: FloatArray, old: FloatArray) -> None:
+        pass
+
+    def _resum(self, cols: IntArray) -> None:
+        self._sum[cols] = self._ring[:, cols].sum(axis=0)
+
+
+class BollingerBands(SMA):
+    """the SMA as middle band with bands width standard deviations either side"""
+
+    _sum_squares: FloatArray
+
+    def __init__(
+        self, period: int = 20, width: float = 2.0, n_symbols: int = 0
+    ) -> None:
+        self.width = width
+        super().__init__(period, n_symbols)
+
+    @property
+    def deviation(self) -> FloatArray:
+        mean = self._sum / self.period
+        variance = np.maximum(self._sum_squares / self.period - mean * mean, 0)
+        return np.where(self._count >= self.period, np.sqrt(variance), np.nan)
+
+    @property
+    def upper(self) -> FloatArray:
+        return self.value + self.width * self.deviation
+
+    @property
+    def lower(self) -> FloatArray:
+        return self.value - self.width * self.deviation
+
+    def _new_state(self, n_symbols: int) -> t.Dict[str, npt.NDArray[t.Any]]:
+        return {**super()._new_state(n_symbols), "_sum_squares": np.zeros(n_symbols)}
+
+    def _add_sums(self, cols: IntArray, prices: FloatArray, old: FloatArray) -> None:
+        self._sum_squares[cols] += prices * prices - old * old
+
+    def _resum(self, cols: IntArray) -> None:
+        super()._resum(cols)
+        window = self._ring[:, cols]
+        self._sum_squares[cols] = (window * window).sum(axis=0)
+
+
+class EMA(Indicator):
+    """exponential moving average seeded with the first price"""
+
+    _value: FloatArray
+
+    def __init__(self, period: int, n_symbols: int = 0) -> None:
+        if period < 1:
+            raise ValueError("period must be at least 1")
+        self.period = period
+        self.alpha = 2 / (period + 1)
+        super().__init__(n_symbols)
+
+    @property
+    def value(self) -> FloatArray:
+        return self._value.copy()
+
+    def _new_state(self, n_symbols: int) -> t.Dict[str, npt.NDArray[t.Any]]:
+        return {"_value": np.full(n_symbols, np.nan)}
+
+    def _update(
+        self, cols: IntArray, prices: FloatArray, volumes: t.Optional[FloatArray]
+    ) -> None:
+        value = self._value[cols]
+        self._value[cols] = np.where(
+            np.isnan(value), prices, value + self.alpha * (prices - value)
+        )
+
+
+class RSI(Indicator):
+    """relative strength index with Wilder's smoothing"""
+
+    _prev: FloatArray
+    _count: IntArray
+    _avg_gain: FloatArray
+    _avg_loss: FloatArray
+
+    def __init__(self, period: int = 14, n_symbols: int = 0) -> None:
+        if period < 1:
+            raise ValueError("period must be at least 1")
+        self.period = period
+        super().__init__(n_symbols)
+
+    @property
+    def value(self) -> FloatArray:
+        gain, loss = self._avg_gain, self._avg_loss
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rsi = np.where(
+                loss > 0,
+                100 - 100 / (1 + gain / loss),
+                np.where(gain > 0, 100.0, 50.0),
+            )
+        return np.where(self._count >= self.period, rsi, np.nan)
+
+    def _new_state(self, n_symbols: int) -> t.Dict[str, npt.NDArray[t.Any]]:
+        return {
+            "_prev": np.full(n_symbols, np.nan),
+            "_count": np.zeros(n_symbols, dtype=np.int64),
+            "_avg_gain": np.zeros(n_symbols),
+            "_avg_loss": np.zeros(n_symbols),
+        }
+
+    def _update(
+        self, cols: IntArray, prices: FloatArray, volumes: t.Optional[FloatArray]
+    ) -> None:
+        prev = self._prev[cols]
+        self._prev[cols] = prices
+        has_prev = ~np.isnan(prev)
+        cols, change = cols[has_prev], prices[has_prev] - prev[has_prev]
+        count = self._count[cols] + 1
+        self._count[cols] = count
+        # a plain average over the first period changes, then Wilder's smoothing
+        weight = 1 / np.minimum(count, self.period)
+        gain = self._avg_gain[cols]
+        loss = self._avg_loss[cols]
+        self._avg_gain[cols] = gain + (np.maximum(change, 0) - gain) * weight
+        self._avg_loss[cols] = loss + (np.maximum(-change, 0) - loss) * weight
+
+
+class VWAP(Indicator):
+    """volume weighted average price since the last reset.
+    volumes are the volume traded since the previous tick"""
+
+    _price_volume: FloatArray
+    _volume: FloatArray
+
+    @property
+    def value(self) -> FloatArray:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self._volume > 0, self._price_volume / self._volume, np.nan)
+
+    def _new_state(self, n_symbols: int) -> t.Dict[str, npt.NDArray[t.Any]]:
+        return {"_price_volume": np.zeros(n_symbols), "_volume": np.zeros(n_symbols)}
+
+    def _update(
+        self, cols: IntArray, prices: FloatArray, volumes: t.Optional[FloatArray]
+    ) -> None:
+        if volumes is None:
+            raise ValueError("VWAP needs volumes")
+        self._price_volume[cols] += prices * volumes
+        self._volume[cols] += volumes
+
+
+class IndicatorSet:
+    """Named indicators over the same symbols, updated together one tick at a time.
+
+    Price and volume arrays passed in are aligned with symbols.
+    """
+
+    def __init__(
+        self, indicators: t.Mapping[str, Indicator], symbols: t.Iterable[str] = ()
+    ) -> None:
+        self.indicators = dict(indicators)
+        self._symbols: t.List[str] = []
+        self._index: t.Dict[str, int] = {}
+        for indicator in self.indicators.values():
+            indicator.reindex(np.full(0, -1, dtype=np.int64))
+        self.set_symbols(symbols)
+
+    @property
+    def symbols(self) -> t.List[str]:
+        return list(self._symbols)
+
+    def set_symbols(self, symbols: t.Iterable[str]) -> None:
+        """change the symbols, keeping the state of symbols that remain"""
+        symbols = list(dict.fromkeys(symbols))
+        if symbols == self._symbols:
+            return
+        take = np.array(
+            [self._index.get(symbol, -1) for symbol in symbols], dtype=np.int64
+        )
+        for indicator in self.indicators.values():
+            indicator.reindex(take)
+        self._symbols = symbols
+        self._index = {symbol: i for i, symbol in enumerate(symbols)}
+
+    def update(
+        self, prices: FloatArray, volumes: t.Optional[FloatArray] = None
+    ) -> None:
+        cols = np.flatnonzero(~np.isnan(prices))
+        for indicator in self.indicators.values():
+            indicator.update(prices, volumes, cols)
+
+    def seed(self, prices: FloatArray, volumes: t.Optional[FloatArray] = None) -> None:
+        """replay history given as 2-D arrays of symbols by ticks, oldest first.
+        NaN pads symbols with shorter histories"""
+        for i in range(prices.shape[1]):
+            self.update(prices[:, i], volumes[:, i] if volumes is not None else None)
+
+    def reset(self) -> None:
+        for indicator in self.indicators.values():
+            indicator.reset()
+
+    def values(self) -> t.Dict[str, FloatArray]:
+        return {name: indicator.value for name, indicator in self.indicators.items()}
+
+    def value(self, name: str, symbol: str) -> float:
+        return float(self.indicators[name].value[self._index[symbol]])
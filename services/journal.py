@@ -0,0 +1,447 @@
+"""An append-only journal of signals, orders, fills and settings changes.
+
+Events are fixed width records in segment files. A segment has room for a set
+number of records and stores them column by column behind a small header, so a
+query touches only the columns it needs. Segments are read through mmap, which
+pages in what a query scans instead of loading the journal into memory.
+
+Each worker process appends to its own segment, and starts a new one when it is
+full or older than the rotation period. A reader can map a segment while its
+writer appends: the record count in the header is bumped after the record.
+"""
+import contextlib
+import datetime
+import enum
+import logging
+import mmap
+import os
+import threading
+import time
+import typing as t
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+
+from common.config import (
+    APP_NAME,
+    GlobalConfig,
+    UserSettings,
+    UserSettingsChange,
+    config_snapshot,
+)
+from common.metrics import Counter
+from common.utils import get_clock
+from models.journal import JournalSummary, LatencySummary, SymbolSummary
+from models.trading import Fill, Order, OrderSide
+
+LOGGER = logging.getLogger(f"{APP_NAME}.journal")
+
+JOURNAL_RECORDS = Counter(
+    "mark_trader_journal_records_total",
+    "Events appended to the trade journal, by kind",
+    ["kind"],
+)
+
+
+class EventKind(enum.IntEnum):
+    SIGNAL = 0
+    ORDER = 1
+    ORDER_FAILED = 2
+    FILL = 3
+    SETTINGS = 4
+
+
+_RECORDS_BY_KIND = {
+    kind: JOURNAL_RECORDS.labels(kind.name.lower()) for kind in EventKind
+}
+
+
+# 8 byte columns first, so every column is aligned whatever the capacity
+COLUMNS: t.Dict[str, np.dtype[t.Any]] = {
+    "time": np.dtype("<f8"),
+    # signed, negative for sells. signals hold the direction wanted
+    "quantity": np.dtype("<f8"),
+    "price": np.dtype("<f8"),
+    "commission": np.dtype("<f8"),
+    # orders: seconds from queueing to the fill
+    "latency": np.dtype("<f8"),
+    # settings changes hold the name of the setting. longer values are rejected
+    "symbol": np.dtype("S32"),
+    "kind": np.dtype("u1"),
+}
+
+# bumped whenever the columns change, segments of other versions are skipped
+_MAGIC = int.from_bytes(b"MTJRNL02", "little")
+# magic, capacity and record count, padded
+_HEADER_SIZE = 64
+_SUFFIX = ".seg"
+
+
+def _layout(capacity: int) -> t.Tuple[t.Dict[str, int], int]:
+    """the offset of each column and the size of a segment"""
+    offsets = {}
+    offset = _HEADER_SIZE
+    for name, dtype in COLUMNS.items():
+        offsets[name] = offset
+        offset += dtype.itemsize * capacity
+    return offsets, offset
+
+
+class Segment:
+    """One segment file, mapped into memory. Open segments of other processes
+    read only with Segment.open."""
+
+    def __init__(self, path: Path, mapped: mmap.mmap) -> None:
+        self.path = path
+        self._mmap = mapped
+        self._header = np.frombuffer(mapped, dtype="<u8", count=3)
+        if int(self._header[0]) != _MAGIC:
+            raise ValueError(f"{path} is not a journal segment")
+        self.capacity = int(self._header[1])
+        offsets, _ = _layout(self.capacity)
+        self._columns = {
+            name: np.frombuffer(
+                mapped, dtype=dtype, count=self.capacity, offset=offsets[name]
+            )
+            for name, dtype in COLUMNS.items()
+        }
+
+    @classmethod
+    def create(cls, path: Path, capacity: int) -> "Segment":
+        _, size = _layout(capacity)
+        with open(path, "xb+") as file:
+            # sparse until written
+            file.truncate(size)
+            mapped = mmap.mmap(file.fileno(), size)
+        np.frombuffer(mapped, dtype="<u8", count=2)[:] = (_MAGIC, capacity)
+        return cls(path, mapped)
+
+    @classmethod
+    def open(cls, path: Path) -> "Segment":
+        with open(path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(path, mapped)
+
+    def __enter__(self) -> "Segment":
+        return self
+
+    def __exit__(self, *args: t.Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        del self._header, self._columns
+        # unmapped once views handed out by column are gone
+        with contextlib.suppress(BufferError):
+            self._mmap.close()
+
+    def flush(self) -> None:
+        self._mmap.flush()
+
+    @property
+    def count(self) -> int:
+        return int(self._header[2])
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def column(self, name: str) -> npt.NDArray[t.Any]:
+        """a view of the records written so far"""
+        return self._columns[name][: self.count]
+
+    def append(
+        self,
+        kind: EventKind,
+        event_time: float,
+        symbol: str = "",
+        quantity: float = 0.0,
+        price: float = np.nan,
+        commission: float = 0.0,
+        latency: float = np.nan,
+    ) -> None:
+        index = self.count
+        if index >= self.capacity:
+            raise ValueError(f"{self.path} is full")
+        columns = self._columns
+        encoded = symbol.encode()
+        # numpy would silently cut it short
+        if len(encoded) > columns["symbol"].itemsize:
+            raise ValueError(f"{symbol!r} is too long for the journal")
+        columns["time"][index] = event_time
+        columns["quantity"][index] = quantity
+        columns["price"][index] = price
+        columns["commission"][index] = commission
+        columns["latency"][index] = latency
+        columns["symbol"][index] = encoded
+        columns["kind"][index] = kind
+        self._header[2] = index + 1
+
+
+def segment_paths(directory: Path) -> t.List[Path]:
+    """every segment in the journal, oldest first"""
+    return sorted(directory.glob(f"*{_SUFFIX}"))
+
+
+def journal_directory() -> Path:
+    return config_snapshot().config.data_dir / "journal"
+
+
+class TradeJournal:
+    """Appends events to the current process's segment. Safe to use from any
+    thread, and cheap enough for the event loop: an append is a few writes to
+    mapped memory, except when it starts a new segment."""
+
+    def __init__(self) -> None:
+        self._segment: t.Optional[Segment] = None
+        self._segment_directory: t.Optional[Path] = None
+        self._segment_config: t.Optional[GlobalConfig] = None
+        self._segment_started = 0.0
+        self._lock = threading.Lock()
+        self._unsubscribe: t.Optional[t.Callable[[], None]] = None
+
+    def start(self) -> None:
+        """journal settings changes until stopped"""
+        if self._unsubscribe is None:
+            self._unsubscribe = UserSettings.subscribe(self.record_settings)
+
+    def stop(self) -> None:
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+            self._unsubscribe = None
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_segment()
+
+    def _close_segment(self) -> None:
+        if self._segment is not None:
+            self._segment.flush()
+            self._segment.close()
+            self._segment = None
+
+    def _writable_segment(self) -> t.Optional[Segment]:
+        config = config_snapshot().config
+        if not config.journal.enabled:
+            self._close_segment()
+            return None
+        now = get_clock().time()
+        segment = self._segment
+        if (
+            segment is None
+            or segment.full
+            or now - self._segment_started >= config.journal.rotate_seconds
+            # a reloaded config may have moved the data directory
+            or (
+                config is not self._segment_config
+                and journal_directory() != self._segment_directory
+            )
+        ):
+            self._close_segment()
+            directory = journal_directory()
+            directory.mkdir(parents=True, exist_ok=True)
+            # names sort by creation time, the pid keeps workers apart
+            path = directory / f"{time.time_ns():020d}-{os.getpid()}{_SUFFIX}"
+            segment = self._segment = Segment.create(
+                path, config.journal.records_per_segment
+            )
+            self._segment_directory = directory
+            self._segment_started = now
+            LOGGER.info(f"Journaling to {path}")
+        self._segment_config = config
+        return segment
+
+    def append(self, kind: EventKind, event_time: float, **fields: t.Any) -> None:
+        with self._lock:
+            segment = self._writable_segment()
+            if segment is None:
+                return
+            try:
+                segment.append(kind, event_time, **fields)
+            except ValueError as e:
+                # journaling never fails the trade or settings change it records
+                LOGGER.warning(f"Journal {kind.name.lower()} event rejected: {e}")
+                return
+        _RECORDS_BY_KIND[kind].inc()
+
+    def record_signal(
+        self, symbol: str, direction: float, price: float, when: datetime.datetime
+    ) -> None:
+        self.append(
+            EventKind.SIGNAL,
+            when.timestamp(),
+            symbol=symbol,
+            quantity=direction,
+            price=price,
+        )
+
+    def record_order(
+        self, order: Order, latency: float, fill: t.Optional[Fill] = None
+    ) -> None:
+        """an order that was placed, with its fill, or failed without one"""
+        sign = 1 if order.side == OrderSide.BUY else -1
+        self.append(
+            EventKind.ORDER if fill is not None else EventKind.ORDER_FAILED,
+            get_clock().time(),
+            symbol=order.symbol,
+            quantity=sign * order.quantity,
+            latency=latency,
+        )
+        if fill is not None:
+            self.record_fill(fill)
+
+    def record_fill(self, fill: Fill) -> None:
+        sign = 1 if fill.side == OrderSide.BUY else -1
+        self.append(
+            EventKind.FILL,
+            fill.fill_time.timestamp(),
+            symbol=fill.symbol,
+            quantity=sign * fill.quantity,
+            price=fill.price,
+            commission=fill.commission,
+        )
+
+    def record_settings(self, change: UserSettingsChange) -> None:
+        # every worker sees a change, only the one that made it journals it
+        if not change.local:
+            return
+        now = get_clock().time()
+        for name in sorted(change.changed):
+            self.append(EventKind.SETTINGS, now, symbol=name)
+
+
+trade_journal = TradeJournal()
+
+
+class _SymbolTotals:
+    def __init__(self) -> None:
+        self.fills = 0
+        self.volume = 0.0
+        self.net_quantity = 0.0
+        self.commission = 0.0
+        self.cash_flow = 0.0
+        self.last_time = -np.inf
+        self.last_price = np.nan
+
+    def summary(self, symbol: str) -> SymbolSummary:
+        return SymbolSummary(
+            symbol=symbol,
+            fills=self.fills,
+            volume=self.volume,
+            net_quantity=self.net_quantity,
+            commission=self.commission,
+            cash_flow=self.cash_flow,
+            last_price=self.last_price,
+            pnl=self.cash_flow + self.net_quantity * self.last_price,
+        )
+
+
+class _Totals:
+    def __init__(self) -> None:
+        self.events = np.zeros(len(EventKind), dtype=np.int64)
+        self.symbols: t.Dict[str, _SymbolTotals] = {}
+        self.latencies: t.List[npt.NDArray[np.float64]] = []
+
+
+def summarize(
+    directory: Path,
+    start: t.Optional[datetime.datetime] = None,
+    end: t.Optional[datetime.datetime] = None,
+    symbol: t.Optional[str] = None,
+) -> JournalSummary:
+    """event counts, fill totals per symbol and order latency for events from
+    start up to end, scanning each segment's columns in place"""
+    totals = _Totals()
+    for path in segment_paths(directory):
+        try:
+            segment = Segment.open(path)
+        except (FileNotFoundError, ValueError):
+            # being created, or not a segment
+            continue
+        with segment:
+            _scan(segment, totals, start, end, symbol)
+
+    events = totals.events
+    latencies = np.concatenate(totals.latencies) if totals.latencies else np.zeros(0)
+    ordered = len(latencies) > 0
+    return JournalSummary(
+        start=start,
+        end=end,
+        events={kind.name.lower(): int(events[kind]) for kind in EventKind},
+        symbols=[totals.symbols[s].summary(s) for s in sorted(totals.symbols)],
+        order_latency=LatencySummary(
+            orders=len(latencies),
+            failed=int(events[EventKind.ORDER_FAILED]),
+            mean=float(latencies.mean()) if ordered else None,
+            p50=float(np.quantile(latencies, 0.5)) if ordered else None,
+            p99=float(np.quantile(latencies, 0.99)) if ordered else None,
+            max=float(latencies.max()) if ordered else None,
+        ),
+    )
+
+
+def _scan(
+    segment: Segment,
+    totals: _Totals,
+    start: t.Optional[datetime.datetime],
+    end: t.Optional[datetime.datetime],
+    symbol: t.Optional[str],
+) -> None:
+    # only copies outlive this, so the segment can be unmapped after
+    count = segment.count
+    times = segment.column("time")[:count]
+    kinds = segment.column("kind")[:count]
+    symbols = segment.column("symbol")[:count]
+    wanted = np.ones(count, dtype=bool)
+    if start is not None:
+        wanted &= times >= start.timestamp()
+    if end is not None:
+        wanted &= times < end.timestamp()
+    if symbol is not None:
+        wanted &= symbols == symbol.encode()
+    totals.events += np.bincount(kinds[wanted], minlength=len(EventKind))
+
+    orders = wanted & (kinds == EventKind.ORDER)
+    totals.latencies.append(segment.column("latency")[:count][orders])
+
+    fills = np.flatnonzero(wanted & (kinds == EventKind.FILL))
+    if len(fills):
+        _add_fills(
+            totals.symbols,
+            symbols[fills],
+            times[fills],
+            segment.column("quantity")[:count][fills],
+            segment.column("price")[:count][fills],
+            segment.column("commission")[:count][fills],
+        )
+
+
+def _add_fills(
+    totals: t.Dict[str, _SymbolTotals],
+    symbols: npt.NDArray[np.bytes_],
+    times: npt.NDArray[np.float64],
+    quantities: npt.NDArray[np.float64],
+    prices: npt.NDArray[np.float64],
+    commissions: npt.NDArray[np.float64],
+) -> None:
+    names, groups = np.unique(symbols, return_inverse=True)
+    size = len(names)
+    fills = np.bincount(groups, minlength=size)
+    volume = np.bincount(groups, np.abs(quantities), size)
+    net_quantity = np.bincount(groups, quantities, size)
+    commission = np.bincount(groups, commissions, size)
+    spent = np.bincount(groups, quantities * prices, size)
+    # the newest fill of each symbol
+    order = np.lexsort((times, groups))
+    last = order[np.searchsorted(groups[order], np.arange(size), side="right") - 1]
+    for i, name in enumerate(names):
+        symbol_totals = totals.setdefault(name.decode(), _SymbolTotals())
+        symbol_totals.fills += int(fills[i])
+        symbol_totals.volume += float(volume[i])
+        symbol_totals.net_quantity += float(net_quantity[i])
+        symbol_totals.commission += float(commission[i])
+        symbol_totals.cash_flow -= float(spent[i] + commission[i])
+        if times[last[i]] >= symbol_totals.last_time:
+            symbol_totals.last_time = float(times[last[i]])
+            symbol_totals.last_price = float(prices[last[i]])
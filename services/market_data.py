@@ -0,0 +1,228 @@
+import asyncio
+import contextlib
+import logging
+import typing as t
+
+import numpy as np
+import numpy.typing as npt
+
+from common.config import APP_NAME, GlobalConfig, UserSettings, UserSettingsChange
+from common.utils import wait_for_event
+from models.market_data import Quote
+from services.authentication import AuthenticationService
+from services.brokerage import get_async_brokerage_service
+
+LOGGER = logging.getLogger(f"{APP_NAME}.market_data")
+
+FloatArray = npt.NDArray[np.float64]
+
+
+class PriceWindow(t.NamedTuple):
+    """Read-only views of the most recent ticks, oldest first.
+
+    The views share memory with the ring buffer. They stay valid until the
+    buffer wraps past them, so copy them if they must outlive the next
+    capacity - len(window) ticks.
+    """
+
+    times: FloatArray
+    prices: FloatArray
+    volumes: FloatArray
+
+
+class PriceRingBuffer:
+    """Fixed capacity tick storage backed by numpy arrays.
+
+    Every tick is written twice, capacity slots apart, so any window of up to
+    capacity ticks is a contiguous slice and can be returned without copying.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self._times = np.zeros(2 * capacity, dtype=np.float64)
+        self._prices = np.zeros(2 * capacity, dtype=np.float64)
+        self._volumes = np.zeros(2 * capacity, dtype=np.float64)
+        self._next = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, time: float, price: float, volume: float = 0) -> None:
+        i = self._next
+        for column, value in (
+            (self._times, time),
+            (self._prices, price),
+            (self._volumes, volume),
+        ):
+            column[i] = value
+            column[i + self.capacity] = value
+        self._next = (i + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def window(self, size: t.Optional[int] = None) -> PriceWindow:
+        """the last size ticks (all stored ticks by default) as zero-copy views"""
+        size = self._count if size is None else min(size, self._count)
+        end = self._next + self.capacity
+        start = end - size
+        views = []
+        for column in (self._times, self._prices, self._volumes):
+            view = column[start:end]
+            view.flags.writeable = False
+            views.append(view)
+        return PriceWindow(*views)
+
+
+class MarketDataEngine:
+    """Polls quotes for the configured symbols every trading_frequency_seconds
+    and keeps a bounded history per symbol.
+
+    Symbols are added and removed as the user settings change. Quotes are only
+    polled while automated trading is enabled or something has subscribed.
+    """
+
+    def __init__(self, system: str = "MARK_TRADER") -> None:
+        self._auth_service = AuthenticationService(system)
+        self._buffers: t.Dict[str, PriceRingBuffer] = {}
+        self._loop: t.Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: t.Optional[asyncio.Event] = None
+        self._task: t.Optional[asyncio.Task[None]] = None
+        self._unsubscribe: t.Optional[t.Callable[[], None]] = None
+        self._subscribers = 0
+
+    @property
+    def symbols(self) -> t.List[str]:
+        return list(self._buffers)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def polling(self) -> bool:
+        return self._subscribers > 0 or UserSettings().enable_automated_trading
+
+    @contextlib.contextmanager
+    def subscribe(self) -> t.Iterator[None]:
+        """poll quotes for as long as the with block runs, on the event loop"""
+        self._subscribers += 1
+        self._wake()
+        try:
+            yield
+        finally:
+            self._subscribers -= 1
+
+    def _wake(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def window(self, symbol: str, size: t.Optional[int] = None) -> PriceWindow:
+        return self._buffers[symbol].window(size)
+
+    def batch(self, size: int) -> PriceWindow:
+        """the last size ticks of every symbol as symbols by ticks arrays, in the
+        order of symbols. shorter histories are padded with NaN at the start"""
+        shape = (len(self._buffers), size)
+        times, prices, volumes = (np.full(shape, np.nan) for _ in range(3))
+        for row, buffer in enumerate(self._buffers.values()):
+            window = buffer.window(size)
+            start = size - len(window.prices)
+            times[row, start:] = window.times
+            prices[row, start:] = window.prices
+            volumes[row, start:] = window.volumes
+        return PriceWindow(times, prices, volumes)
+
+    def latest_price(self, symbol: str) -> t.Optional[float]:
+        window = self.window(symbol, 1)
+        return float(window.prices[0]) if len(window.prices) else None
+
+    def set_symbols(self, symbols: t.Iterable[str]) -> None:
+        symbols = list(dict.fromkeys(symbols))
+        capacity = GlobalConfig().market_data.buffer_size
+        buffers = {
+            symbol: self._buffers.get(symbol) or PriceRingBuffer(capacity)
+            for symbol in symbols
+        }
+        added = buffers.keys() - self._buffers.keys()
+        removed = self._buffers.keys() - buffers.keys()
+        if added or removed:
+            LOGGER.info(f"Market data symbols added {added}, removed {removed}")
+        self._buffers = buffers
+
+    def record(self, quote: Quote) -> None:
+        buffer = self._buffers.get(quote.symbol)
+        if buffer is not None:
+            buffer.append(quote.quote_time.timestamp(), quote.last_price, quote.volume)
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self.set_symbols(UserSettings().symbols)
+        self._unsubscribe = UserSettings.subscribe(
+            self._on_settings_change,
+            fields=["symbols", "trading_frequency_seconds", "enable_automated_trading"],
+        )
+        self._task = self._loop.create_task(self._run(), name="MARKET_DATA_ENGINE")
+
+    async def stop(self) -> None:
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+            self._unsubscribe = None
+        task, self._task, self._loop = self._task, None, None
+        if task is not None:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    def _on_settings_change(self, change: UserSettingsChange) -> None:
+        # settings change on request and watcher threads, apply them on the loop
+        loop, wakeup = self._loop, self._wakeup
+        if loop is None or wakeup is None or loop.is_closed():
+            return
+        woken: asyncio.Event = wakeup
+
+        def apply() -> None:
+            self.set_symbols(change.new.symbols)
+            woken.set()
+
+        loop.call_soon_threadsafe(apply)
+
+    async def poll(self) -> None:
+        symbols = self.symbols
+        if not symbols:
+            return
+        auth_tokens = await self._auth_service.get_active_tokens_async()
+        if not auth_tokens:
+            return
+        brokerage = get_async_brokerage_service(auth_tokens.brokerage_id)
+        try:
+            quotes = await brokerage.get_quotes(auth_tokens, symbols)
+        except Exception as e:
+            LOGGER.warning(f"Failed to get quotes for {len(symbols)} symbols: {e}")
+            return
+        for quote in quotes.values():
+            self.record(quote)
+        missing = [symbol for symbol in symbols if symbol not in quotes]
+        if missing:
+            LOGGER.warning(f"No quotes returned for {missing}")
+
+    async def _run(self) -> None:
+        assert self._wakeup is not None
+        while True:
+            self._wakeup.clear()
+            if not self.polling:
+                # woken by settings changes and subscribers
+                await wait_for_event(self._wakeup, None)
+                continue
+            try:
+                await self.poll()
+            except Exception:
+                LOGGER.exception("Market data poll failed")
+            await wait_for_event(self._wakeup, UserSettings().trading_frequency_seconds)
+
+
+market_data_engine = MarketDataEngine()
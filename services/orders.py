@@ -0,0 +1,308 @@
+import asyncio
+import collections
+import contextlib
+import itertools
+import logging
+import statistics
+import typing as t
+import uuid
+
+from common.config import APP_NAME, GlobalConfig, RateLimitConfig, config_snapshot
+from common.metrics import Counter, Gauge, Histogram
+from common.utils import get_clock, run_blocking
+from models.brokerage import BrokerageId
+from models.trading import Fill, Order
+from services.authentication import AuthenticationService
+from services.brokerage import OrdersNotSupportedError, get_async_brokerage_service
+from services.journal import trade_journal
+from services.positions import position_store
+
+LOGGER = logging.getLogger(f"{APP_NAME}.orders")
+
+# exits close risk, so they jump ahead of any queued entries
+EXIT_PRIORITY = 0
+ENTRY_PRIORITY = 1
+
+ORDERS = Counter(
+    "mark_trader_orders_total",
+    "Orders submitted by the pipeline, by result",
+    ["result"],
+)
+ORDER_SUBMIT_SECONDS = Histogram(
+    "mark_trader_order_submit_seconds",
+    "Seconds from queueing an order until the brokerage answered",
+)
+
+
+class TokenBucket:
+    """Allows rate acquisitions per second on average, and bursts of up to burst,
+    measured on the current clock. Waiters are served in arrival order: each
+    reserves its token on arrival, taking the balance below zero, and sleeps
+    until the balance it reserved from has refilled."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = get_clock().time()
+
+    @classmethod
+    def from_config(cls, config: RateLimitConfig) -> "TokenBucket":
+        return cls(config.requests_per_second, config.burst)
+
+    def _refill(self) -> None:
+        now = get_clock().time()
+        elapsed = max(now - self._updated, 0)
+        self._tokens = min(self._tokens + elapsed * self.rate, self.burst)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        self._refill()
+        self._tokens -= 1
+        if self._tokens < 0:
+            try:
+                await get_clock().sleep(-self._tokens / self.rate)
+            except asyncio.CancelledError:
+                self._tokens += 1
+                raise
+
+
+class OrderPipelineStats(t.NamedTuple):
+    """latencies are seconds from submission until the brokerage answered, over
+    the most recent orders"""
+
+    queue_depth: int
+    in_flight: int
+    submitted: int
+    failed: int
+    duplicates: int
+    latency_mean: float
+    latency_p50: float
+    latency_p99: float
+    latency_max: float
+
+
+class _QueuedOrder(t.NamedTuple):
+    priority: int
+    seq: int
+    queued_at: float
+    order: Order
+    result: "asyncio.Future[Fill]"
+
+
+class OrderPipeline:
+    """Submits orders to the active brokerage from a bounded priority queue.
+
+    Workers take exits before entries, and orders of the same priority in the
+    order they were queued. Each brokerage gets its own token bucket so bursts
+    of orders stay within its rate limit. Orders are keyed by client order ID:
+    queueing an ID that is pending or has filled returns the same result
+    instead of placing the order again.
+    """
+
+    RECENT_ORDERS = 10_000
+    LATENCY_SAMPLES = 1000
+
+    def __init__(self, system: str = "MARK_TRADER") -> None:
+        self._auth_service = AuthenticationService(system)
+        self._queue: t.Optional["asyncio.PriorityQueue[_QueuedOrder]"] = None
+        self._workers: t.List["asyncio.Task[None]"] = []
+        self._buckets: t.Dict[BrokerageId, TokenBucket] = {}
+        self._results: t.OrderedDict[
+            str, "asyncio.Future[Fill]"
+        ] = collections.OrderedDict()
+        self._seq = itertools.count()
+        self._latencies: t.Deque[float] = collections.deque(maxlen=self.LATENCY_SAMPLES)
+        self._in_flight = 0
+        self._submitted = 0
+        self._failed = 0
+        self._duplicates = 0
+
+    @property
+    def running(self) -> bool:
+        return any(not worker.done() for worker in self._workers)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stats(self) -> OrderPipelineStats:
+        latencies = sorted(self._latencies)
+        return OrderPipelineStats(
+            queue_depth=self.queue_depth,
+            in_flight=self._in_flight,
+            submitted=self._submitted,
+            failed=self._failed,
+            duplicates=self._duplicates,
+            latency_mean=statistics.fmean(latencies) if latencies else 0.0,
+            latency_p50=latencies[len(latencies) // 2] if latencies else 0.0,
+            latency_p99=latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+            latency_max=latencies[-1] if latencies else 0.0,
+        )
+
+    def start(self) -> None:
+        if self.running:
+            return
+        config = GlobalConfig().orders
+        self._queue = asyncio.PriorityQueue(config.queue_size)
+        loop = asyncio.get_running_loop()
+        self._workers = [
+            loop.create_task(self._run(), name=f"ORDER_PIPELINE {i}")
+            for i in range(config.workers)
+        ]
+
+    async def stop(self) -> None:
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.cancel()
+        for worker in workers:
+            with contextlib.suppress(asyncio.CancelledError):
+                await worker
+        queue, self._queue = self._queue, None
+        while queue is not None and not queue.empty():
+            queued = queue.get_nowait()
+            if not queued.result.done():
+                queued.result.set_exception(RuntimeError("order pipeline stopped"))
+
+    def _remember(self, client_order_id: str, result: "asyncio.Future[Fill]") -> None:
+        self._results[client_order_id] = result
+        self._results.move_to_end(client_order_id)
+        while len(self._results) > self.RECENT_ORDERS:
+            self._results.popitem(last=False)
+
+    async def _check_supported(self) -> None:
+        auth_tokens = await self._auth_service.get_active_tokens_async()
+        if auth_tokens and not (
+            get_async_brokerage_service(auth_tokens.brokerage_id).SUPPORTS_ORDERS
+        ):
+            raise OrdersNotSupportedError(
+                f"{auth_tokens.brokerage_id} does not support orders"
+            )
+
+    async def _enqueue(self, order: Order) -> "asyncio.Future[Fill]":
+        if self._queue is None or not self.running:
+            raise RuntimeError("order pipeline is not running")
+        if order.client_order_id is None:
+            order = order.copy(update={"client_order_id": uuid.uuid4().hex})
+        assert order.client_order_id is not None
+        previous = self._results.get(order.client_order_id)
+        if previous is not None and not (
+            previous.done() and (previous.cancelled() or previous.exception())
+        ):
+            # pending or filled, failed orders may be retried with the same ID
+            self._duplicates += 1
+            LOGGER.info(f"Order {order.client_order_id} already submitted")
+            return previous
+        result: "asyncio.Future[Fill]" = asyncio.get_running_loop().create_future()
+        self._remember(order.client_order_id, result)
+        priority = EXIT_PRIORITY if order.is_exit else ENTRY_PRIORITY
+        await self._queue.put(
+            _QueuedOrder(priority, next(self._seq), get_clock().time(), order, result)
+        )
+        return result
+
+    async def enqueue(self, order: Order) -> "asyncio.Future[Fill]":
+        """queue order, waiting for room if the queue is full, and return the
+        future of its fill. orders without a client order ID are given one.
+        raises OrdersNotSupportedError without queueing if the active brokerage
+        can't place orders"""
+        if self._queue is None or not self.running:
+            raise RuntimeError("order pipeline is not running")
+        await self._check_supported()
+        return await self._enqueue(order)
+
+    async def submit(self, order: Order) -> Fill:
+        """queue order and wait for its fill"""
+        # the future may be shared with duplicate submissions, so never cancel it
+        return await asyncio.shield(await self.enqueue(order))
+
+    async def submit_many(self, orders: t.Iterable[Order]) -> t.List[Fill]:
+        """queue a batch of orders together, so its exits are placed before its
+        entries, and wait for all of their fills"""
+        if self._queue is None or not self.running:
+            raise RuntimeError("order pipeline is not running")
+        await self._check_supported()
+        results = [await self._enqueue(order) for order in orders]
+        return list(await asyncio.shield(asyncio.gather(*results)))
+
+    def _bucket(self, brokerage_id: BrokerageId) -> TokenBucket:
+        config = config_snapshot().brokerage_map[brokerage_id].order_rate_limit
+        bucket = self._buckets.get(brokerage_id)
+        if bucket is None or (bucket.rate, bucket.burst) != (
+            config.requests_per_second,
+            config.burst,
+        ):
+            bucket = self._buckets[brokerage_id] = TokenBucket.from_config(config)
+        return bucket
+
+    async def _acquire(self) -> t.Optional[BrokerageId]:
+        auth_tokens = await self._auth_service.get_active_tokens_async()
+        if not auth_tokens:
+            return None
+        await self._bucket(auth_tokens.brokerage_id).acquire()
+        return auth_tokens.brokerage_id
+
+    async def _place(self, order: Order, acquired: t.Optional[BrokerageId]) -> Fill:
+        auth_tokens = await self._auth_service.get_active_tokens_async()
+        if not auth_tokens:
+            raise RuntimeError("not signed in to a brokerage")
+        if auth_tokens.brokerage_id != acquired:
+            # the active brokerage changed while waiting for the rate limit
+            await self._bucket(auth_tokens.brokerage_id).acquire()
+        brokerage = get_async_brokerage_service(auth_tokens.brokerage_id)
+        fill = await brokerage.place_order(auth_tokens, order)
+        try:
+            store = await run_blocking(position_store)
+            await run_blocking(store.record_fill, auth_tokens.brokerage_id, fill)
+        except Exception:
+            # the order went through, reconciling at the next start records the fill
+            LOGGER.exception(f"Order {order.client_order_id}: failed to record fill")
+        return fill
+
+    async def _run(self) -> None:
+        assert self._queue is not None
+        queue = self._queue
+        while True:
+            queued = await queue.get()
+            self._in_flight += 1
+            fill: t.Optional[Fill] = None
+            try:
+                acquired = await self._acquire()
+                if not queue.empty() and not queue.full():
+                    # an exit queued while waiting for the rate limit goes first.
+                    # swapping keeps the sequence numbers, so ties stay in order
+                    queue.put_nowait(queued)
+                    queued = queue.get_nowait()
+                    queue.task_done()
+                fill = await self._place(queued.order, acquired)
+            except asyncio.CancelledError:
+                if not queued.result.done():
+                    queued.result.set_exception(RuntimeError("order pipeline stopped"))
+                raise
+            except Exception as e:
+                self._failed += 1
+                ORDERS.labels("failure").inc()
+                LOGGER.warning(f"Order {queued.order.client_order_id} failed: {e}")
+                if not queued.result.done():
+                    queued.result.set_exception(e)
+            else:
+                self._submitted += 1
+                ORDERS.labels("success").inc()
+                if not queued.result.done():
+                    queued.result.set_result(fill)
+            finally:
+                self._in_flight -= 1
+                latency = get_clock().time() - queued.queued_at
+                self._latencies.append(latency)
+                ORDER_SUBMIT_SECONDS.observe(latency)
+                trade_journal.record_order(queued.order, latency, fill)
+                queue.task_done()
+
+
+order_pipeline = OrderPipeline()
+
+ORDER_QUEUE_DEPTH = Gauge(
+    "mark_trader_order_queue_depth",
+    "Orders waiting in the pipeline queue",
+    function=lambda: order_pipeline.queue_depth,
+)
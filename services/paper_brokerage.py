@@ -0,0 +1,347 @@
+import abc
+import datetime
+import logging
+import math
+import random
+import secrets
+import threading
+import typing as t
+from pathlib import Path
+
+import numpy as np
+
+from common.config import APP_NAME, PaperBrokerageConfig, config_snapshot
+from common.utils import get_clock
+from models.authentication import AuthTokens
+from models.brokerage import BrokerageId
+from models.market_data import Quote
+from models.trading import Fill, Order, OrderSide
+from services.backtest import Bars, load_bars
+from services.brokerage import (
+    AsyncBaseBrokerageService,
+    BaseBrokerageService,
+    _BrokerageServiceBase,
+)
+
+LOGGER = logging.getLogger(f"{APP_NAME}.paper_brokerage")
+
+
+class PriceFeed(abc.ABC):
+    @abc.abstractmethod
+    def tick(self, symbol: str, time: float) -> t.Optional[t.Tuple[float, int]]:
+        """the last price and the volume traded so far at time, or None if the
+        feed has no prices for symbol"""
+        raise NotImplemented
+
+
+class _RandomWalk:
+    def __init__(self, time: float, price: float, rng: random.Random) -> None:
+        self.time = time
+        self.price = price
+        self.volume = 0
+        self.rng = rng
+
+
+class SyntheticPriceFeed(PriceFeed):
+    """A geometric random walk per symbol, advanced to each requested time.
+
+    The same seed and sequence of requests always produces the same prices.
+    """
+
+    def __init__(
+        self, start_price: float, volatility: float, seed: t.Optional[int] = None
+    ) -> None:
+        self.start_price = start_price
+        self.volatility = volatility
+        self.seed = seed if seed is not None else secrets.randbits(32)
+        self._walks: t.Dict[str, _RandomWalk] = {}
+
+    def tick(self, symbol: str, time: float) -> t.Optional[t.Tuple[float, int]]:
+        walk = self._walks.get(symbol)
+        if walk is None:
+            rng = random.Random(f"{self.seed}-{symbol}")
+            price = self.start_price * (0.5 + rng.random())
+            walk = self._walks[symbol] = _RandomWalk(time, price, rng)
+        elapsed = time - walk.time
+        if elapsed > 0:
+            step = self.volatility * math.sqrt(elapsed) * walk.rng.gauss(0, 1)
+            walk.price *= math.exp(step)
+            walk.volume += int(walk.rng.expovariate(0.01) * elapsed)
+            walk.time = time
+        return round(walk.price, 2), walk.volume
+
+
+class ReplayPriceFeed(PriceFeed):
+    """Replays SYMBOL.csv bars from a directory, starting from the first bar at
+    start_time and holding the last close once the bars run out"""
+
+    def __init__(self, feed_dir: Path, start_time: float) -> None:
+        self.feed_dir = feed_dir
+        self.start_time = start_time
+        self._bars: t.Dict[str, t.Optional[t.Tuple[Bars, t.Any]]] = {}
+
+    def _load(self, symbol: str) -> t.Optional[t.Tuple[Bars, t.Any]]:
+        if symbol not in self._bars:
+            path = self.feed_dir / f"{symbol}.csv"
+            bars = load_bars(path) if path.exists() else None
+            self._bars[symbol] = (bars, np.cumsum(bars.volume)) if bars else None
+        return self._bars[symbol]
+
+    def tick(self, symbol: str, time: float) -> t.Optional[t.Tuple[float, int]]:
+        loaded = self._load(symbol)
+        if loaded is None or not len(loaded[0].times):
+            return None
+        bars, volumes = loaded
+        replay_time = bars.times[0] + time - self.start_time
+        i = max(int(np.searchsorted(bars.times, replay_time, side="right")) - 1, 0)
+        return float(bars.close[i]), int(volumes[i])
+
+
+class PaperExchange:
+    """The simulated market and account behind the paper brokerage services.
+
+    The sync and async services share one exchange, so orders placed through
+    either show up in the same positions.
+    """
+
+    def __init__(self, feed: PriceFeed, seed: t.Optional[int] = None) -> None:
+        self.feed = feed
+        self.cash = 0.0
+        self.positions: t.Dict[str, float] = {}
+        self.fills: t.List[Fill] = []
+        self._fills_by_client_order_id: t.Dict[str, Fill] = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: PaperBrokerageConfig) -> "PaperExchange":
+        feed: PriceFeed
+        if config.feed_dir is not None:
+            feed = ReplayPriceFeed(config.feed_dir, get_clock().time())
+        else:
+            feed = SyntheticPriceFeed(
+                config.start_price, config.volatility, config.seed
+            )
+        return cls(feed, config.seed)
+
+    def delay(self, config: PaperBrokerageConfig) -> float:
+        with self._lock:
+            return config.latency_seconds + config.latency_jitter_seconds * (
+                self._rng.random()
+            )
+
+    def check_failure(self, config: PaperBrokerageConfig, operation: str) -> None:
+        with self._lock:
+            failed = self._rng.random() < config.error_rate
+        if failed:
+            LOGGER.warning(f"Injected failure for {operation}")
+            raise RuntimeError(f"unexpected response for {operation}")
+
+    def issue_tokens(
+        self,
+        config: PaperBrokerageConfig,
+        old_tokens: t.Optional[AuthTokens] = None,
+        update_refresh_token: bool = True,
+    ) -> AuthTokens:
+        now = get_clock().now()
+        if old_tokens is None or update_refresh_token:
+            refresh_token = f"paper-refresh-{secrets.token_hex(8)}"
+            refresh_expiry = now + datetime.timedelta(
+                seconds=config.refresh_token_seconds
+            )
+        else:
+            refresh_token = old_tokens.refresh_token
+            refresh_expiry = old_tokens.refresh_expiry
+        return AuthTokens(
+            brokerage_id=BrokerageId.PAPER,
+            access_token=f"paper-access-{secrets.token_hex(8)}",
+            access_expiry=now + datetime.timedelta(seconds=config.access_token_seconds),
+            refresh_token=refresh_token,
+            refresh_expiry=refresh_expiry,
+        )
+
+    @staticmethod
+    def check_tokens(auth_tokens: AuthTokens) -> None:
+        if auth_tokens.access_expiry <= get_clock().now():
+            raise RuntimeError("unexpected response: access token expired")
+
+    def quotes(
+        self, config: PaperBrokerageConfig, symbols: t.Sequence[str]
+    ) -> t.Dict[str, Quote]:
+        now = get_clock().now()
+        quotes = {}
+        with self._lock:
+            for symbol in dict.fromkeys(symbols):
+                tick = self.feed.tick(symbol, now.timestamp())
+                if tick is None:
+                    continue
+                price, volume = tick
+                quotes[symbol] = Quote(
+                    symbol=symbol,
+                    last_price=price,
+                    bid_price=price - config.spread / 2,
+                    ask_price=price + config.spread / 2,
+                    volume=volume,
+                    quote_time=now,
+                )
+        return quotes
+
+    def fill(self, config: PaperBrokerageConfig, order: Order) -> Fill:
+        """fill a market order at the ask when buying and the bid when selling"""
+        if order.client_order_id is not None:
+            with self._lock:
+                previous = self._fills_by_client_order_id.get(order.client_order_id)
+            if previous is not None:
+                return previous
+        quote = self.quotes(config, [order.symbol]).get(order.symbol)
+        if quote is None:
+            raise RuntimeError(f"unexpected response: unknown symbol {order.symbol}")
+        buy = order.side == OrderSide.BUY
+        fill = Fill(
+            symbol=order.symbol,
+            side=order.side,
+            quantity=order.quantity,
+            price=quote.ask_price if buy else quote.bid_price,
+            fill_time=quote.quote_time,
+            commission=config.commission,
+            fill_id=f"paper-{secrets.token_hex(8)}",
+        )
+        quantity = order.quantity if buy else -order.quantity
+        with self._lock:
+            if order.client_order_id is not None:
+                previous = self._fills_by_client_order_id.setdefault(
+                    order.client_order_id, fill
+                )
+                if previous is not fill:
+                    return previous
+            self.positions[order.symbol] = (
+                self.positions.get(order.symbol, 0.0) + quantity
+            )
+            self.cash -= quantity * fill.price + fill.commission
+            self.fills.append(fill)
+        return fill
+
+    def fills_since(self, since: t.Optional[datetime.datetime]) -> t.List[Fill]:
+        with self._lock:
+            fills = list(self.fills)
+        return [fill for fill in fills if since is None or fill.fill_time >= since]
+
+
+_paper_exchange: t.Optional[PaperExchange] = None
+_paper_exchange_lock = threading.Lock()
+
+
+def paper_exchange() -> PaperExchange:
+    global _paper_exchange
+    with _paper_exchange_lock:
+        if _paper_exchange is None:
+            _paper_exchange = PaperExchange.from_config(_paper_config())
+        return _paper_exchange
+
+
+def reset_paper_exchange() -> None:
+    """start over with a new market and an empty account on next use"""
+    global _paper_exchange
+    with _paper_exchange_lock:
+        _paper_exchange = None
+
+
+def _paper_config() -> PaperBrokerageConfig:
+    return config_snapshot().brokerage_map[BrokerageId.PAPER].paper
+
+
+class _PaperBrokerageMixin(_BrokerageServiceBase):
+    brokerage_id = BrokerageId.PAPER
+    SUPPORTS_ORDERS = True
+
+    @property
+    def auth_uri(self) -> str:
+        # there is nothing to sign in to, so go straight back with a code
+        redirect_uri = config_snapshot().config.server.redirect_uri
+        return f"{redirect_uri}?code=paper&state={BrokerageId.PAPER.value}"
+
+
+class PaperBrokerageService(_PaperBrokerageMixin, BaseBrokerageService):
+    """A simulated brokerage with configurable latency and injected failures"""
+
+    def _simulate(self, operation: str) -> t.Tuple[PaperExchange, PaperBrokerageConfig]:
+        config = _paper_config()
+        exchange = paper_exchange()
+        get_clock().sleep_blocking(exchange.delay(config))
+        exchange.check_failure(config, operation)
+        return exchange, config
+
+    def get_access_tokens(self, access_code: str) -> AuthTokens:
+        exchange, config = self._simulate("post access token")
+        return exchange.issue_tokens(config)
+
+    def refresh_tokens(
+        self,
+        auth_tokens: AuthTokens,
+        update_refresh_token: bool = False,
+    ) -> AuthTokens:
+        exchange, config = self._simulate("post access token")
+        return exchange.issue_tokens(config, auth_tokens, update_refresh_token)
+
+    def get_quotes(
+        self, auth_tokens: AuthTokens, symbols: t.Sequence[str]
+    ) -> t.Dict[str, Quote]:
+        exchange, config = self._simulate("get quotes")
+        exchange.check_tokens(auth_tokens)
+        return exchange.quotes(config, symbols)
+
+    def place_order(self, auth_tokens: AuthTokens, order: Order) -> Fill:
+        exchange, config = self._simulate("post order")
+        exchange.check_tokens(auth_tokens)
+        return exchange.fill(config, order)
+
+    def get_fills(
+        self, auth_tokens: AuthTokens, since: t.Optional[datetime.datetime]
+    ) -> t.List[Fill]:
+        exchange, config = self._simulate("get fills")
+        exchange.check_tokens(auth_tokens)
+        return exchange.fills_since(since)
+
+
+class AsyncPaperBrokerageService(_PaperBrokerageMixin, AsyncBaseBrokerageService):
+    """A simulated brokerage with configurable latency and injected failures"""
+
+    async def _simulate(
+        self, operation: str
+    ) -> t.Tuple[PaperExchange, PaperBrokerageConfig]:
+        config = _paper_config()
+        exchange = paper_exchange()
+        await get_clock().sleep(exchange.delay(config))
+        exchange.check_failure(config, operation)
+        return exchange, config
+
+    async def get_access_tokens(self, access_code: str) -> AuthTokens:
+        exchange, config = await self._simulate("post access token")
+        return exchange.issue_tokens(config)
+
+    async def refresh_tokens(
+        self,
+        auth_tokens: AuthTokens,
+        update_refresh_token: bool = False,
+    ) -> AuthTokens:
+        exchange, config = await self._simulate("post access token")
+        return exchange.issue_tokens(config, auth_tokens, update_refresh_token)
+
+    async def get_quotes(
+        self, auth_tokens: AuthTokens, symbols: t.Sequence[str]
+    ) -> t.Dict[str, Quote]:
+        exchange, config = await self._simulate("get quotes")
+        exchange.check_tokens(auth_tokens)
+        return exchange.quotes(config, symbols)
+
+    async def place_order(self, auth_tokens: AuthTokens, order: Order) -> Fill:
+        exchange, config = await self._simulate("post order")
+        exchange.check_tokens(auth_tokens)
+        return exchange.fill(config, order)
+
+    async def get_fills(
+        self, auth_tokens: AuthTokens, since: t.Optional[datetime.datetime]
+    ) -> t.List[Fill]:
+        exchange, config = await self._simulate("get fills")
+        exchange.check_tokens(auth_tokens)
+        return exchange.fills_since(since)
@@ -0,0 +1,445 @@
+import asyncio
+import contextlib
+import datetime
+import logging
+import math
+import sqlite3
+import threading
+import typing as t
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from common.config import APP_NAME, GlobalConfig
+from common.metrics import Histogram
+from common.utils import run_blocking, wait_for_event
+from models.brokerage import BrokerageId
+from models.events import EventType
+from models.trading import Fill, OrderSide
+from services.authentication import AuthenticationService
+from services.brokerage import OrdersNotSupportedError, get_async_brokerage_service
+from services.events import event_broker
+
+LOGGER = logging.getLogger(f"{APP_NAME}.positions")
+
+POSITION_RECOVERY_SECONDS = Histogram(
+    "mark_trader_position_recovery_seconds",
+    "Loading the position snapshot and reconciling it with a brokerage, by step",
+    ["step"],
+)
+
+# fills are recorded as they arrive from several order workers, so they can land
+# out of order. reconciling starts this far before the newest recorded fill and
+# skips the fills already recorded
+RECONCILE_OVERLAP = datetime.timedelta(minutes=5)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fills (
+    brokerage TEXT NOT NULL,
+    fill_id TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    side TEXT NOT NULL,
+    quantity REAL NOT NULL,
+    price REAL NOT NULL,
+    commission REAL NOT NULL,
+    fill_time REAL NOT NULL,
+    PRIMARY KEY (brokerage, fill_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS positions (
+    brokerage TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    quantity REAL NOT NULL,
+    average_price REAL NOT NULL,
+    realized_pnl REAL NOT NULL,
+    PRIMARY KEY (brokerage, symbol)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS accounts (
+    brokerage TEXT PRIMARY KEY,
+    cash REAL NOT NULL,
+    last_fill_time REAL
+);
+"""
+
+
+class Position(t.NamedTuple):
+    symbol: str
+    quantity: float
+    average_price: float
+    # net of commissions, kept once the position is closed
+    realized_pnl: float
+
+    @property
+    def open(self) -> bool:
+        return self.quantity != 0
+
+
+def signed_quantity(fill: Fill) -> float:
+    return fill.quantity if fill.side == OrderSide.BUY else -fill.quantity
+
+
+class PositionChange(t.NamedTuple):
+    position: Position
+    # the signed quantity of the previous position the fill closed, 0 if none
+    closed: float
+    # profit on the closed quantity, before commissions
+    closed_pnl: float
+
+    @property
+    def reversed(self) -> bool:
+        """whether the fill closed the position and opened one the other way"""
+        return (
+            self.closed != 0
+            and self.position.open
+            and (
+                math.copysign(1, self.position.quantity)
+                != math.copysign(1, self.closed)
+            )
+        )
+
+
+def position_change(position: t.Optional[Position], fill: Fill) -> PositionChange:
+    """the position after fill, at its average entry price, and what it closed.
+    live positions and backtests both apply fills with this"""
+    if position is None:
+        position = Position(fill.symbol, 0.0, 0.0, 0.0)
+    quantity, price = signed_quantity(fill), fill.price
+    held = position.quantity
+    realized = position.realized_pnl - fill.commission
+
+    if held == 0 or math.copysign(1, held) == math.copysign(1, quantity):
+        total = held + quantity
+        average = (position.average_price * held + price * quantity) / total
+        return PositionChange(Position(fill.symbol, total, average, realized), 0.0, 0.0)
+
+    closed = math.copysign(min(abs(quantity), abs(held)), held)
+    closed_pnl = closed * (price - position.average_price)
+    realized += closed_pnl
+    remaining = held + quantity
+    if math.isclose(remaining, 0, abs_tol=1e-9):
+        after = Position(fill.symbol, 0.0, 0.0, realized)
+    elif math.copysign(1, remaining) == math.copysign(1, held):
+        after = Position(fill.symbol, remaining, position.average_price, realized)
+    else:
+        after = Position(fill.symbol, remaining, price, realized)
+    return PositionChange(after, closed, closed_pnl)
+
+
+def apply_fill(position: t.Optional[Position], fill: Fill) -> Position:
+    """the position after fill, at its average entry price"""
+    return position_change(position, fill).position
+
+
+def fill_key(fill: Fill) -> str:
+    """the fill's brokerage ID. two fills can match in every other field, so
+    fills without one can't be told apart from a fill recorded twice"""
+    if fill.fill_id is None:
+        raise ValueError(f"{fill.symbol} fill at {fill.fill_time} has no fill ID")
+    return fill.fill_id
+
+
+class Portfolio:
+    """The positions and cash of one brokerage account"""
+
+    def __init__(self) -> None:
+        self.cash = 0.0
+        self.last_fill_time: t.Optional[float] = None
+        # every symbol ever traded, closed positions keep their realized pnl
+        self.symbols: t.Dict[str, Position] = {}
+
+    @property
+    def positions(self) -> t.Dict[str, Position]:
+        """open positions by symbol"""
+        return {s: p for s, p in self.symbols.items() if p.open}
+
+    def position(self, symbol: str) -> float:
+        position = self.symbols.get(symbol)
+        return position.quantity if position else 0.0
+
+    def apply(self, fill: Fill) -> Position:
+        position = self.symbols[fill.symbol] = apply_fill(
+            self.symbols.get(fill.symbol), fill
+        )
+        self.cash -= signed_quantity(fill) * fill.price + fill.commission
+        fill_time = fill.fill_time.timestamp()
+        self.last_fill_time = max(self.last_fill_time or fill_time, fill_time)
+        return position
+
+
+class PositionStore:
+    """Positions, cash and fills per brokerage, in SQLite with an in-memory view.
+
+    Each fill is journaled and the position it changes is rewritten in the
+    same transaction, so the positions table is always a snapshot of every fill
+    so far. Loading it costs one row per symbol however long the history, and
+    the fill journal is only read to skip fills that were already recorded.
+
+    The database runs in WAL mode, so worker processes can share it. A worker
+    reloads its view when PRAGMA data_version says another one has written.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # with WAL, commits survive an app crash without waiting on fsync
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+        self._lock = threading.RLock()
+        self._portfolios: t.Dict[BrokerageId, Portfolio] = {}
+        self._data_version = -1
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _current_data_version(self) -> int:
+        return int(self._connection.execute("PRAGMA data_version").fetchone()[0])
+
+    def load(self) -> None:
+        """replace the in-memory view with the snapshot in the database"""
+        with self._lock, POSITION_RECOVERY_SECONDS.labels("load").time():
+            portfolios: t.Dict[BrokerageId, Portfolio] = {}
+            for brokerage, cash, last_fill_time in self._connection.execute(
+                "SELECT brokerage, cash, last_fill_time FROM accounts"
+            ):
+                portfolio = portfolios[BrokerageId(brokerage)] = Portfolio()
+                portfolio.cash = cash
+                portfolio.last_fill_time = last_fill_time
+            for (
+                brokerage,
+                symbol,
+                quantity,
+                average_price,
+                realized_pnl,
+            ) in self._connection.execute(
+                "SELECT brokerage, symbol, quantity, average_price, realized_pnl"
+                " FROM positions"
+            ):
+                portfolio = portfolios.setdefault(BrokerageId(brokerage), Portfolio())
+                portfolio.symbols[symbol] = Position(
+                    symbol, quantity, average_price, realized_pnl
+                )
+            self._portfolios = portfolios
+            self._data_version = self._current_data_version()
+
+    def _refresh(self) -> None:
+        if self._current_data_version() != self._data_version:
+            self.load()
+
+    def portfolio(self, brokerage_id: BrokerageId) -> Portfolio:
+        with self._lock:
+            self._refresh()
+            return self._portfolios.setdefault(brokerage_id, Portfolio())
+
+    def record_fills(
+        self, brokerage_id: BrokerageId, fills: t.Iterable[Fill]
+    ) -> t.List[Fill]:
+        """apply and persist fills in one transaction, returning the ones that
+        weren't recorded before"""
+        with self._lock:
+            cursor = self._connection.cursor()
+            try:
+                # take the write lock first so the view can't miss another
+                # worker's fills between loading it and writing
+                cursor.execute("BEGIN IMMEDIATE")
+                self._refresh()
+                portfolio = self._portfolios.setdefault(brokerage_id, Portfolio())
+                previous = (
+                    portfolio.cash,
+                    portfolio.last_fill_time,
+                    dict(portfolio.symbols),
+                )
+            except BaseException:
+                if self._connection.in_transaction:
+                    cursor.execute("ROLLBACK")
+                cursor.close()
+                raise
+            recorded = []
+            try:
+                for fill in fills:
+                    cursor.execute(
+                        "INSERT OR IGNORE INTO fills VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            brokerage_id.value,
+                            fill_key(fill),
+                            fill.symbol,
+                            fill.side.value,
+                            fill.quantity,
+                            fill.price,
+                            fill.commission,
+                            fill.fill_time.timestamp(),
+                        ),
+                    )
+                    if cursor.rowcount == 0:
+                        continue
+                    position = portfolio.apply(fill)
+                    cursor.execute(
+                        "INSERT OR REPLACE INTO positions VALUES (?, ?, ?, ?, ?)",
+                        (brokerage_id.value, *position),
+                    )
+                    recorded.append(fill)
+                if recorded:
+                    cursor.execute(
+                        "INSERT OR REPLACE INTO accounts VALUES (?, ?, ?)",
+                        (brokerage_id.value, portfolio.cash, portfolio.last_fill_time),
+                    )
+                cursor.execute("COMMIT")
+            except BaseException:
+                if self._connection.in_transaction:
+                    cursor.execute("ROLLBACK")
+                portfolio.cash, portfolio.last_fill_time, portfolio.symbols = previous
+                raise
+            finally:
+                cursor.close()
+            # our own commit changes nothing for data_version, other connections' do
+            return recorded
+
+    def record_fill(self, brokerage_id: BrokerageId, fill: Fill) -> bool:
+        return bool(self.record_fills(brokerage_id, [fill]))
+
+    def reconcile_since(
+        self, brokerage_id: BrokerageId
+    ) -> t.Optional[datetime.datetime]:
+        """when the delta query for brokerage_id should start, None for everything"""
+        last_fill_time = self.portfolio(brokerage_id).last_fill_time
+        if last_fill_time is None:
+            return None
+        return datetime.datetime.fromtimestamp(last_fill_time) - RECONCILE_OVERLAP
+
+
+_position_store: t.Optional[PositionStore] = None
+_position_store_lock = threading.Lock()
+
+
+def position_store() -> PositionStore:
+    global _position_store
+    path = GlobalConfig().data_dir / "positions.db"
+    with _position_store_lock:
+        if _position_store is None or _position_store.path != path:
+            if _position_store is not None:
+                _position_store.close()
+            _position_store = PositionStore(path)
+            _position_store.load()
+        return _position_store
+
+
+class PositionTracker:
+    """Recovers positions: at startup the stored snapshot is loaded, then each
+    signed in brokerage is asked for the fills since the newest one recorded.
+    Signing in here, or another worker signing in to a brokerage this one had
+    no session with, reconciles again, since fills may have been placed
+    elsewhere while signed out. Token refreshes don't. The order pipeline
+    records fills as they happen in between."""
+
+    def __init__(self, system: str = "MARK_TRADER") -> None:
+        self._auth_service = AuthenticationService(system)
+        self._task: t.Optional[asyncio.Task[None]] = None
+        self._loop: t.Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: t.Optional[asyncio.Event] = None
+        self._unlisten: t.Optional[t.Callable[[], None]] = None
+        # whether a sign in here asked for every session to be reconciled
+        self._signed_in = False
+        # the sessions at the last reconcile
+        self._brokerages: t.FrozenSet[BrokerageId] = frozenset()
+        self.recovered = asyncio.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self.recovered = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        # other workers' sign ins, and their token refreshes, reach this one as
+        # auth events
+        self._unlisten = event_broker.listen(
+            self._on_auth_event, [EventType.SIGN_IN, EventType.AUTH]
+        )
+        self._task = self._loop.create_task(self._run(), name="POSITION_RECOVERY")
+
+    async def stop(self) -> None:
+        if self._unlisten is not None:
+            self._unlisten()
+            self._unlisten = None
+        task, self._task, self._loop = self._task, None, None
+        if task is not None:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    def _on_auth_event(self, event_type: EventType, status: BaseModel) -> None:
+        loop, wakeup = self._loop, self._wakeup
+        if loop is None or wakeup is None or loop.is_closed():
+            return
+        set_wakeup = wakeup.set
+
+        def wake() -> None:
+            if event_type == EventType.SIGN_IN:
+                self._signed_in = True
+            set_wakeup()
+
+        loop.call_soon_threadsafe(wake)
+
+    async def reconcile(self, brokerage_id: BrokerageId) -> t.List[Fill]:
+        """record the fills the brokerage has that the store doesn't"""
+        auth_tokens = (await self._auth_service.get_sessions_async()).get(brokerage_id)
+        if auth_tokens is None:
+            raise RuntimeError(f"not signed in to {brokerage_id}")
+        brokerage = get_async_brokerage_service(brokerage_id)
+        if not brokerage.SUPPORTS_ORDERS:
+            raise OrdersNotSupportedError(f"{brokerage_id} does not support orders")
+        store = await run_blocking(position_store)
+        since = store.reconcile_since(brokerage_id)
+        with POSITION_RECOVERY_SECONDS.labels("delta_query").time():
+            fills = await brokerage.get_fills(auth_tokens, since)
+        with POSITION_RECOVERY_SECONDS.labels("apply").time():
+            return await run_blocking(store.record_fills, brokerage_id, fills)
+
+    async def _reconcile_sessions(self, all_sessions: bool = True) -> None:
+        """reconcile every signed in brokerage, or only those signed in since
+        the last reconcile"""
+        sessions = frozenset(await self._auth_service.get_sessions_async())
+        brokerages = sessions if all_sessions else sessions - self._brokerages
+        self._brokerages = sessions
+        for brokerage_id in sorted(brokerages, key=list(BrokerageId).index):
+            if not get_async_brokerage_service(brokerage_id).SUPPORTS_ORDERS:
+                LOGGER.info(
+                    f"Brokerage {brokerage_id}: reconciling positions is unsupported",
+                    extra={"brokerage_id": brokerage_id},
+                )
+                continue
+            try:
+                missed = await self.reconcile(brokerage_id)
+            except Exception:
+                LOGGER.exception(
+                    f"Brokerage {brokerage_id}: failed to reconcile positions",
+                    extra={"brokerage_id": brokerage_id},
+                )
+                continue
+            LOGGER.info(
+                f"Brokerage {brokerage_id}: reconciled positions, "
+                f"{len(missed)} fills missed",
+                extra={"brokerage_id": brokerage_id},
+            )
+
+    async def _run(self) -> None:
+        assert self._wakeup is not None
+        try:
+            await run_blocking(position_store)
+            await self._reconcile_sessions()
+        finally:
+            self.recovered.set()
+        while True:
+            await wait_for_event(self._wakeup, None)
+            self._wakeup.clear()
+            signed_in, self._signed_in = self._signed_in, False
+            await self._reconcile_sessions(all_sessions=signed_in)
+
+
+position_tracker = PositionTracker()
@@ -0,0 +1,151 @@
+"""Stack sampling profiles of individual API requests.
+
+Profiles are saved in the collapsed stack format, one ``frame;frame;frame count``
+line per distinct stack, which flamegraph.pl, speedscope and inferno read
+directly. Only the newest profiles are kept.
+"""
+import collections
+import functools
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import typing as t
+import uuid
+from pathlib import Path
+from types import CodeType
+
+from common.config import APP_NAME, GlobalConfig
+from common.utils import atomic_write
+from models.profiling import ProfileInfo
+
+LOGGER = logging.getLogger(f"{APP_NAME}.profiling")
+
+_PROFILE_ID = re.compile(r"[0-9]+-[0-9a-f]+")
+
+
+@functools.lru_cache(maxsize=4096)
+def _frame_label(code: CodeType) -> str:
+    filename = code.co_filename
+    if filename.startswith(os.getcwd()):
+        filename = os.path.relpath(filename)
+    else:
+        filename = os.path.join(*Path(filename).parts[-2:])
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ",")
+
+
+class StackSampler:
+    """Counts the Python stacks of the selected threads every interval_seconds,
+    from a background thread, until stopped or for at most max_seconds"""
+
+    def __init__(
+        self,
+        threads: t.Callable[[], t.Iterable[threading.Thread]],
+        interval_seconds: float,
+        max_seconds: t.Optional[float] = None,
+    ) -> None:
+        self.interval_seconds = interval_seconds
+        self.max_seconds = max_seconds
+        self.stacks: t.Counter[str] = collections.Counter()
+        self._threads = threads
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="stack-sampler", daemon=True
+        )
+
+    @property
+    def samples(self) -> int:
+        return sum(self.stacks.values())
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> t.Counter[str]:
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self) -> None:
+        deadline = (
+            time.monotonic() + self.max_seconds
+            if self.max_seconds is not None
+            else None
+        )
+        while not self._stop.wait(self.interval_seconds):
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+            self.sample()
+
+    def sample(self) -> None:
+        frames = sys._current_frames()
+        for thread in self._threads():
+            frame = frames.get(thread.ident) if thread.ident is not None else None
+            # idle pool workers wait for work in concurrent.futures' _worker
+            if frame is None or frame.f_code.co_name == "_worker":
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            stack.append(thread.name)
+            self.stacks[";".join(reversed(stack))] += 1
+
+
+def collapsed_stacks(stacks: t.Mapping[str, int]) -> bytes:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.items()).encode()
+
+
+class ProfileStore:
+    """Keeps the newest max_profiles profiles in a directory, as a collapsed
+    stack file and a JSON description per profile"""
+
+    def __init__(self, directory: Path, max_profiles: int) -> None:
+        self.directory = directory
+        self.max_profiles = max_profiles
+
+    @staticmethod
+    def new_id() -> str:
+        # sorts by creation time
+        return f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+
+    def save(self, info: ProfileInfo, stacks: t.Mapping[str, int]) -> None:
+        atomic_write(self.directory / f"{info.id}.folded", collapsed_stacks(stacks))
+        atomic_write(self.directory / f"{info.id}.json", info.json().encode())
+        self._prune()
+
+    def _ids(self) -> t.List[str]:
+        return sorted(path.stem for path in self.directory.glob("*.json"))
+
+    def _prune(self) -> None:
+        ids = self._ids()
+        for profile_id in ids[: max(len(ids) - self.max_profiles, 0)]:
+            for suffix in (".json", ".folded"):
+                (self.directory / f"{profile_id}{suffix}").unlink(missing_ok=True)
+
+    def list(self) -> t.List[ProfileInfo]:
+        """the stored profiles, newest first"""
+        profiles = []
+        for profile_id in reversed(self._ids()):
+            try:
+                profiles.append(
+                    ProfileInfo.parse_file(self.directory / f"{profile_id}.json")
+                )
+            except FileNotFoundError:
+                continue
+        return profiles
+
+    def read(self, profile_id: str) -> t.Optional[bytes]:
+        """the collapsed stacks of a profile, or None if there is no such profile"""
+        if not _PROFILE_ID.fullmatch(profile_id):
+            return None
+        try:
+            return (self.directory / f"{profile_id}.folded").read_bytes()
+        except FileNotFoundError:
+            return None
+
+
+def profile_store() -> ProfileStore:
+    config = GlobalConfig()
+    return ProfileStore(config.data_dir / "profiles", config.profiling.max_profiles)
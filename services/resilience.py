@@ -0,0 +1,190 @@
+import enum
+import logging
+import random
+import threading
+import typing as t
+
+import httpx
+
+from common.config import APP_NAME, CircuitBreakerConfig, RetryConfig
+from common.metrics import Counter, Gauge
+from common.utils import get_clock
+from models.brokerage import BrokerageId
+
+LOGGER = logging.getLogger(f"{APP_NAME}.resilience")
+
+BROKERAGE_RETRIES = Counter(
+    "mark_trader_brokerage_retries_total",
+    "Brokerage requests retried after a failure, by endpoint",
+    ["brokerage", "endpoint"],
+)
+CIRCUIT_BREAKER_STATE = Gauge(
+    "mark_trader_circuit_breaker_state",
+    "Brokerage endpoint circuit breakers: 0 closed, 1 half open, 2 open",
+    ["brokerage", "endpoint"],
+)
+CIRCUIT_BREAKER_REJECTIONS = Counter(
+    "mark_trader_circuit_breaker_rejections_total",
+    "Brokerage requests failed fast by an open circuit breaker",
+    ["brokerage", "endpoint"],
+)
+
+# the request never reached the brokerage, so even a non idempotent call can go again
+_UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+def retryable_status(status_code: int) -> bool:
+    """statuses that say the brokerage is down or overloaded, not that the call was bad"""
+    return status_code == 429 or status_code >= 500
+
+
+def retryable_error(error: Exception, idempotent: bool) -> bool:
+    if not isinstance(error, httpx.TransportError):
+        return False
+    return idempotent or isinstance(error, _UNSENT_ERRORS)
+
+
+def can_retry(config: RetryConfig, attempt: int, breaker: "CircuitBreaker") -> bool:
+    """whether attempt, counting from 0, may be followed by another. not once
+    the failures have opened the breaker"""
+    return attempt + 1 < config.max_attempts and breaker.state is not BreakerState.OPEN
+
+
+def backoff_delay(
+    config: RetryConfig,
+    attempt: int,
+    retry_after: t.Optional[float] = None,
+    rng: t.Optional[random.Random] = None,
+) -> float:
+    """seconds to wait before retry number attempt, counting from 0. random
+    between 0 and an exponentially growing cap, so clients that failed together
+    don't retry together. a Retry-After from the brokerage is a lower bound"""
+    cap = min(config.max_delay_seconds, config.base_delay_seconds * 2**attempt)
+    delay = (rng or random).uniform(0, cap)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, config.max_delay_seconds))
+    return delay
+
+
+def retry_after_seconds(response: httpx.Response) -> t.Optional[float]:
+    try:
+        return float(response.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+class BreakerState(enum.Enum):
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+
+class CircuitBreaker:
+    """Fails calls to one brokerage endpoint fast while it is down.
+
+    After failure_threshold failures in a row the breaker opens and rejects
+    calls. Once reset_timeout_seconds pass it lets one trial call through: a
+    success closes it, a failure opens it for another timeout. Shared by the
+    sync and async services and safe to use from any thread.
+    """
+
+    def __init__(self, brokerage_id: BrokerageId, endpoint: str) -> None:
+        self.brokerage_id = brokerage_id
+        self.endpoint = endpoint
+        self.config = CircuitBreakerConfig()
+        self._state = BreakerState.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        self._gauge = CIRCUIT_BREAKER_STATE.labels(brokerage_id, endpoint)
+        self._gauge.set(BreakerState.CLOSED.value)
+
+    @property
+    def state(self) -> BreakerState:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> BreakerState:
+        if self._state is BreakerState.OPEN and (
+            get_clock().time() - self._opened_at >= self.config.reset_timeout_seconds
+        ):
+            self._set_state(BreakerState.HALF_OPEN)
+        return self._state
+
+    def _set_state(self, state: BreakerState) -> None:
+        if state is not self._state:
+            LOGGER.warning(
+                f"Brokerage {self.brokerage_id}: {self.endpoint} circuit {state.name.lower()}",
+                extra={"brokerage_id": self.brokerage_id},
+            )
+        self._state = state
+        self._gauge.set(state.value)
+
+    def before_call(self) -> None:
+        """raise CircuitOpenError if the call should fail fast"""
+        with self._lock:
+            state = self._current_state()
+            if state is BreakerState.CLOSED:
+                return
+            if state is BreakerState.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+        CIRCUIT_BREAKER_REJECTIONS.labels(self.brokerage_id, self.endpoint).inc()
+        raise CircuitOpenError(
+            f"{self.brokerage_id.value} {self.endpoint} circuit is open, not calling"
+        )
+
+    def abandon(self) -> None:
+        """the call ended without saying whether the endpoint is up, e.g. it was
+        cancelled. lets another trial call through"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._trial_in_flight = False
+            self._set_state(BreakerState.CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if (
+                self._state is BreakerState.HALF_OPEN
+                or self._failures >= self.config.failure_threshold
+            ):
+                self._opened_at = get_clock().time()
+                self._set_state(BreakerState.OPEN)
+
+
+_circuit_breakers: t.Dict[t.Tuple[BrokerageId, str], CircuitBreaker] = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(
+    brokerage_id: BrokerageId, endpoint: str, config: CircuitBreakerConfig
+) -> CircuitBreaker:
+    """the process wide breaker for an endpoint, following config as it is reloaded"""
+    key = (brokerage_id, endpoint)
+    breaker = _circuit_breakers.get(key)
+    if breaker is None:
+        with _circuit_breakers_lock:
+            breaker = _circuit_breakers.get(key)
+            if breaker is None:
+                breaker = _circuit_breakers[key] = CircuitBreaker(
+                    brokerage_id, endpoint
+                )
+    breaker.config = config
+    return breaker
+
+
+def reset_circuit_breakers() -> None:
+    with _circuit_breakers_lock:
+        for breaker in _circuit_breakers.values():
+            breaker.record_success()
@@ -0,0 +1,185 @@
+import abc
+import datetime
+import logging
+import typing as t
+
+import numpy as np
+
+from common.config import APP_NAME
+from models.trading import Fill, Order, OrderSide, Trade
+from services.indicators import EMA, FloatArray, IndicatorSet
+from services.journal import TradeJournal
+from services.positions import Position, position_change
+
+LOGGER = logging.getLogger(f"{APP_NAME}.strategy")
+
+
+class MarketSnapshot(t.NamedTuple):
+    """one tick for every symbol. prices are NaN for symbols without a tick"""
+
+    time: datetime.datetime
+    symbols: t.List[str]
+    prices: FloatArray
+    volumes: FloatArray
+
+
+class Strategy(abc.ABC):
+    def set_symbols(self, symbols: t.List[str]) -> None:
+        """called before the first snapshot and whenever the symbols change"""
+
+    @abc.abstractmethod
+    def signals(self, snapshot: MarketSnapshot) -> FloatArray:
+        """the direction to hold per symbol: 1 long, -1 short, 0 flat,
+        NaN to leave the position as it is"""
+        raise NotImplemented
+
+
+class MovingAverageCrossover(Strategy):
+    """long while the fast EMA is above the slow EMA, flat otherwise"""
+
+    def __init__(self, fast: int = 10, slow: int = 30) -> None:
+        if fast >= slow:
+            raise ValueError("fast period must be shorter than slow period")
+        self.indicators = IndicatorSet({"fast": EMA(fast), "slow": EMA(slow)})
+        self._slow_period = slow
+        self._ticks = np.zeros(0, dtype=np.int64)
+
+    def set_symbols(self, symbols: t.List[str]) -> None:
+        old = dict(zip(self.indicators.symbols, self._ticks))
+        self.indicators.set_symbols(symbols)
+        self._ticks = np.array([old.get(s, 0) for s in symbols], dtype=np.int64)
+
+    def signals(self, snapshot: MarketSnapshot) -> FloatArray:
+        self.indicators.update(snapshot.prices, snapshot.volumes)
+        self._ticks += ~np.isnan(snapshot.prices)
+        fast = self.indicators.indicators["fast"].value
+        slow = self.indicators.indicators["slow"].value
+        return np.where(
+            self._ticks >= self._slow_period, (fast > slow).astype(np.float64), np.nan
+        )
+
+
+class _OpenPosition:
+    def __init__(self, position: Position, time: datetime.datetime):
+        self.position = position
+        self.entry_time = time
+        # paid since the position was opened or last partly closed
+        self.commission = 0.0
+
+
+class TradingSession:
+    """Turns strategy signals into orders and fills into positions and trades.
+
+    Only the backtester drives a session so far, without a journal. A live
+    trading loop would drive one the same way. position_size is the amount of
+    money put into each new position. With a journal, signals that change a
+    position are recorded in it.
+    """
+
+    def __init__(
+        self,
+        strategy: Strategy,
+        position_size: float,
+        end_of_day_exit: bool = False,
+        journal: t.Optional[TradeJournal] = None,
+    ) -> None:
+        self.strategy = strategy
+        self.position_size = position_size
+        self.end_of_day_exit = end_of_day_exit
+        self.journal = journal
+        self.realized_pnl = 0.0
+        self.trades: t.List[Trade] = []
+        self._positions: t.Dict[str, _OpenPosition] = {}
+
+    def position(self, symbol: str) -> float:
+        position = self._positions.get(symbol)
+        return position.position.quantity if position else 0.0
+
+    def unrealized_pnl(self, prices: t.Mapping[str, float]) -> float:
+        return sum(
+            position.position.quantity
+            * (prices[symbol] - position.position.average_price)
+            for symbol, position in self._positions.items()
+            if symbol in prices
+        )
+
+    def exit_orders(self) -> t.List[Order]:
+        return [
+            self._order(symbol, -position.position.quantity, is_exit=True)
+            for symbol, position in self._positions.items()
+        ]
+
+    def step(self, snapshot: MarketSnapshot, end_of_day: bool = False) -> t.List[Order]:
+        """the orders to place for a snapshot. on the last tick of the day with
+        end_of_day_exit set, every open position is closed instead"""
+        # the strategy sees every tick, so its indicators don't skip the day's last
+        wanted = np.sign(self.strategy.signals(snapshot))
+        if end_of_day and self.end_of_day_exit:
+            return self.exit_orders()
+
+        held = np.sign([self.position(symbol) for symbol in snapshot.symbols])
+        changed = np.flatnonzero(
+            ~np.isnan(wanted) & ~np.isnan(snapshot.prices) & (wanted != held)
+        )
+        orders = []
+        for i in changed:
+            symbol = snapshot.symbols[i]
+            if self.journal is not None:
+                self.journal.record_signal(
+                    symbol, float(wanted[i]), float(snapshot.prices[i]), snapshot.time
+                )
+            current = self.position(symbol)
+            if current:
+                orders.append(self._order(symbol, -current, is_exit=True))
+            if wanted[i]:
+                quantity = wanted[i] * self.position_size / snapshot.prices[i]
+                orders.append(self._order(symbol, quantity))
+        return orders
+
+    @staticmethod
+    def _order(symbol: str, quantity: float, is_exit: bool = False) -> Order:
+        return Order(
+            symbol=symbol,
+            side=OrderSide.BUY if quantity > 0 else OrderSide.SELL,
+            quantity=abs(quantity),
+            is_exit=is_exit,
+        )
+
+    def apply_fill(self, fill: Fill) -> t.Optional[Trade]:
+        """update the position, returning the trade if the fill closed one"""
+        self.realized_pnl -= fill.commission
+        position = self._positions.get(fill.symbol)
+        change = position_change(position.position if position else None, fill)
+
+        if not change.closed:
+            if position is None:
+                position = self._positions[fill.symbol] = _OpenPosition(
+                    change.position, fill.fill_time
+                )
+            position.position = change.position
+            position.commission += fill.commission
+            return None
+
+        assert position is not None
+        self.realized_pnl += change.closed_pnl
+        trade = Trade(
+            symbol=fill.symbol,
+            quantity=change.closed,
+            entry_time=position.entry_time,
+            entry_price=position.position.average_price,
+            exit_time=fill.fill_time,
+            exit_price=fill.price,
+            pnl=change.closed_pnl - position.commission - fill.commission,
+        )
+        self.trades.append(trade)
+
+        if not change.position.open:
+            del self._positions[fill.symbol]
+        elif change.reversed:
+            self._positions[fill.symbol] = _OpenPosition(
+                change.position, fill.fill_time
+            )
+        else:
+            position.position = change.position
+            position.commission = 0.0
+        return trade
@@ -0,0 +1,194 @@
+import abc
+import json
+import logging
+import threading
+import typing as t
+from abc import ABC
+from pathlib import Path
+
+import keyring
+from cryptography.fernet import Fernet, InvalidToken
+
+from common.config import APP_NAME, ConfigSnapshot, config_snapshot
+from common.metrics import Histogram
+from common.utils import FileLock, atomic_write
+from models.authentication import AuthTokens, TokenStoreType
+from models.brokerage import BrokerageId
+
+LOGGER = logging.getLogger(f"{APP_NAME}.token_store")
+
+KEYRING_SECONDS = Histogram(
+    "mark_trader_keyring_seconds", "Keyring calls by operation", ["operation"]
+)
+
+
+def _get_password(system: str, key: str) -> t.Optional[str]:
+    with KEYRING_SECONDS.labels("get").time():
+        return keyring.get_password(system, key)
+
+
+def _set_password(system: str, key: str, value: str) -> None:
+    with KEYRING_SECONDS.labels("set").time():
+        keyring.set_password(system, key, value)
+
+
+def _delete_password(system: str, key: str) -> None:
+    with KEYRING_SECONDS.labels("delete").time():
+        keyring.delete_password(system, key)
+
+
+class BaseTokenStore(ABC):
+    """Persists one serialized AuthTokens record per brokerage.
+
+    Every operation is a single read, write or delete against the backend, so a
+    reader never sees a partially written set of tokens.
+    """
+
+    @abc.abstractmethod
+    def get(self, brokerage_id: BrokerageId) -> t.Optional[AuthTokens]:
+        raise NotImplemented
+
+    @abc.abstractmethod
+    def set(self, auth_tokens: AuthTokens) -> None:
+        raise NotImplemented
+
+    @abc.abstractmethod
+    def delete(self, brokerage_id: BrokerageId) -> None:
+        raise NotImplemented
+
+
+class KeyringTokenStore(BaseTokenStore):
+    _TOKENS_KEY_PREFIX = "TOKENS"
+
+    def __init__(self, system: str) -> None:
+        self._system = system
+
+    def _key(self, brokerage_id: BrokerageId) -> str:
+        return f"{self._TOKENS_KEY_PREFIX}_{brokerage_id.value}"
+
+    def get(self, brokerage_id: BrokerageId) -> t.Optional[AuthTokens]:
+        record = _get_password(self._system, self._key(brokerage_id))
+        return AuthTokens.parse_raw(record) if record is not None else None
+
+    def set(self, auth_tokens: AuthTokens) -> None:
+        _set_password(
+            self._system, self._key(auth_tokens.brokerage_id), auth_tokens.json()
+        )
+
+    def delete(self, brokerage_id: BrokerageId) -> None:
+        if _get_password(self._system, self._key(brokerage_id)) is not None:
+            _delete_password(self._system, self._key(brokerage_id))
+
+
+class TokenFileError(RuntimeError):
+    """the token file can't be decrypted with the key in the keyring"""
+
+
+class EncryptedFileTokenStore(BaseTokenStore):
+    """Keeps every brokerage's tokens in one Fernet encrypted file.
+
+    The encryption key lives in the keyring and is read once per store. Writes
+    replace the file atomically, under a lock file shared by every process, so
+    concurrent updates for different brokerages don't drop each other. The key
+    is created under the same lock, so processes starting together agree on it.
+    A file that can't be decrypted reads as empty but is never overwritten.
+    """
+
+    _FILE_KEY = "TOKEN_FILE_KEY"
+
+    def __init__(self, system: str, path: Path) -> None:
+        self._system = system
+        self._path = path
+        self._lock_path = path.with_name(f"{path.name}.lock")
+        self._fernet: t.Optional[Fernet] = None
+
+    def _load_fernet(self) -> Fernet:
+        """the file key, created if the keyring has none. call holding the lock"""
+        if self._fernet is None:
+            key = _get_password(self._system, self._FILE_KEY)
+            if key is None:
+                key = Fernet.generate_key().decode()
+                _set_password(self._system, self._FILE_KEY, key)
+            self._fernet = Fernet(key.encode())
+        return self._fernet
+
+    @property
+    def fernet(self) -> Fernet:
+        if self._fernet is None:
+            with FileLock(self._lock_path):
+                return self._load_fernet()
+        return self._fernet
+
+    def _read_records(self) -> t.Dict[str, str]:
+        try:
+            encrypted = self._path.read_bytes()
+        except FileNotFoundError:
+            return {}
+        try:
+            records: t.Dict[str, str] = json.loads(self.fernet.decrypt(encrypted))
+        except InvalidToken as e:
+            raise TokenFileError(f"Unable to decrypt token file {self._path}") from e
+        return records
+
+    def _write_records(self, records: t.Dict[str, str]) -> None:
+        atomic_write(self._path, self.fernet.encrypt(json.dumps(records).encode()))
+
+    def get(self, brokerage_id: BrokerageId) -> t.Optional[AuthTokens]:
+        try:
+            record = self._read_records().get(brokerage_id.value)
+        except TokenFileError as e:
+            LOGGER.error(f"{e}, ignoring it")
+            return None
+        return AuthTokens.parse_raw(record) if record is not None else None
+
+    def set(self, auth_tokens: AuthTokens) -> None:
+        with FileLock(self._lock_path):
+            self._load_fernet()
+            records = self._read_records()
+            records[auth_tokens.brokerage_id.value] = auth_tokens.json()
+            self._write_records(records)
+
+    def delete(self, brokerage_id: BrokerageId) -> None:
+        with FileLock(self._lock_path):
+            self._load_fernet()
+            records = self._read_records()
+            if records.pop(brokerage_id.value, None) is not None:
+                self._write_records(records)
+
+
+_TokenStoreKey = t.Tuple[str, TokenStoreType, Path]
+
+_token_stores: t.Dict[_TokenStoreKey, BaseTokenStore] = {}
+_token_stores_snapshot: t.Optional[ConfigSnapshot] = None
+_token_stores_lock = threading.Lock()
+
+
+def _new_token_store(
+    system: str, store_type: TokenStoreType, path: Path
+) -> BaseTokenStore:
+    if store_type == TokenStoreType.KEYRING:
+        return KeyringTokenStore(system)
+    if store_type == TokenStoreType.ENCRYPTED_FILE:
+        return EncryptedFileTokenStore(system, path)
+    raise ValueError(f"unrecognized token store {store_type}")
+
+
+def get_token_store(system: str) -> BaseTokenStore:
+    """the store for system, kept until the config changes so the file key is
+    read from the keyring once"""
+    global _token_stores_snapshot
+    snapshot = config_snapshot()
+    config = snapshot.config
+    key = (
+        system,
+        config.authentication.token_store,
+        config.data_dir / f"{system}.tokens",
+    )
+    with _token_stores_lock:
+        if snapshot is not _token_stores_snapshot:
+            _token_stores.clear()
+            _token_stores_snapshot = snapshot
+        store = _token_stores.get(key)
+        if store is None:
+            store = _token_stores[key] = _new_token_store(*key)
+        return store
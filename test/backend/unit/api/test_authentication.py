@@ -1,7 +1,12 @@
+import datetime
+
 import pytest
-from mock.mock import patch
+from confz import ConfZDataSource
+from mock.mock import PropertyMock, patch
 
 from common.config import GlobalConfig
+from models.authentication import AuthTokens
+from models.brokerage import BrokerageId
 from services.authentication import AuthenticationService
 from services.brokerage import get_brokerage_service
 
@@ -46,3 +51,74 @@ def test_sign_out(client):
         response = client.delete("/api/v1/auth/")
         assert response.status_code == 200
         mock_sign_out.assert_called_once()
+
+
+def test_sign_out_brokerage(client):
+    with patch.object(AuthenticationService, "sign_out") as mock_sign_out:
+        response = client.delete("/api/v1/auth/td-a")
+        assert response.status_code == 200
+        mock_sign_out.assert_called_once_with(BrokerageId.TD)
+
+
+def test_get_sessions(client, tokens):
+    paper_tokens = tokens.copy(update={"brokerage_id": BrokerageId.PAPER})
+    config = GlobalConfig().dict()
+    paper = {"id": "paper", "name": "Paper", "client_id": "paper"}
+    config["brokerages"] = [*config["brokerages"], paper]
+    with GlobalConfig.change_config_sources(ConfZDataSource(data=config)), patch.object(
+        AuthenticationService, "sessions", new_callable=PropertyMock
+    ) as mock_sessions:
+        mock_sessions.return_value = {}
+        response = client.get("/api/v1/auth/sessions")
+        assert response.json() == {"active": None, "sessions": []}
+
+        mock_sessions.return_value = {
+            BrokerageId.TD: tokens,
+            BrokerageId.PAPER: paper_tokens,
+        }
+        response = client.get("/api/v1/auth/sessions")
+        assert response.status_code == 200
+        assert response.json()["active"] == "td-a"
+        assert [s["id"] for s in response.json()["sessions"]] == ["td-a", "paper"]
+
+
+def test_sign_in(client):
+    with patch.object(AuthenticationService, "sign_in_async") as mock_sign_in:
+        response = client.post("/api/v1/auth/", json={"id": "td-a", "code": "code"})
+        assert response.status_code == 200
+        mock_sign_in.assert_awaited_once_with(BrokerageId.TD, "code")
+
+
+def test_auth_status_conditional_get(client):
+    with patch.object(
+        AuthenticationService, "active_tokens", new_callable=PropertyMock
+    ) as mock_tokens:
+        mock_tokens.return_value = None
+        response = client.get("/api/v1/auth/")
+        etag = response.headers["etag"]
+        assert response.headers["cache-control"] == "no-cache"
+
+        response = client.get("/api/v1/auth/", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+
+        mock_tokens.return_value = AuthTokens(
+            brokerage_id=BrokerageId.TD,
+            access_token="access_token",
+            access_expiry=datetime.datetime.now(),
+            refresh_token="refresh_token",
+            refresh_expiry=datetime.datetime.now(),
+        )
+        response = client.get("/api/v1/auth/", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.json()["signed_in"]
+        assert response.headers["etag"] != etag
+
+
+def test_auth_uri_conditional_get(client):
+    etag = client.get("/api/v1/auth/td-a").headers["etag"]
+    response = client.get(
+        "/api/v1/auth/td-a", headers={"If-None-Match": f'"other", W/{etag}'}
+    )
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+
+from api.events import get_events
+from models.authentication import AuthStatus
+from models.events import EventType
+from services.events import event_broker
+
+
+@pytest.mark.usefixtures("auth_service_signed_in")
+def test_event_stream(user_settings):
+    async def run():
+        event_broker.start()
+        try:
+            response = await get_events()
+            assert response.media_type == "text/event-stream"
+            messages = response.body_iterator
+            initial = [await messages.__anext__() for _ in range(2)]
+            event_broker.publish(EventType.SIGN_OUT, AuthStatus(signed_in=False))
+            return initial + [await messages.__anext__()]
+        finally:
+            await event_broker.stop()
+
+    auth, settings, sign_out = asyncio.run(run())
+    assert auth.startswith(b"event: auth\n")
+    assert b'"signed_in": true' in auth
+    assert settings.startswith(b"event: settings\n")
+    assert b'"symbols": ["AMZN", "IBM"]' in settings
+    assert sign_out.startswith(b"event: sign_out\n")
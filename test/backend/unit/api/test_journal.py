@@ -0,0 +1,39 @@
+import datetime
+
+from models.trading import Fill, Order, OrderSide
+from services.journal import trade_journal
+
+START = datetime.datetime(2022, 12, 1, 9, 30)
+
+
+def test_get_summary(client):
+    assert client.get("/api/v1/journal/summary").json()["symbols"] == []
+
+    for minutes, price in [(0, 100), (10, 110)]:
+        trade_journal.record_order(
+            Order(symbol="AMZN", side=OrderSide.BUY, quantity=1),
+            0.25,
+            Fill(
+                symbol="AMZN",
+                side=OrderSide.BUY,
+                quantity=1,
+                price=price,
+                fill_time=START + datetime.timedelta(minutes=minutes),
+            ),
+        )
+    summary = client.get("/api/v1/journal/summary").json()
+    assert summary["events"]["fill"] == 2
+    assert summary["symbols"][0]["cash_flow"] == -210
+    assert summary["order_latency"]["p50"] == 0.25
+
+    response = client.get(
+        "/api/v1/journal/summary",
+        params={"start": (START + datetime.timedelta(minutes=5)).isoformat()},
+    )
+    assert response.json()["symbols"][0]["fills"] == 1
+
+    response = client.get(
+        "/api/v1/journal/summary",
+        params={"start": START.isoformat(), "end": START.isoformat()},
+    )
+    assert response.status_code == 422
@@ -0,0 +1,34 @@
+from common.config import UserSettings
+
+
+def series(text, name, **labels):
+    label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+    prefix = f"{name}{{{label_text}}} " if labels else f"{name} "
+    values = [
+        line[len(prefix) :] for line in text.splitlines() if line.startswith(prefix)
+    ]
+    return float(values[0]) if values else 0.0
+
+
+def test_metrics(client, user_settings_from_file):
+    count = "mark_trader_http_request_seconds_count"
+    route = {"method": "GET", "route": "/auth/{brokerage_id}", "status": "200"}
+    before = client.get("/api/v1/metrics").text
+
+    assert client.get("/api/v1/auth/td-a").status_code == 200
+    assert client.get("/api/v1/auth/td-a").status_code == 200
+    assert client.get("/api/v1/nothing").status_code == 404
+    UserSettings.update({"position_size": 20})
+
+    response = client.get("/api/v1/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    after = response.text
+    assert series(after, count, **route) - series(before, count, **route) == 2
+    unmatched = {"method": "GET", "route": "unmatched", "status": "404"}
+    assert series(after, count, **unmatched) - series(before, count, **unmatched) == 1
+    settings = "mark_trader_user_settings_update_seconds_count"
+    assert series(after, settings) - series(before, settings) == 1
+    assert "# TYPE mark_trader_brokerage_request_seconds histogram" in after
+    assert "# TYPE mark_trader_keyring_seconds histogram" in after
+    assert "# TYPE mark_trader_token_refresh_lag_seconds histogram" in after
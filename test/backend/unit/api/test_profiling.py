@@ -0,0 +1,70 @@
+import pytest
+from confz import ConfZDataSource
+
+from common.config import GlobalConfig
+
+ADMIN = {"Authorization": "Bearer s3cret"}
+
+
+@pytest.fixture
+def profiling_config():
+    return {"enabled": True, "admin_token": "s3cret", "interval_seconds": 0.001}
+
+
+@pytest.fixture(autouse=True)
+def profiling(profiling_config):
+    with GlobalConfig.change_config_sources(
+        ConfZDataSource(data={**GlobalConfig().dict(), "profiling": profiling_config})
+    ):
+        yield
+
+
+def test_admin_requires_token(client):
+    assert client.get("/api/v1/admin/profiles/").status_code == 401
+    response = client.get(
+        "/api/v1/admin/profiles/", headers={"Authorization": "Bearer wrong"}
+    )
+    assert response.status_code == 401
+    assert client.get("/api/v1/admin/profiles/", headers=ADMIN).json() == []
+
+
+@pytest.mark.parametrize("profiling_config", [{"enabled": True}])
+def test_admin_disabled_without_token(client):
+    assert client.get("/api/v1/admin/profiles/", headers=ADMIN).status_code == 404
+
+
+def test_profile_requested_with_header(client, user_settings):
+    assert client.get("/api/v1/userSettings/").status_code == 200
+    headers = {"X-Profile-Request": "wrong"}
+    assert client.get("/api/v1/userSettings/", headers=headers).status_code == 200
+    assert client.get("/api/v1/admin/profiles/", headers=ADMIN).json() == []
+
+    headers = {"X-Profile-Request": "s3cret"}
+    assert client.get("/api/v1/userSettings/", headers=headers).status_code == 200
+    profiles = client.get("/api/v1/admin/profiles/", headers=ADMIN).json()
+    assert len(profiles) == 1
+    assert profiles[0]["path"] == "/userSettings/"
+    assert profiles[0]["status"] == "200"
+
+    response = client.get(f"/api/v1/admin/profiles/{profiles[0]['id']}", headers=ADMIN)
+    assert response.status_code == 200
+    assert "attachment" in response.headers["content-disposition"]
+    for line in response.text.splitlines():
+        _, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+    assert client.get("/api/v1/admin/profiles/0-abc", headers=ADMIN).status_code == 404
+
+
+@pytest.mark.parametrize(
+    "profiling_config", [{"enabled": True, "sample_rate": 1, "max_profiles": 2}]
+)
+def test_sampled_requests_bounded(client, user_settings):
+    for _ in range(4):
+        assert client.get("/api/v1/userSettings/").status_code == 200
+    assert len(list((GlobalConfig().data_dir / "profiles").glob("*.folded"))) == 2
+
+
+@pytest.mark.parametrize("profiling_config", [{"sample_rate": 1}])
+def test_disabled(client, user_settings):
+    assert client.get("/api/v1/userSettings/").status_code == 200
+    assert not (GlobalConfig().data_dir / "profiles").exists()
@@ -0,0 +1,132 @@
+import gzip
+
+import pytest
+from mock.mock import patch
+from starlette.testclient import TestClient
+
+from api import static
+from api.static import PrecompressedStaticFiles, accepted_encoding, precompress
+
+SCRIPT = "function render(props){return props.quote}\n" * 100
+
+
+@pytest.fixture
+def build(tmp_path):
+    (tmp_path / "static" / "js").mkdir(parents=True)
+    (tmp_path / "index.html").write_text(f"<html>{SCRIPT}</html>")
+    (tmp_path / "static" / "js" / "main.8f1a2b3c.js").write_text(SCRIPT)
+    (tmp_path / "robots.txt").write_text("User-agent: *")
+    return tmp_path
+
+
+@pytest.fixture
+def static_client(build):
+    precompress(build)
+    return TestClient(PrecompressedStaticFiles(build))
+
+
+@pytest.mark.parametrize(
+    "accept, expected",
+    [
+        ("", "identity"),
+        ("gzip, deflate", "gzip"),
+        ("gzip;q=0.5, br", "br"),
+        ("br;q=0, gzip;q=0", "identity"),
+        ("*", "br"),
+        ("gzip;q=bad", "identity"),
+    ],
+)
+def test_accepted_encoding(accept, expected):
+    assert accepted_encoding(accept, ["br", "gzip"]) == expected
+
+
+def test_serves_compressed(static_client):
+    response = static_client.get(
+        "/static/js/main.8f1a2b3c.js", headers={"Accept-Encoding": "gzip"}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert int(response.headers["content-length"]) < len(SCRIPT)
+    assert response.text == SCRIPT
+
+    response = static_client.get(
+        "/static/js/main.8f1a2b3c.js", headers={"Accept-Encoding": "identity"}
+    )
+    assert "content-encoding" not in response.headers
+    assert response.headers["content-type"] == "text/javascript; charset=utf-8"
+
+
+def test_small_files_not_compressed(static_client):
+    response = static_client.get("/robots.txt", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+    assert response.text == "User-agent: *"
+
+
+def test_cache_headers(static_client):
+    response = static_client.get("/static/js/main.8f1a2b3c.js")
+    assert response.headers["cache-control"] == static.IMMUTABLE
+    response = static_client.get("/")
+    assert response.headers["cache-control"] == static.REVALIDATE
+    assert response.text.startswith("<html>")
+
+
+def test_not_modified(static_client):
+    headers = {"Accept-Encoding": "gzip"}
+    etag = static_client.get("/", headers=headers).headers["etag"]
+    response = static_client.get("/", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    for if_none_match in (f'"other", W/{etag}', "*"):
+        response = static_client.get(
+            "/", headers={**headers, "If-None-Match": if_none_match}
+        )
+        assert response.status_code == 304
+
+    # the identity body has a different etag
+    response = static_client.get(
+        "/", headers={"Accept-Encoding": "identity", "If-None-Match": etag}
+    )
+    assert response.status_code == 200
+
+
+def test_served_uncompressed_without_copies(build):
+    client = TestClient(PrecompressedStaticFiles(build))
+    response = client.get(
+        "/static/js/main.8f1a2b3c.js", headers={"Accept-Encoding": "gzip"}
+    )
+    assert "content-encoding" not in response.headers
+    assert response.text == SCRIPT
+
+
+def test_head_and_methods(static_client):
+    response = static_client.head("/", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.content == b""
+    assert int(response.headers["content-length"]) > 0
+    assert static_client.post("/").status_code == 405
+
+
+def test_not_found(build, static_client):
+    assert static_client.get("/missing.js").status_code == 404
+    (build / "404.html").write_text("gone")
+    response = TestClient(PrecompressedStaticFiles(build)).get("/missing.js")
+    assert response.status_code == 404
+    assert response.text == "gone"
+
+
+def test_large_files_use_precompressed_copies(build):
+    assert precompress(build) >= 2
+    assert (build / "index.html.gz").exists()
+    assert not (build / "robots.txt.gz").exists()
+
+    with patch.object(static, "SMALL_FILE_BYTES", 0):
+        client = TestClient(PrecompressedStaticFiles(build))
+    response = client.get(
+        "/static/js/main.8f1a2b3c.js", headers={"Accept-Encoding": "gzip"}
+    )
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.text == SCRIPT
+    # precompressed copies aren't served as files of their own
+    assert client.get("/index.html.gz").status_code == 404
+    assert gzip.decompress((build / "index.html.gz").read_bytes()).startswith(b"<html>")
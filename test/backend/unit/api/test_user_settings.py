@@ -49,3 +49,16 @@ def test_enable_trading_signed_out(client, user_settings_from_file):
     assert response.status_code == 422
 
     assert UserSettings().dict() == original_settings
+
+
+def test_get_user_settings_conditional(client, user_settings_from_file):
+    response = client.get("/api/v1/userSettings/")
+    etag = response.headers["etag"]
+    response = client.get("/api/v1/userSettings/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    client.patch("/api/v1/userSettings/", json={"position_size": 7})
+    response = client.get("/api/v1/userSettings/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["position_size"] == 7
+    assert response.headers["etag"] != etag
@@ -7,6 +7,7 @@ import yaml
 from confz import ConfZDataSource, ConfZFileSource
 
 from common.config import GlobalConfig, UserSettings
+from services.resilience import reset_circuit_breakers
 
 
 @pytest.fixture
@@ -41,13 +42,26 @@ def user_settings() -> UserSettings:
 
 
 @pytest.fixture(autouse=True)
-def global_config(server_config, td_brokerage):
+def global_config(server_config, td_brokerage, tmp_path):
     with GlobalConfig.change_config_sources(
-        ConfZDataSource(data={"server": server_config, "brokerages": [td_brokerage]})
+        ConfZDataSource(
+            data={
+                "server": server_config,
+                "brokerages": [td_brokerage],
+                "data_dir": str(tmp_path),
+            }
+        )
     ):
         yield
 
 
+@pytest.fixture(autouse=True)
+def circuit_breakers():
+    # breakers are process wide, don't let failures in one test trip another
+    yield
+    reset_circuit_breakers()
+
+
 # All tests should be forced to use these fixtures for their user settings and global config
 
 
@@ -58,3 +72,4 @@ def user_settings_from_file(user_settings) -> t.Tuple[UserSettings, str]:
         tmp.flush()
         with UserSettings.change_config_sources(ConfZFileSource(file=Path(tmp.name))):
             yield UserSettings(), tmp.name
+            UserSettings.flush()
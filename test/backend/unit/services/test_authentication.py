@@ -1,23 +1,38 @@
+import asyncio
 import datetime
 
 import keyring
 import mock
 import pytest
+from confz import ConfZDataSource
 
 from common.config import GlobalConfig
-from models.authentication import AuthTokens
+from common.utils import LeaderLock, VirtualClock, use_clock
+from models.authentication import AuthStatus, AuthTokens
 from models.brokerage import BrokerageId
-from services.authentication import AuthenticationService, refresh_access
-from services.brokerage import TDAmeritradeBrokerageService
+from models.events import EventType
+from services.authentication import (
+    AuthenticationService,
+    TokenRefreshScheduler,
+    _on_tokens_changed,
+    refresh_access,
+    refresh_schedule,
+    token_refresh_scheduler,
+)
+from services.brokerage import TDAmeritradeBrokerageService, close_brokerage_services
+from services.events import event_broker
+from services.token_store import KeyringTokenStore
 
 
 @pytest.fixture
-def mock_start_daemon():
-    with mock.patch("services.authentication.start_daemon") as mock_start:
-        yield mock_start
+def mock_reschedule():
+    with mock.patch.object(
+        token_refresh_scheduler, "reschedule", wraps=token_refresh_scheduler.reschedule
+    ) as mock_reschedule:
+        yield mock_reschedule
 
 
-def test_sign_in(mock_start_daemon):
+def test_sign_in(mock_reschedule):
     tokens = AuthTokens(
         brokerage_id=BrokerageId.TD,
         access_token="access_token",
@@ -35,27 +50,20 @@ def test_sign_in(mock_start_daemon):
 
         auth_service.sign_in(BrokerageId.TD, "access")
 
-        assert mock_start_daemon.call_count == 2
+        assert mock_reschedule.call_count == 1
 
-        for key, expected_value in [
-            (auth_service._ACTIVE_BROKERAGE_KEY, BrokerageId.TD.value),
-            (auth_service._ACCESS_TOKEN_KEY, tokens.access_token),
-            (auth_service._REFRESH_TOKEN_KEY, tokens.refresh_token),
-            (auth_service._ACCESS_EXPIRY_KEY, str(tokens.access_expiry.timestamp())),
-            (auth_service._REFRESH_EXPIRY_KEY, str(tokens.refresh_expiry.timestamp())),
-        ]:
-            assert (
-                keyring.get_password(auth_service._SYSTEM, key) == expected_value
-            ), key
+        assert (
+            keyring.get_password(auth_service._SYSTEM, f"TOKENS_{BrokerageId.TD.value}")
+            == tokens.json()
+        )
 
         assert auth_service.active_brokerage == BrokerageId.TD
         assert auth_service.active_tokens == tokens
 
-        for key in auth_service._ALL_KEYS:
-            keyring.delete_password(auth_service._SYSTEM, key)
+        KeyringTokenStore(auth_service._SYSTEM).delete(BrokerageId.TD)
 
 
-def test_sign_out(mock_start_daemon):
+def test_sign_out(mock_reschedule):
     tokens = AuthTokens(
         brokerage_id=BrokerageId.TD,
         access_token="access_token",
@@ -77,17 +85,147 @@ def test_sign_out(mock_start_daemon):
         assert auth_service.active_brokerage is None
         assert auth_service.active_tokens is None
 
-        assert mock_start_daemon.call_count == 3
+        assert mock_reschedule.call_count == 2
 
 
-class TestRefreshAccess:
+@pytest.fixture
+def paper_brokerage():
+    config = GlobalConfig().dict()
+    paper = {"id": "paper", "name": "Paper", "client_id": "paper"}
+    config["brokerages"] = [*config["brokerages"], paper]
+    with GlobalConfig.change_config_sources(ConfZDataSource(data=config)):
+        yield
+
+
+@pytest.mark.usefixtures("paper_brokerage")
+def test_sessions_with_several_brokerages():
+    now = datetime.datetime.now()
+    td_tokens = AuthTokens(
+        brokerage_id=BrokerageId.TD,
+        access_token="td",
+        access_expiry=now,
+        refresh_token="refresh_token",
+        refresh_expiry=now,
+    )
+    paper_tokens = td_tokens.copy(
+        update={"brokerage_id": BrokerageId.PAPER, "access_token": "paper"}
+    )
+
+    auth_service = AuthenticationService("TEST")
+    auth_service.set_access_keys(paper_tokens)
+    try:
+        with mock.patch.object(
+            TDAmeritradeBrokerageService, "get_access_tokens", return_value=td_tokens
+        ):
+            auth_service.sign_in(BrokerageId.TD, "access")
+        assert auth_service.sessions == {
+            BrokerageId.TD: td_tokens,
+            BrokerageId.PAPER: paper_tokens,
+        }
+        assert auth_service.active_brokerage == BrokerageId.TD
+
+        auth_service.sign_out(BrokerageId.TD)
+        assert auth_service.sessions == {BrokerageId.PAPER: paper_tokens}
+        assert auth_service.active_brokerage == BrokerageId.PAPER
+
+        auth_service.set_access_keys(td_tokens)
+    finally:
+        auth_service.sign_out()
+    assert auth_service.sessions == {}
+
+
+@pytest.mark.usefixtures("paper_brokerage")
+def test_sign_in_publishes_active_brokerage():
+    now = datetime.datetime.now()
+    auth_service = AuthenticationService("TEST")
+    auth_service.set_access_keys(
+        AuthTokens(
+            brokerage_id=BrokerageId.TD,
+            access_token="td",
+            access_expiry=now,
+            refresh_token="refresh_token",
+            refresh_expiry=now,
+        )
+    )
+    td_status = AuthStatus(id="td-a", name="TD Ameritrade", signed_in=True)
+    try:
+        with mock.patch.object(event_broker, "publish") as mock_publish:
+            auth_service.sign_in(BrokerageId.PAPER, "paper")
+            mock_publish.assert_called_once_with(EventType.SIGN_IN, td_status)
+
+            mock_publish.reset_mock()
+            asyncio.run(auth_service.sign_in_async(BrokerageId.PAPER, "paper"))
+            mock_publish.assert_called_once_with(EventType.SIGN_IN, td_status)
+    finally:
+        auth_service.sign_out()
+        asyncio.run(close_brokerage_services())
+
+
+def test_token_watcher_skips_own_writes(mock_reschedule):
+    auth_service = AuthenticationService()
+    with mock.patch.object(event_broker, "publish") as mock_publish:
+        auth_service._invalidate()
+        _on_tokens_changed()
+        mock_publish.assert_not_called()
+
+        # another worker writes, then this one does before the watcher polls
+        auth_service._version_stamp.path.write_text("1-0-abc")
+        auth_service._invalidate()
+        _on_tokens_changed()
+        mock_publish.assert_called_once_with(
+            EventType.AUTH, AuthStatus(signed_in=False)
+        )
+        _on_tokens_changed()
+        mock_publish.assert_called_once()
+    assert mock_reschedule.call_count == 3
+
+
+class TestActiveTokensSnapshot:
     @pytest.fixture
-    def auth_service_not_signed_in(self):
-        auth_service = AuthenticationService("TEST-no-sign-in")
-        assert not auth_service.active_tokens
+    def signed_in_service(self):
+        auth_service = AuthenticationService("TEST-snapshot")
+        auth_service.set_access_keys(
+            AuthTokens(
+                brokerage_id=BrokerageId.TD,
+                access_token="access_token",
+                access_expiry=datetime.datetime.now() + datetime.timedelta(minutes=30),
+                refresh_token="refresh_token",
+                refresh_expiry=datetime.datetime.now() + datetime.timedelta(days=30),
+            )
+        )
         yield auth_service
         auth_service.sign_out()
 
+    def test_hot_read_skips_keyring(self, signed_in_service):
+        tokens = signed_in_service.active_tokens
+        with mock.patch("services.token_store.keyring.get_password") as mock_get:
+            assert signed_in_service.active_tokens == tokens
+            assert AuthenticationService("TEST-snapshot").active_brokerage == (
+                BrokerageId.TD
+            )
+            mock_get.assert_not_called()
+
+    def test_write_invalidates(self, signed_in_service):
+        tokens = signed_in_service.active_tokens
+        new_tokens = tokens.copy(update={"access_token": "new-access_token"})
+        signed_in_service.set_access_keys(new_tokens)
+        assert signed_in_service.active_tokens == new_tokens
+
+    def test_other_process_write_invalidates(self, signed_in_service):
+        assert signed_in_service.active_tokens.access_token == "access_token"
+
+        # another process writes to the token store and bumps the shared version stamp
+        KeyringTokenStore(signed_in_service._SYSTEM).set(
+            signed_in_service.active_tokens.copy(
+                update={"access_token": "other-access_token"}
+            )
+        )
+        signed_in_service._version_stamp.bump()
+
+        assert signed_in_service.active_tokens.access_token == "other-access_token"
+
+
+class TestRefreshAccess:
     @pytest.fixture
     def auth_service_access_first(self):
         auth_service = AuthenticationService("TEST-access-first")
@@ -171,25 +309,248 @@ class TestRefreshAccess:
             refresh_token="new-refresh_token",
             refresh_expiry=datetime.datetime.now() + datetime.timedelta(days=30),
         )
-        with mock.patch("services.authentication.safe_sleep") as mock_sleep, mock.patch(
-            "services.brokerage.TDAmeritradeBrokerageService.refresh_tokens",
+        to_wait, update_refresh_token = refresh_schedule(old_tokens)
+        assert expected_sleep(to_wait)
+        assert update_refresh_token == update_refresh
+
+        with mock.patch(
+            "services.brokerage.AsyncTDAmeritradeBrokerageService.refresh_tokens",
             return_value=new_tokens,
         ) as mock_refresh:
-            refresh_access(auth_service)
+            asyncio.run(refresh_access(auth_service, old_tokens, update_refresh_token))
             mock_refresh.assert_called_once_with(
                 old_tokens, update_refresh_token=update_refresh
             )
-            mock_sleep.assert_called()
-            assert expected_sleep(mock_sleep.call_args[0][0])
             assert auth_service.active_tokens == new_tokens
 
-    def test_refresh_not_signed_in(self, auth_service_not_signed_in):
-        auth_service = auth_service_not_signed_in
-        with mock.patch("services.authentication.safe_sleep") as mock_sleep, mock.patch(
-            "services.brokerage.TDAmeritradeBrokerageService.refresh_tokens"
-        ) as mock_refresh:
-            refresh_access(auth_service)
-            mock_refresh.assert_not_called()
-            mock_sleep.assert_called_once_with(
-                GlobalConfig().authentication.login_check_delay_seconds
+
+class TestTokenRefreshScheduler:
+    @pytest.fixture
+    def new_tokens(self):
+        return AuthTokens(
+            brokerage_id=BrokerageId.TD,
+            access_token="new-access_token",
+            access_expiry=datetime.datetime.now() + datetime.timedelta(minutes=30),
+            refresh_token="new-refresh_token",
+            refresh_expiry=datetime.datetime.now() + datetime.timedelta(days=30),
+        )
+
+    @staticmethod
+    async def _wait_for(condition, timeout=5.0):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not condition():
+            assert asyncio.get_running_loop().time() < deadline, "timed out"
+            await asyncio.sleep(0.01)
+
+    def test_refresh_due_tokens(self, new_tokens):
+        auth_service = AuthenticationService("TEST-scheduler")
+        auth_service.set_access_keys(
+            new_tokens.copy(
+                update={
+                    "access_token": "access_token",
+                    "access_expiry": datetime.datetime.now()
+                    + datetime.timedelta(seconds=1),
+                }
+            )
+        )
+
+        async def run():
+            scheduler = TokenRefreshScheduler("TEST-scheduler")
+            scheduler.start()
+            await self._wait_for(lambda: mock_refresh.called)
+            await self._wait_for(lambda: auth_service.active_tokens == new_tokens)
+            await scheduler.stop()
+            assert not scheduler.running
+
+        try:
+            with mock.patch(
+                "services.brokerage.AsyncTDAmeritradeBrokerageService.refresh_tokens",
+                return_value=new_tokens,
+            ) as mock_refresh:
+                asyncio.run(run())
+        finally:
+            auth_service.sign_out()
+
+    def test_only_leader_refreshes(self, new_tokens):
+        auth_service = AuthenticationService("TEST-scheduler")
+        auth_service.set_access_keys(
+            new_tokens.copy(update={"access_expiry": datetime.datetime.now()})
+        )
+        # another worker is leading
+        other_worker = LeaderLock(
+            GlobalConfig().data_dir / "TEST-scheduler.leader.lock"
+        )
+        assert other_worker.try_acquire()
+
+        async def run():
+            scheduler = TokenRefreshScheduler("TEST-scheduler")
+            scheduler.start()
+            await asyncio.sleep(0.05)
+            assert not scheduler.leader
+            assert not mock_refresh.called
+
+            other_worker.release()
+            await self._wait_for(lambda: mock_refresh.called)
+            assert scheduler.leader
+            await scheduler.stop()
+            assert not scheduler.leader
+            assert other_worker.try_acquire()
+            other_worker.release()
+
+        try:
+            with mock.patch(
+                "services.brokerage.AsyncTDAmeritradeBrokerageService.refresh_tokens",
+                return_value=new_tokens,
+            ) as mock_refresh, GlobalConfig.change_config_sources(
+                ConfZDataSource(
+                    data={
+                        **GlobalConfig().dict(),
+                        "authentication": {"leader_poll_seconds": 0.01},
+                    }
+                )
+            ):
+                asyncio.run(run())
+        finally:
+            other_worker.release()
+            auth_service.sign_out()
+
+    def test_sign_in_wakes_scheduler(self, new_tokens):
+        auth_service = AuthenticationService("TEST-scheduler")
+        assert not auth_service.active_tokens
+        scheduler = TokenRefreshScheduler("TEST-scheduler")
+
+        async def run():
+            scheduler.start()
+            # the scheduler is now waiting login_check_delay_seconds for a sign in
+            await asyncio.sleep(0.05)
+            assert not mock_refresh.called
+            auth_service.set_access_keys(
+                new_tokens.copy(
+                    update={
+                        "access_token": "access_token",
+                        "access_expiry": datetime.datetime.now(),
+                    }
+                )
+            )
+            scheduler.reschedule()
+            await self._wait_for(lambda: mock_refresh.called)
+            await scheduler.stop()
+
+        try:
+            with mock.patch(
+                "services.brokerage.AsyncTDAmeritradeBrokerageService.refresh_tokens",
+                return_value=new_tokens,
+            ) as mock_refresh:
+                asyncio.run(run())
+        finally:
+            auth_service.sign_out()
+
+    def test_refresh_failure_does_not_stop_scheduler(self, new_tokens):
+        auth_service = AuthenticationService("TEST-scheduler")
+        auth_service.set_access_keys(
+            new_tokens.copy(update={"access_expiry": datetime.datetime.now()})
+        )
+        scheduler = TokenRefreshScheduler("TEST-scheduler")
+
+        async def run():
+            scheduler.start()
+            await self._wait_for(lambda: mock_refresh.called)
+            await asyncio.sleep(0.05)
+            assert scheduler.running
+            await scheduler.stop()
+
+        try:
+            with mock.patch(
+                "services.brokerage.AsyncTDAmeritradeBrokerageService.refresh_tokens",
+                side_effect=RuntimeError("unexpected response for post access token"),
+            ) as mock_refresh:
+                asyncio.run(run())
+        finally:
+            auth_service.sign_out()
+
+    def test_day_of_refreshes_on_virtual_clock(self, new_tokens):
+        clock = VirtualClock()
+        start = clock.now()
+        auth_service = AuthenticationService("TEST-scheduler")
+        auth_service.set_access_keys(new_tokens)
+
+        async def refresh_tokens(auth_tokens, update_refresh_token=False):
+            return auth_tokens.copy(
+                update={"access_expiry": clock.now() + datetime.timedelta(minutes=30)}
+            )
+
+        async def run():
+            scheduler = TokenRefreshScheduler("TEST-scheduler")
+            scheduler.start()
+            await clock.run_until(start + datetime.timedelta(days=1))
+            await scheduler.stop()
+            assert auth_service.active_tokens.access_expiry > clock.now()
+
+        try:
+            with use_clock(clock), mock.patch(
+                "services.brokerage.AsyncTDAmeritradeBrokerageService.refresh_tokens",
+                side_effect=refresh_tokens,
+            ) as mock_refresh:
+                asyncio.run(run())
+        finally:
+            auth_service.sign_out()
+
+        # refreshed refresh_buffer_seconds (5 minutes) before each 30 minute expiry
+        assert mock_refresh.call_count == 24 * 60 // 25
+
+    @pytest.mark.usefixtures("paper_brokerage")
+    def test_sessions_refresh_in_expiry_order(self, new_tokens):
+        clock = VirtualClock()
+        auth_service = AuthenticationService("TEST-scheduler")
+        # the paper session expires first, the TD session 20 minutes later
+        paper_tokens = new_tokens.copy(
+            update={
+                "brokerage_id": BrokerageId.PAPER,
+                "access_expiry": clock.now() + datetime.timedelta(minutes=10),
+            }
+        )
+        auth_service.set_access_keys(paper_tokens)
+        auth_service.set_access_keys(new_tokens)
+        refreshed = []
+
+        async def refresh_tokens(auth_tokens, update_refresh_token=False):
+            refreshed.append((auth_tokens.brokerage_id, clock.now()))
+            return auth_tokens.copy(
+                update={"access_expiry": clock.now() + datetime.timedelta(minutes=30)}
             )
+
+        async def run():
+            scheduler = TokenRefreshScheduler("TEST-scheduler")
+            scheduler.start()
+            await clock.advance(1)
+            # one timer, for the refresh due first
+            assert len(scheduler._heap) == 2
+            assert clock.next_wakeup == pytest.approx(clock.time() + 5 * 60 - 1, abs=2)
+            await clock.advance(60 * 60)
+            await scheduler.stop()
+
+        start = clock.now()
+        try:
+            with use_clock(clock), mock.patch(
+                "services.brokerage.AsyncTDAmeritradeBrokerageService.refresh_tokens",
+                side_effect=refresh_tokens,
+            ), mock.patch(
+                "services.paper_brokerage.AsyncPaperBrokerageService.refresh_tokens",
+                side_effect=refresh_tokens,
+            ):
+                asyncio.run(run())
+        finally:
+            auth_service.sign_out()
+
+        minutes = [
+            (brokerage_id, round((when - start).total_seconds() / 60))
+            for brokerage_id, when in refreshed
+        ]
+        # each refreshed 5 minutes before expiry, then every 25 minutes
+        assert minutes == [
+            (BrokerageId.PAPER, 5),
+            (BrokerageId.TD, 25),
+            (BrokerageId.PAPER, 30),
+            (BrokerageId.TD, 50),
+            (BrokerageId.PAPER, 55),
+        ]
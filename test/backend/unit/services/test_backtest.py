@@ -0,0 +1,122 @@
+import datetime
+import functools
+
+import numpy as np
+import pytest
+
+from services.backtest import (
+    BacktestSettings,
+    Bars,
+    backtest_symbol,
+    load_bars,
+    run_backtest,
+)
+from services.strategy import MovingAverageCrossover, Strategy
+
+START = datetime.datetime(2022, 12, 1, 14, 30, tzinfo=datetime.timezone.utc)
+
+
+class AlwaysLong(Strategy):
+    def signals(self, snapshot):
+        return np.ones(len(snapshot.symbols))
+
+
+def make_bars(closes, minutes=60):
+    closes = np.array(closes, dtype=np.float64)
+    times = START.timestamp() + np.arange(len(closes)) * minutes * 60
+    return Bars(times, closes, closes, closes, closes, np.ones(len(closes)))
+
+
+class TestBacktest:
+    def test_fills_at_next_open(self):
+        result = backtest_symbol(
+            "AMZN", make_bars([10, 20, 30, 40]), AlwaysLong, BacktestSettings(100)
+        )
+
+        assert result.bars == 4
+        (trade,) = result.trades
+        assert trade.entry_price == 20
+        assert trade.exit_price == 40
+        assert trade.quantity == 10
+        assert result.pnl == 200
+
+    def test_orders_on_last_bar(self):
+        class FlatOnLastBar(Strategy):
+            def __init__(self):
+                self.bars = 0
+
+            def signals(self, snapshot):
+                self.bars += 1
+                return np.full(len(snapshot.symbols), float(self.bars < 4))
+
+        result = backtest_symbol(
+            "AMZN", make_bars([10, 20, 30, 40]), FlatOnLastBar, BacktestSettings(100)
+        )
+        (exit_order,) = result.unfilled_orders
+        assert exit_order.is_exit
+        # the position is still closed, at the last close
+        (trade,) = result.trades
+        assert trade.exit_price == 40
+        assert result.pnl == 200
+
+        result = backtest_symbol(
+            "AMZN", make_bars([10, 20]), AlwaysLong, BacktestSettings(100)
+        )
+        assert result.unfilled_orders == []
+        result = backtest_symbol(
+            "AMZN", make_bars([10]), AlwaysLong, BacktestSettings(100)
+        )
+        (entry,) = result.unfilled_orders
+        assert not entry.is_exit
+        assert result.trades == []
+
+    def test_end_of_day_exit(self):
+        # hourly bars from 14:30 run past midnight UTC
+        bars = make_bars(range(10, 24))
+        settings = BacktestSettings(100, end_of_day_exit=True, commission=1)
+        result = backtest_symbol("AMZN", bars, AlwaysLong, settings)
+
+        assert len(result.trades) == 2
+        first, second = result.trades
+        assert first.exit_time.date() == first.entry_time.date()
+        assert first.exit_time.hour == 23
+        assert second.entry_time.date() > first.exit_time.date()
+        assert result.pnl == pytest.approx(sum(t.pnl for t in result.trades))
+
+    def test_max_drawdown(self):
+        result = backtest_symbol(
+            "AMZN", make_bars([10, 10, 20, 10, 15]), AlwaysLong, BacktestSettings(100)
+        )
+        assert result.max_drawdown == 100
+        assert result.pnl == 50
+
+    def test_process_pool_matches_inline(self):
+        rng = np.random.default_rng(2)
+        sources = {
+            symbol: make_bars(100 + np.cumsum(rng.normal(size=500)), minutes=5)
+            for symbol in ("AMZN", "IBM", "GE")
+        }
+        factory = functools.partial(MovingAverageCrossover, 5, 20)
+        settings = BacktestSettings(1000, end_of_day_exit=True)
+
+        inline = run_backtest(sources, factory, settings, processes=1)
+        pooled = run_backtest(sources, factory, settings, processes=2)
+
+        assert [r.symbol for r in pooled.symbols] == ["AMZN", "IBM", "GE"]
+        assert pooled == inline
+        assert inline.trades
+        assert 0 <= inline.win_rate <= 1
+
+    def test_load_bars(self, tmp_path):
+        path = tmp_path / "amzn.csv"
+        path.write_text(
+            "time,open,high,low,close,volume\n"
+            "2022-12-01T14:30:00,1,2,0.5,1.5,100\n"
+            "2022-12-01T14:31:00,1.5,2,1,1,50\n"
+        )
+        bars = load_bars(path)
+
+        assert bars.times.tolist() == [START.timestamp(), START.timestamp() + 60]
+        assert bars.close.tolist() == [1.5, 1]
+        result = run_backtest({"AMZN": path}, AlwaysLong, BacktestSettings(10))
+        assert result.symbols[0].bars == 2
@@ -1,12 +1,28 @@
+import asyncio
 import datetime
 
+import httpx
 import mock
 import pytest
+from confz import ConfZDataSource
 
 from common.config import GlobalConfig
 from models.authentication import AuthTokens
 from models.brokerage import BrokerageId
-from services.brokerage import TDAmeritradeBrokerageService
+from services.brokerage import (
+    AsyncTDAmeritradeBrokerageService,
+    TDAmeritradeBrokerageService,
+    close_brokerage_services,
+    get_async_brokerage_service,
+    get_brokerage_service,
+)
+
+
+def quotes_body(symbols):
+    return {
+        symbol: {"symbol": symbol, "lastPrice": 1.0, "quoteTimeInLong": 1670000000000}
+        for symbol in symbols
+    }
 
 
 # @pytest.mark.usefixtures("global_config")
@@ -22,7 +38,7 @@ class TestTDAmeritradeBrokerageService:
         )
 
     def test_get_access_tokens(self):
-        with mock.patch("services.brokerage.requests.post") as mock_post:
+        with mock.patch("services.brokerage.httpx.Client.post") as mock_post:
             mock_body = {
                 "access_token": "access",
                 "expires_in": 700,
@@ -58,7 +74,7 @@ class TestTDAmeritradeBrokerageService:
             assert mock_post.call_args.kwargs["data"] == expected_call
 
     def test_refresh_tokens_no_new_rerfesh(self, old_tokens):
-        with mock.patch("services.brokerage.requests.post") as mock_post:
+        with mock.patch("services.brokerage.httpx.Client.post") as mock_post:
             mock_body = {
                 "access_token": "access",
                 "expires_in": 700,
@@ -87,7 +103,7 @@ class TestTDAmeritradeBrokerageService:
             assert mock_post.call_args.kwargs["data"] == expected_call
 
     def test_refresh_tokens_do_new_rerfesh(self, old_tokens):
-        with mock.patch("services.brokerage.requests.post") as mock_post:
+        with mock.patch("services.brokerage.httpx.Client.post") as mock_post:
             mock_body = {
                 "access_token": "access",
                 "expires_in": 700,
@@ -121,3 +137,197 @@ class TestTDAmeritradeBrokerageService:
             ).total_seconds() - mock_body["refresh_token_expires_in"] < 1
 
             assert mock_post.call_args.kwargs["data"] == expected_call
+
+    def test_get_quotes_chunked(self, old_tokens):
+        symbols = [f"S{i}" for i in range(5)]
+        service = TDAmeritradeBrokerageService()
+        with mock.patch.object(
+            TDAmeritradeBrokerageService, "MAX_QUOTE_SYMBOLS", 3
+        ), mock.patch(
+            "services.brokerage.httpx.Client.get",
+            side_effect=lambda url, params, headers: httpx.Response(
+                200, json=quotes_body(params["symbol"].split(","))
+            ),
+        ) as mock_get:
+            quotes = service.get_quotes(old_tokens, symbols)
+
+        assert list(quotes) == symbols
+        assert [c.kwargs["params"]["symbol"] for c in mock_get.call_args_list] == [
+            "S0,S1,S2",
+            "S3,S4",
+        ]
+
+
+class TestAsyncTDAmeritradeBrokerageService:
+    @pytest.fixture
+    def old_tokens(self):
+        return AuthTokens(
+            brokerage_id=BrokerageId.TD,
+            access_token="access_token",
+            access_expiry=datetime.datetime.now() + datetime.timedelta(seconds=1),
+            refresh_token="refresh_token",
+            refresh_expiry=datetime.datetime.now() + datetime.timedelta(days=30),
+        )
+
+    def test_get_access_tokens(self):
+        mock_body = {
+            "access_token": "access",
+            "expires_in": 700,
+            "refresh_token": "refresh",
+            "refresh_token_expires_in": 3600,
+        }
+        with mock.patch(
+            "services.brokerage.httpx.AsyncClient.post",
+            return_value=httpx.Response(200, json=mock_body),
+        ) as mock_post:
+            auth_tokens = asyncio.run(
+                AsyncTDAmeritradeBrokerageService().get_access_tokens("access code")
+            )
+
+            assert auth_tokens.access_token == mock_body["access_token"]
+            assert auth_tokens.refresh_token == mock_body["refresh_token"]
+            assert mock_post.call_args.kwargs["data"] == {
+                "grant_type": "authorization_code",
+                "access_type": "offline",
+                "code": "access code",
+                "client_id": GlobalConfig().brokerages[0].client_id,
+                "redirect_uri": GlobalConfig().server.redirect_uri,
+            }
+
+    def test_refresh_tokens_no_new_refresh(self, old_tokens):
+        mock_body = {"access_token": "access", "expires_in": 700}
+        with mock.patch(
+            "services.brokerage.httpx.AsyncClient.post",
+            return_value=httpx.Response(200, json=mock_body),
+        ):
+            auth_tokens = asyncio.run(
+                AsyncTDAmeritradeBrokerageService().refresh_tokens(old_tokens)
+            )
+
+            assert auth_tokens.access_token == mock_body["access_token"]
+            assert auth_tokens.refresh_token == old_tokens.refresh_token
+            assert auth_tokens.refresh_expiry == old_tokens.refresh_expiry
+
+    def test_unexpected_response(self, old_tokens):
+        with mock.patch(
+            "services.brokerage.httpx.AsyncClient.post",
+            return_value=httpx.Response(401, content=b"unauthorized"),
+        ):
+            with pytest.raises(RuntimeError):
+                asyncio.run(
+                    AsyncTDAmeritradeBrokerageService().refresh_tokens(old_tokens)
+                )
+
+    def test_get_quote(self, old_tokens):
+        mock_body = {
+            "AMZN": {
+                "symbol": "AMZN",
+                "bidPrice": 99.5,
+                "askPrice": 100.5,
+                "lastPrice": 100.0,
+                "totalVolume": 1200,
+                "quoteTimeInLong": 1670000000000,
+            }
+        }
+        with mock.patch(
+            "services.brokerage.httpx.AsyncClient.get",
+            return_value=httpx.Response(200, json=mock_body),
+        ) as mock_get:
+            quote = asyncio.run(
+                AsyncTDAmeritradeBrokerageService().get_quote(old_tokens, "AMZN")
+            )
+
+        assert quote.symbol == "AMZN"
+        assert quote.last_price == 100.0
+        assert quote.bid_price == 99.5
+        assert quote.volume == 1200
+        assert quote.quote_time == datetime.datetime.fromtimestamp(1670000000)
+        assert mock_get.call_args.kwargs["headers"] == {
+            "Authorization": f"Bearer {old_tokens.access_token}"
+        }
+        assert mock_get.call_args.kwargs["params"] == {"symbol": "AMZN"}
+
+    def test_get_quote_missing(self, old_tokens):
+        with mock.patch(
+            "services.brokerage.httpx.AsyncClient.get",
+            return_value=httpx.Response(200, json={}),
+        ):
+            with pytest.raises(RuntimeError):
+                asyncio.run(
+                    AsyncTDAmeritradeBrokerageService().get_quote(old_tokens, "AMZN")
+                )
+
+    def test_get_quotes_chunked(self, old_tokens):
+        symbols = [f"S{i}" for i in range(5)]
+
+        async def get(url, params, headers):
+            return httpx.Response(200, json=quotes_body(params["symbol"].split(",")))
+
+        service = AsyncTDAmeritradeBrokerageService()
+        with mock.patch.object(
+            AsyncTDAmeritradeBrokerageService, "MAX_QUOTE_SYMBOLS", 2
+        ), mock.patch(
+            "services.brokerage.httpx.AsyncClient.get", side_effect=get
+        ) as mock_get:
+            quotes = asyncio.run(service.get_quotes(old_tokens, symbols + ["S0"]))
+
+        assert list(quotes) == symbols
+        assert [c.kwargs["params"]["symbol"] for c in mock_get.call_args_list] == [
+            "S0,S1",
+            "S2,S3",
+            "S4",
+        ]
+
+    def test_get_quotes_error(self, old_tokens):
+        with mock.patch(
+            "services.brokerage.httpx.AsyncClient.get",
+            return_value=httpx.Response(429, content=b"too many requests"),
+        ):
+            with pytest.raises(RuntimeError):
+                asyncio.run(
+                    AsyncTDAmeritradeBrokerageService().get_quotes(
+                        old_tokens, ["AMZN", "IBM"]
+                    )
+                )
+
+
+class TestBrokerageServiceRegistry:
+    @pytest.fixture(autouse=True)
+    def clean_registry(self):
+        asyncio.run(close_brokerage_services())
+        yield
+        asyncio.run(close_brokerage_services())
+
+    def test_singleton_per_brokerage(self):
+        assert get_brokerage_service(BrokerageId.TD) is get_brokerage_service(
+            BrokerageId.TD
+        )
+        assert get_async_brokerage_service(
+            BrokerageId.TD
+        ) is get_async_brokerage_service(BrokerageId.TD)
+
+    def test_client_reused(self):
+        service = get_brokerage_service(BrokerageId.TD)
+        client = service.client
+        assert service.client is client
+        assert not client.is_closed
+
+        asyncio.run(close_brokerage_services())
+        assert client.is_closed
+        assert get_brokerage_service(BrokerageId.TD) is not service
+
+    def test_client_options(self, server_config, td_brokerage):
+        td_brokerage["http"] = {
+            "max_connections": 3,
+            "timeout_seconds": 2,
+            "http2": False,
+        }
+        with GlobalConfig.change_config_sources(
+            ConfZDataSource(
+                data={"server": server_config, "brokerages": [td_brokerage]}
+            )
+        ):
+            options = TDAmeritradeBrokerageService()._http_client_options()
+        assert options["limits"].max_connections == 3
+        assert options["timeout"].read == 2
+        assert not options["http2"]
@@ -0,0 +1,67 @@
+import asyncio
+import threading
+
+from common.config import UserSettings
+from models.authentication import AuthStatus
+from models.events import EventType
+from services.events import EventBroker, format_event
+
+SIGNED_OUT = AuthStatus(signed_in=False)
+
+
+async def next_message(subscription):
+    return await asyncio.wait_for(subscription.__aiter__().__anext__(), 1)
+
+
+def test_format_event():
+    assert format_event(EventType.SIGN_OUT, SIGNED_OUT) == (
+        b'event: sign_out\ndata: {"id": null, "name": null, "signed_in": false}\n\n'
+    )
+
+
+def test_publish_from_any_thread(user_settings_from_file):
+    async def run():
+        broker = EventBroker()
+        broker.start()
+        try:
+            with broker.subscribe() as first, broker.subscribe() as second:
+                assert broker.subscribers == 2
+                broker.publish(EventType.SIGN_OUT, SIGNED_OUT)
+                expected = format_event(EventType.SIGN_OUT, SIGNED_OUT)
+                assert await next_message(first) == expected
+                assert await next_message(second) == expected
+
+                thread = threading.Thread(
+                    target=UserSettings.update, args=({"position_size": 42},)
+                )
+                thread.start()
+                thread.join()
+                message = await next_message(first)
+                assert message.startswith(b"event: settings\n")
+                assert b'"position_size": 42.0' in message
+            assert broker.subscribers == 0
+        finally:
+            await broker.stop()
+
+    asyncio.run(run())
+
+
+def test_slow_subscriber_disconnected():
+    async def run():
+        broker = EventBroker()
+        broker.MAX_PENDING = 2
+        broker.start()
+        try:
+            with broker.subscribe() as subscription:
+                for _ in range(3):
+                    broker.publish(EventType.SIGN_OUT, SIGNED_OUT)
+                assert broker.subscribers == 0
+                return [message async for message in subscription]
+        finally:
+            await broker.stop()
+
+    assert len(asyncio.run(run())) == 2
+
+
+def test_publish_without_subscribers():
+    EventBroker().publish(EventType.SIGN_OUT, SIGNED_OUT)
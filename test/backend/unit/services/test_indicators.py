@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from services.indicators import EMA, RSI, SMA, VWAP, BollingerBands, IndicatorSet
+
+
+@pytest.fixture
+def prices():
+    rng = np.random.default_rng(1)
+    return 100 + np.cumsum(rng.normal(size=(3, 60)), axis=1)
+
+
+def replay(indicator, prices, volumes=None):
+    for i in range(prices.shape[1]):
+        indicator.update(prices[:, i], volumes[:, i] if volumes is not None else None)
+    return indicator
+
+
+def reference_rsi(series, period):
+    changes = np.diff(series)
+    gain = np.maximum(changes, 0)
+    loss = np.maximum(-changes, 0)
+    avg_gain, avg_loss = gain[:period].mean(), loss[:period].mean()
+    for g, l in zip(gain[period:], loss[period:]):
+        avg_gain = (avg_gain * (period - 1) + g) / period
+        avg_loss = (avg_loss * (period - 1) + l) / period
+    return 100 - 100 / (1 + avg_gain / avg_loss)
+
+
+class TestIndicators:
+    def test_sma(self, prices):
+        sma = SMA(10, n_symbols=3)
+        replay(sma, prices[:, :9])
+        assert np.isnan(sma.value).all()
+
+        replay(sma, prices[:, 9:])
+        np.testing.assert_allclose(sma.value, prices[:, -10:].mean(axis=1))
+
+    def test_bollinger_bands(self, prices):
+        bands = replay(BollingerBands(20, 2, n_symbols=3), prices)
+        window = prices[:, -20:]
+        np.testing.assert_allclose(bands.value, window.mean(axis=1))
+        np.testing.assert_allclose(
+            bands.upper, window.mean(axis=1) + 2 * window.std(axis=1)
+        )
+        np.testing.assert_allclose(
+            bands.lower, window.mean(axis=1) - 2 * window.std(axis=1)
+        )
+
+    def test_ema(self, prices):
+        ema = replay(EMA(10, n_symbols=3), prices)
+        expected = prices[:, 0]
+        for i in range(1, prices.shape[1]):
+            expected = expected + 2 / 11 * (prices[:, i] - expected)
+        np.testing.assert_allclose(ema.value, expected)
+
+    def test_rsi(self, prices):
+        rsi = replay(RSI(14, n_symbols=3), prices)
+        np.testing.assert_allclose(
+            rsi.value, [reference_rsi(series, 14) for series in prices]
+        )
+        assert np.isnan(replay(RSI(14, n_symbols=3), prices[:, :14]).value).all()
+
+    def test_vwap(self, prices):
+        volumes = np.arange(prices.size, dtype=np.float64).reshape(prices.shape)
+        vwap = replay(VWAP(3), prices, volumes)
+        np.testing.assert_allclose(
+            vwap.value, (prices * volumes).sum(axis=1) / volumes.sum(axis=1)
+        )
+        with pytest.raises(ValueError):
+            vwap.update(prices[:, 0])
+
+        vwap.reset()
+        assert np.isnan(vwap.value).all()
+
+    def test_missing_prices_leave_symbol_unchanged(self, prices):
+        gappy = prices.copy()
+        gappy[1, ::2] = np.nan
+        sma = replay(SMA(5, n_symbols=3), gappy)
+        np.testing.assert_allclose(sma.value[0], prices[0, -5:].mean())
+        np.testing.assert_allclose(sma.value[1], prices[1, 1::2][-5:].mean())
+
+
+class TestIndicatorSet:
+    def test_set_symbols_keeps_state(self, prices):
+        indicators = IndicatorSet({"sma": SMA(5), "ema": EMA(5)}, ["A", "B"])
+        indicators.seed(prices[:2])
+        sma_a = indicators.value("sma", "A")
+
+        indicators.set_symbols(["C", "A"])
+        assert indicators.symbols == ["C", "A"]
+        assert indicators.value("sma", "A") == sma_a
+        assert np.isnan(indicators.value("ema", "C"))
+
+        indicators.update(np.array([1.0, np.nan]))
+        assert indicators.value("ema", "C") == 1
+        assert indicators.value("sma", "A") == sma_a
+        assert set(indicators.values()) == {"sma", "ema"}
@@ -0,0 +1,199 @@
+import datetime
+import multiprocessing
+
+import numpy as np
+import pytest
+from confz import ConfZDataSource
+
+from common.config import GlobalConfig, UserSettings
+from common.utils import VirtualClock, use_clock
+from models.trading import Fill, Order, OrderSide
+from services.journal import (
+    EventKind,
+    Segment,
+    TradeJournal,
+    journal_directory,
+    segment_paths,
+    summarize,
+)
+from services.strategy import MarketSnapshot, Strategy, TradingSession
+
+START = datetime.datetime(2022, 12, 1, 9, 30)
+
+
+@pytest.fixture
+def journal_config():
+    return {"records_per_segment": 4, "rotate_seconds": 3600}
+
+
+@pytest.fixture
+def clock(journal_config):
+    with GlobalConfig.change_config_sources(
+        ConfZDataSource(data={**GlobalConfig().dict(), "journal": journal_config})
+    ):
+        with use_clock(VirtualClock(START)) as clock:
+            yield clock
+
+
+@pytest.fixture
+def journal(clock):
+    journal = TradeJournal()
+    yield journal
+    journal.stop()
+
+
+def fill(symbol, side, quantity, price, seconds=0, commission=0.0):
+    return Fill(
+        symbol=symbol,
+        side=side,
+        quantity=quantity,
+        price=price,
+        fill_time=START + datetime.timedelta(seconds=seconds),
+        commission=commission,
+    )
+
+
+def test_segment_read_while_written(tmp_path):
+    path = tmp_path / "test.seg"
+    with Segment.create(path, capacity=3) as segment:
+        segment.append(EventKind.FILL, 1.0, symbol="AMZN", quantity=2, price=10)
+        with Segment.open(path) as reader:
+            assert reader.count == 1
+            segment.append(EventKind.ORDER, 2.0, symbol="IBM", latency=0.5)
+            assert reader.count == 2
+            assert reader.column("symbol").tolist() == [b"AMZN", b"IBM"]
+            assert reader.column("kind").tolist() == [EventKind.FILL, EventKind.ORDER]
+            assert np.isnan(reader.column("price")[1])
+        segment.append(EventKind.SIGNAL, 3.0)
+        assert segment.full
+        with pytest.raises(ValueError):
+            segment.append(EventKind.SIGNAL, 4.0)
+
+    (tmp_path / "other.seg").write_bytes(b"\0" * 128)
+    with pytest.raises(ValueError):
+        Segment.open(tmp_path / "other.seg")
+
+
+def test_rotation(journal, clock):
+    for seconds in range(5):
+        journal.record_fill(fill("AMZN", OrderSide.BUY, 1, 100, seconds))
+    # full after four records
+    assert len(segment_paths(journal_directory())) == 2
+    clock.sleep_blocking(3600)
+    journal.record_fill(fill("AMZN", OrderSide.BUY, 1, 100, 3600))
+    paths = segment_paths(journal_directory())
+    assert len(paths) == 3
+    assert [Segment.open(path).count for path in paths] == [4, 1, 1]
+
+
+def test_summary(journal):
+    buy = Order(symbol="AMZN", side=OrderSide.BUY, quantity=10)
+    journal.record_order(buy, 0.5, fill("AMZN", OrderSide.BUY, 10, 100, 0, 1))
+    sell = Order(symbol="AMZN", side=OrderSide.SELL, quantity=4)
+    journal.record_order(sell, 1.5, fill("AMZN", OrderSide.SELL, 4, 110, 60, 1))
+    journal.record_order(Order(symbol="IBM", side=OrderSide.BUY, quantity=1), 3.0)
+    journal.record_fill(fill("IBM", OrderSide.SELL, 2, 50, 120))
+    journal.record_signal("MSFT", 1, 250, START)
+    assert len(segment_paths(journal_directory())) > 1
+
+    summary = summarize(journal_directory())
+    assert summary.events == {
+        "signal": 1,
+        "order": 2,
+        "order_failed": 1,
+        "fill": 3,
+        "settings": 0,
+    }
+    amzn, ibm = summary.symbols
+    assert amzn.symbol == "AMZN"
+    assert amzn.fills == 2
+    assert amzn.volume == 14
+    assert amzn.net_quantity == 6
+    assert amzn.cash_flow == -1000 + 440 - 2
+    assert amzn.last_price == 110
+    assert amzn.pnl == pytest.approx(-562 + 6 * 110)
+    assert (ibm.net_quantity, ibm.cash_flow) == (-2, 100)
+    assert summary.order_latency.orders == 2
+    assert summary.order_latency.failed == 1
+    assert summary.order_latency.mean == 1.0
+    assert summary.order_latency.max == 1.5
+
+    later = summarize(journal_directory(), start=START + datetime.timedelta(seconds=30))
+    assert [s.symbol for s in later.symbols] == ["AMZN", "IBM"]
+    assert later.symbols[0].fills == 1
+    only_ibm = summarize(journal_directory(), symbol="IBM")
+    assert only_ibm.events["fill"] == 1
+    assert only_ibm.order_latency.mean is None
+
+
+def test_settings_and_signals(journal, user_settings):
+    journal.start()
+    UserSettings().update(
+        {
+            "end_of_day_exit": not user_settings.end_of_day_exit,
+            "trading_frequency_seconds": user_settings.trading_frequency_seconds + 1,
+        }
+    )
+
+    class Long(Strategy):
+        def signals(self, snapshot):
+            return np.ones(len(snapshot.symbols))
+
+    session = TradingSession(Long(), position_size=100, journal=journal)
+    session.step(MarketSnapshot(START, ["AMZN"], np.array([50.0]), np.zeros(1)))
+
+    (path,) = segment_paths(journal_directory())
+    with Segment.open(path) as segment:
+        assert segment.column("kind").tolist() == [
+            EventKind.SETTINGS,
+            EventKind.SETTINGS,
+            EventKind.SIGNAL,
+        ]
+        assert segment.column("symbol").tolist() == [
+            b"end_of_day_exit",
+            b"trading_frequency_seconds",
+            b"AMZN",
+        ]
+        assert segment.column("price")[2] == 50
+
+
+def test_long_values_rejected(tmp_path, journal):
+    with Segment.create(tmp_path / "test.seg", capacity=2) as segment:
+        with pytest.raises(ValueError, match="too long"):
+            segment.append(EventKind.FILL, 1.0, symbol="X" * 33)
+        assert segment.count == 0
+
+    journal.record_fill(fill("X" * 33, OrderSide.BUY, 1, 100))
+    journal.record_fill(fill("AMZN", OrderSide.BUY, 1, 100))
+    journal.close()
+    assert [s.symbol for s in summarize(journal_directory()).symbols] == ["AMZN"]
+
+
+def test_settings_journaled_by_one_worker(journal):
+    journal.start()
+
+    def other_worker():
+        # the forked copy of this worker's journal stays out of it
+        journal.stop()
+        other = TradeJournal()
+        other.start()
+        UserSettings.update({"position_size": 42})
+        UserSettings.flush()
+        other.stop()
+
+    worker = multiprocessing.get_context("fork").Process(target=other_worker)
+    worker.start()
+    worker.join()
+    assert worker.exitcode == 0
+
+    # this worker's file watcher picks up the change
+    UserSettings.reload()
+    assert UserSettings().position_size == 42
+    journal.close()
+    assert summarize(journal_directory()).events["settings"] == 1
+
+
+@pytest.mark.parametrize("journal_config", [{"enabled": False}])
+def test_disabled(journal):
+    journal.record_fill(fill("AMZN", OrderSide.BUY, 1, 100))
+    assert segment_paths(journal_directory()) == []
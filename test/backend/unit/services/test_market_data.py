@@ -0,0 +1,222 @@
+import asyncio
+import datetime
+
+import mock
+import numpy as np
+import pytest
+
+from common.config import UserSettings
+from common.utils import VirtualClock, use_clock
+from models.authentication import AuthTokens
+from models.brokerage import BrokerageId
+from models.market_data import Quote
+from services.authentication import AuthenticationService
+from services.market_data import MarketDataEngine, PriceRingBuffer
+
+
+class TestPriceRingBuffer:
+    def test_window_before_full(self):
+        buffer = PriceRingBuffer(4)
+        for i in range(3):
+            buffer.append(i, 10 + i, 100 + i)
+
+        assert len(buffer) == 3
+        window = buffer.window()
+        assert window.times.tolist() == [0, 1, 2]
+        assert window.prices.tolist() == [10, 11, 12]
+        assert window.volumes.tolist() == [100, 101, 102]
+        assert buffer.window(2).prices.tolist() == [11, 12]
+
+    def test_window_after_wrap(self):
+        buffer = PriceRingBuffer(4)
+        for i in range(10):
+            buffer.append(i, i)
+
+        assert len(buffer) == 4
+        assert buffer.window().prices.tolist() == [6, 7, 8, 9]
+        assert buffer.window(10).prices.tolist() == [6, 7, 8, 9]
+        assert buffer.window(0).prices.tolist() == []
+
+    def test_window_is_read_only_view(self):
+        buffer = PriceRingBuffer(4)
+        for i in range(6):
+            buffer.append(i, i)
+
+        window = buffer.window()
+        assert np.shares_memory(window.prices, buffer._prices)
+        with pytest.raises(ValueError):
+            window.prices[0] = 1
+        buffer.append(6, 6)
+        assert buffer.window().prices.tolist() == [3, 4, 5, 6]
+
+    def test_invalid_capacity(self):
+        with pytest.raises(ValueError):
+            PriceRingBuffer(0)
+
+
+class TestMarketDataEngine:
+    @pytest.fixture
+    def tokens(self):
+        return AuthTokens(
+            brokerage_id=BrokerageId.TD,
+            access_token="access_token",
+            access_expiry=datetime.datetime.now() + datetime.timedelta(minutes=30),
+            refresh_token="refresh_token",
+            refresh_expiry=datetime.datetime.now() + datetime.timedelta(days=30),
+        )
+
+    @pytest.fixture
+    def signed_in(self, tokens):
+        with mock.patch.object(
+            AuthenticationService, "get_active_tokens_async", return_value=tokens
+        ):
+            yield
+
+    @staticmethod
+    def quote(symbol, price):
+        return Quote(
+            symbol=symbol,
+            last_price=price,
+            bid_price=price - 0.01,
+            ask_price=price + 0.01,
+            volume=10,
+            quote_time=datetime.datetime.now(),
+        )
+
+    def test_set_symbols_keeps_history(self):
+        engine = MarketDataEngine()
+        engine.set_symbols(["AMZN", "IBM"])
+        engine.record(self.quote("AMZN", 1))
+        engine.set_symbols(["AMZN", "GE"])
+
+        assert engine.symbols == ["AMZN", "GE"]
+        assert engine.latest_price("AMZN") == 1
+        assert engine.latest_price("GE") is None
+        with pytest.raises(KeyError):
+            engine.window("IBM")
+
+    def test_batch(self):
+        engine = MarketDataEngine()
+        engine.set_symbols(["AMZN", "IBM"])
+        for price in (1, 2, 3):
+            engine.record(self.quote("AMZN", price))
+        engine.record(self.quote("IBM", 7))
+
+        batch = engine.batch(2)
+        assert batch.prices.shape == (2, 2)
+        assert batch.prices[0].tolist() == [2, 3]
+        assert np.isnan(batch.prices[1, 0])
+        assert batch.prices[1, 1] == 7
+
+    @pytest.mark.usefixtures("signed_in")
+    def test_poll(self):
+        engine = MarketDataEngine()
+        engine.set_symbols(["AMZN", "IBM"])
+
+        with mock.patch(
+            "services.brokerage.AsyncTDAmeritradeBrokerageService.get_quotes",
+            return_value={"AMZN": self.quote("AMZN", 5)},
+        ) as mock_get_quotes:
+            asyncio.run(engine.poll())
+
+        mock_get_quotes.assert_called_once()
+        assert mock_get_quotes.call_args.args[1] == ["AMZN", "IBM"]
+        assert engine.latest_price("AMZN") == 5
+        assert engine.latest_price("IBM") is None
+
+    @pytest.mark.usefixtures("signed_in")
+    def test_poll_failure(self):
+        engine = MarketDataEngine()
+        engine.set_symbols(["AMZN"])
+
+        with mock.patch(
+            "services.brokerage.AsyncTDAmeritradeBrokerageService.get_quotes",
+            side_effect=RuntimeError("unexpected response for get quotes"),
+        ):
+            asyncio.run(engine.poll())
+
+        assert engine.latest_price("AMZN") is None
+
+    @pytest.mark.usefixtures("signed_in")
+    def test_follows_settings(self, user_settings_from_file):
+        settings, _ = user_settings_from_file
+        engine = MarketDataEngine()
+
+        async def run():
+            engine.start()
+            assert engine.symbols == settings.symbols
+            await asyncio.to_thread(UserSettings.update, {"symbols": ["ge"]})
+            for _ in range(100):
+                if engine.symbols == ["GE"]:
+                    break
+                await asyncio.sleep(0.01)
+            await engine.stop()
+
+        with mock.patch(
+            "services.brokerage.AsyncTDAmeritradeBrokerageService.get_quotes",
+            side_effect=lambda auth_tokens, symbols: {
+                symbol: self.quote(symbol, 1) for symbol in symbols
+            },
+        ):
+            asyncio.run(run())
+
+        assert engine.symbols == ["GE"]
+        assert not engine.running
+
+    @pytest.mark.usefixtures("signed_in")
+    def test_polls_on_virtual_clock(self):
+        clock = VirtualClock()
+        engine = MarketDataEngine()
+
+        async def run():
+            engine.start()
+            await clock.advance(10 * 60)
+            await engine.stop()
+
+        with use_clock(clock), mock.patch(
+            "services.brokerage.AsyncTDAmeritradeBrokerageService.get_quotes",
+            side_effect=lambda auth_tokens, symbols: {
+                symbol: self.quote(symbol, 1) for symbol in symbols
+            },
+        ) as mock_get_quotes:
+            asyncio.run(run())
+
+        # a poll right away and then every trading_frequency_seconds (1)
+        assert mock_get_quotes.call_count == 10 * 60 + 1
+
+    @pytest.mark.usefixtures("signed_in")
+    def test_polls_only_while_trading_or_subscribed(self, user_settings_from_file):
+        clock = VirtualClock()
+        engine = MarketDataEngine()
+
+        async def run(mock_get_quotes):
+            await asyncio.to_thread(
+                UserSettings.update, {"enable_automated_trading": False}
+            )
+            engine.start()
+            await clock.advance(60)
+            assert mock_get_quotes.call_count == 0
+
+            with engine.subscribe():
+                await clock.advance(9.5)
+            assert mock_get_quotes.call_count == 10
+            await clock.advance(60)
+            assert mock_get_quotes.call_count == 10
+
+            await asyncio.to_thread(
+                UserSettings.update, {"enable_automated_trading": True}
+            )
+            for _ in range(100):
+                if mock_get_quotes.call_count > 10:
+                    break
+                await asyncio.sleep(0.01)
+            assert mock_get_quotes.call_count == 11
+            await engine.stop()
+
+        with use_clock(clock), mock.patch(
+            "services.brokerage.AsyncTDAmeritradeBrokerageService.get_quotes",
+            side_effect=lambda auth_tokens, symbols: {
+                symbol: self.quote(symbol, 1) for symbol in symbols
+            },
+        ) as mock_get_quotes:
+            asyncio.run(run(mock_get_quotes))
@@ -0,0 +1,226 @@
+import asyncio
+import datetime
+
+import pytest
+from confz import ConfZDataSource
+
+from common.config import GlobalConfig
+from common.utils import VirtualClock, use_clock
+from models.authentication import AuthTokens
+from models.brokerage import BrokerageId
+from models.trading import Order, OrderSide
+from services.authentication import AuthenticationService
+from services.brokerage import OrdersNotSupportedError, close_brokerage_services
+from services.orders import OrderPipeline, TokenBucket
+from services.paper_brokerage import (
+    PaperBrokerageService,
+    paper_exchange,
+    reset_paper_exchange,
+)
+from services.positions import position_store
+
+START = datetime.datetime(2022, 12, 1, 9, 30)
+
+
+@pytest.fixture
+def orders_config():
+    return {"workers": 1, "order_rate_limit": {"requests_per_second": 1, "burst": 1}}
+
+
+@pytest.fixture(autouse=True)
+def clock(server_config, td_brokerage, tmp_path, orders_config):
+    paper = {
+        "id": "paper",
+        "name": "Paper",
+        "client_id": "paper",
+        "order_rate_limit": orders_config["order_rate_limit"],
+        "paper": {"latency_seconds": 0, "volatility": 0, "seed": 7},
+    }
+    with GlobalConfig.change_config_sources(
+        ConfZDataSource(
+            data={
+                "server": server_config,
+                "brokerages": [td_brokerage, paper],
+                "data_dir": str(tmp_path),
+                "orders": {"workers": orders_config["workers"]},
+            }
+        )
+    ):
+        reset_paper_exchange()
+        with use_clock(VirtualClock(START)) as clock:
+            yield clock
+        reset_paper_exchange()
+        asyncio.run(close_brokerage_services())
+
+
+@pytest.fixture
+def signed_in():
+    auth_service = AuthenticationService("TEST-orders")
+    auth_service.sign_in(BrokerageId.PAPER, "paper")
+    yield
+    auth_service.sign_out()
+
+
+def run_pipeline(clock, operation, step=1.0):
+    async def run():
+        pipeline = OrderPipeline("TEST-orders")
+        pipeline.start()
+        try:
+            task = asyncio.ensure_future(operation(pipeline))
+            while not task.done():
+                await clock.advance(step)
+            return await task, pipeline.stats()
+        finally:
+            await pipeline.stop()
+
+    return asyncio.run(run())
+
+
+def buy(symbol, **kwargs):
+    return Order(symbol=symbol, side=OrderSide.BUY, quantity=1, **kwargs)
+
+
+def test_token_bucket(clock):
+    async def acquire_times():
+        bucket = TokenBucket(rate=2, burst=3)
+        times = []
+        for _ in range(5):
+            await bucket.acquire()
+            times.append(clock.time() - START.timestamp())
+        return times
+
+    async def run():
+        task = asyncio.ensure_future(acquire_times())
+        while not task.done():
+            await clock.advance(0.25)
+        return await task
+
+    assert asyncio.run(run()) == [0, 0, 0, 0.5, 1.0]
+
+
+def test_exits_first_and_rate_limited(clock, signed_in):
+    fills, stats = run_pipeline(
+        clock,
+        lambda pipeline: pipeline.submit_many(
+            [
+                buy("AMZN"),
+                buy("IBM"),
+                Order(symbol="MSFT", side=OrderSide.SELL, quantity=1, is_exit=True),
+            ]
+        ),
+    )
+    assert [fill.symbol for fill in fills] == ["AMZN", "IBM", "MSFT"]
+    placed = paper_exchange().fills
+    assert [fill.symbol for fill in placed] == ["MSFT", "AMZN", "IBM"]
+    assert [fill.fill_time - START for fill in placed] == [
+        datetime.timedelta(seconds=s) for s in (0, 1, 2)
+    ]
+    assert stats.submitted == 3
+    assert stats.queue_depth == 0
+    assert stats.latency_max == 2
+
+    portfolio = position_store().portfolio(BrokerageId.PAPER)
+    assert {s: p.quantity for s, p in portfolio.positions.items()} == (
+        paper_exchange().positions
+    )
+    assert portfolio.cash == pytest.approx(paper_exchange().cash)
+
+
+def test_exit_queued_while_rate_limited_goes_first(clock, signed_in):
+    async def submit(pipeline):
+        first = await pipeline.enqueue(buy("AMZN"))
+        # the worker is now waiting for the rate limit with nothing taken
+        await clock.sleep(0.5)
+        entry = await pipeline.enqueue(buy("IBM"))
+        exit = await pipeline.enqueue(
+            Order(symbol="MSFT", side=OrderSide.SELL, quantity=1, is_exit=True)
+        )
+        return await asyncio.gather(first, entry, exit)
+
+    run_pipeline(clock, submit, step=0.25)
+    placed = paper_exchange().fills
+    assert [fill.symbol for fill in placed] == ["AMZN", "MSFT", "IBM"]
+    assert [fill.fill_time - START for fill in placed] == [
+        datetime.timedelta(seconds=s) for s in (0, 1, 2)
+    ]
+
+
+@pytest.mark.parametrize(
+    "orders_config",
+    [{"workers": 4, "order_rate_limit": {"requests_per_second": 1, "burst": 2}}],
+)
+def test_burst_shared_by_workers(clock, signed_in):
+    symbols = ["AMZN", "IBM", "MSFT", "AAPL", "GOOG", "TSLA"]
+
+    async def submit(pipeline):
+        # idle long enough for the bucket to refill while the workers wait
+        await clock.sleep(10)
+        return await pipeline.submit_many([buy(symbol) for symbol in symbols])
+
+    run_pipeline(clock, submit, step=0.25)
+    times = [
+        (fill.fill_time - START).total_seconds() for fill in paper_exchange().fills
+    ]
+    assert sorted(times) == [10, 10, 11, 12, 13, 14]
+
+
+def test_client_order_id_is_idempotent(clock, signed_in):
+    async def submit_twice(pipeline):
+        first = await pipeline.submit(buy("AMZN", client_order_id="abc"))
+        second = await pipeline.submit(buy("AMZN", client_order_id="abc"))
+        return first, second
+
+    (first, second), stats = run_pipeline(clock, submit_twice)
+    assert first == second
+    assert len(paper_exchange().fills) == 1
+    assert stats.submitted == 1
+    assert stats.duplicates == 1
+
+    # the brokerage also ignores an order ID it has already filled
+    tokens = PaperBrokerageService().get_access_tokens("paper")
+    again = PaperBrokerageService().place_order(
+        tokens, buy("AMZN", client_order_id="abc")
+    )
+    assert again == first
+    assert len(paper_exchange().fills) == 1
+
+
+def test_failures_reported(clock):
+    async def submit(pipeline):
+        with pytest.raises(RuntimeError, match="not signed in"):
+            await pipeline.submit(buy("AMZN"))
+
+    _, stats = run_pipeline(clock, submit)
+    assert stats.failed == 1
+    assert stats.submitted == 0
+
+
+def test_brokerage_without_orders_rejected_up_front(clock):
+    auth_service = AuthenticationService("TEST-orders")
+    auth_service.set_access_keys(
+        AuthTokens(
+            brokerage_id=BrokerageId.TD,
+            access_token="access_token",
+            access_expiry=START,
+            refresh_token="refresh_token",
+            refresh_expiry=START,
+        )
+    )
+
+    async def submit(pipeline):
+        with pytest.raises(OrdersNotSupportedError):
+            await pipeline.submit(buy("AMZN"))
+        return pipeline.queue_depth
+
+    try:
+        queue_depth, stats = run_pipeline(clock, submit)
+    finally:
+        auth_service.sign_out()
+    assert queue_depth == 0
+    assert stats.failed == 0
+    assert stats.latency_max == 0
+
+
+def test_not_running():
+    with pytest.raises(RuntimeError):
+        asyncio.run(OrderPipeline("TEST-orders").submit(buy("AMZN")))
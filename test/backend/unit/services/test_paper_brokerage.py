@@ -0,0 +1,176 @@
+import asyncio
+import datetime
+
+import pytest
+from confz import ConfZDataSource
+
+from common.config import GlobalConfig
+from common.utils import VirtualClock, use_clock
+from models.brokerage import BrokerageId
+from models.trading import Order, OrderSide
+from services.authentication import AuthenticationService
+from services.brokerage import (
+    close_brokerage_services,
+    get_async_brokerage_service,
+    get_brokerage_service,
+)
+from services.paper_brokerage import (
+    AsyncPaperBrokerageService,
+    PaperBrokerageService,
+    paper_exchange,
+    reset_paper_exchange,
+)
+
+START = datetime.datetime(2022, 12, 1, 9, 30)
+
+
+@pytest.fixture
+def paper_config():
+    return {"latency_seconds": 0.5, "seed": 7}
+
+
+@pytest.fixture(autouse=True)
+def paper_brokerage(server_config, td_brokerage, tmp_path, paper_config):
+    paper = {"id": "paper", "name": "Paper", "client_id": "paper"}
+    with GlobalConfig.change_config_sources(
+        ConfZDataSource(
+            data={
+                "server": server_config,
+                "brokerages": [td_brokerage, {**paper, "paper": paper_config}],
+                "data_dir": str(tmp_path),
+            }
+        )
+    ):
+        reset_paper_exchange()
+        with use_clock(VirtualClock(START)) as clock:
+            yield clock
+        reset_paper_exchange()
+        asyncio.run(close_brokerage_services())
+
+
+async def run_with_clock(clock, coroutine):
+    task = asyncio.ensure_future(coroutine)
+    while not task.done():
+        await clock.advance(1)
+    return await task
+
+
+class TestPaperBrokerageService:
+    def test_registered(self):
+        assert isinstance(
+            get_brokerage_service(BrokerageId.PAPER), PaperBrokerageService
+        )
+        assert isinstance(
+            get_async_brokerage_service(BrokerageId.PAPER), AsyncPaperBrokerageService
+        )
+        assert get_brokerage_service(BrokerageId.PAPER).auth_uri == (
+            "http://my-site.com:9001/?code=paper&state=paper"
+        )
+
+    def test_tokens_with_latency(self, paper_brokerage):
+        service = PaperBrokerageService()
+        tokens = service.get_access_tokens("paper")
+
+        assert tokens.brokerage_id == BrokerageId.PAPER
+        assert paper_brokerage.now() == START + datetime.timedelta(seconds=0.5)
+        assert tokens.access_expiry == paper_brokerage.now() + datetime.timedelta(
+            minutes=30
+        )
+
+        refreshed = service.refresh_tokens(tokens)
+        assert refreshed.access_token != tokens.access_token
+        assert refreshed.refresh_token == tokens.refresh_token
+        assert service.refresh_tokens(tokens, True).refresh_token != (
+            tokens.refresh_token
+        )
+
+    def test_quotes_are_reproducible(self, paper_brokerage):
+        service = PaperBrokerageService()
+        tokens = service.get_access_tokens("paper")
+        first = service.get_quotes(tokens, ["AMZN", "IBM"])
+        paper_brokerage.sleep_blocking(60)
+        later = service.get_quotes(tokens, ["AMZN"])
+
+        reset_paper_exchange()
+        assert service.get_quotes(tokens, ["AMZN", "IBM"])["AMZN"].last_price == (
+            first["AMZN"].last_price
+        )
+        assert later["AMZN"].quote_time > first["AMZN"].quote_time
+        assert later["AMZN"].last_price != first["AMZN"].last_price
+        assert first["AMZN"].ask_price - first["AMZN"].bid_price == pytest.approx(0.01)
+
+    def test_expired_tokens_rejected(self, paper_brokerage):
+        service = PaperBrokerageService()
+        tokens = service.get_access_tokens("paper")
+        paper_brokerage.sleep_blocking(31 * 60)
+        with pytest.raises(RuntimeError):
+            service.get_quotes(tokens, ["AMZN"])
+
+    @pytest.mark.parametrize("paper_config", [{"volatility": 0}])
+    def test_orders_fill_into_shared_account(self, paper_brokerage):
+        tokens = PaperBrokerageService().get_access_tokens("paper")
+        buy = Order(symbol="AMZN", side=OrderSide.BUY, quantity=3)
+        fill = PaperBrokerageService().place_order(tokens, buy)
+        quote = PaperBrokerageService().get_quote(tokens, "AMZN")
+        assert fill.price == quote.ask_price
+
+        sell = Order(symbol="AMZN", side=OrderSide.SELL, quantity=1)
+        fill = asyncio.run(
+            run_with_clock(
+                paper_brokerage, AsyncPaperBrokerageService().place_order(tokens, sell)
+            )
+        )
+        assert fill.price == quote.bid_price
+        assert paper_exchange().positions == {"AMZN": 2}
+        assert paper_exchange().cash == pytest.approx(
+            -3 * quote.ask_price + quote.bid_price
+        )
+
+    @pytest.mark.parametrize("paper_config", [{"error_rate": 1}])
+    def test_error_injection(self):
+        with pytest.raises(RuntimeError):
+            PaperBrokerageService().get_access_tokens("paper")
+
+    def test_replay_feed(self, paper_brokerage, paper_config, tmp_path):
+        (tmp_path / "AMZN.csv").write_text(
+            "time,open,high,low,close,volume\n"
+            "2020-01-02T14:30:00,1,1,1,1.5,100\n"
+            "2020-01-02T14:31:00,1,1,1,2.5,50\n"
+        )
+        paper_config["feed_dir"] = str(tmp_path)
+        with GlobalConfig.change_config_sources(
+            ConfZDataSource(
+                data={
+                    **GlobalConfig().dict(),
+                    "brokerages": [
+                        {
+                            "id": "paper",
+                            "name": "Paper",
+                            "client_id": "paper",
+                            "paper": paper_config,
+                        }
+                    ],
+                }
+            )
+        ):
+            service = PaperBrokerageService()
+            tokens = service.get_access_tokens("paper")
+            assert service.get_quote(tokens, "AMZN").last_price == 1.5
+            paper_brokerage.sleep_blocking(60)
+            quote = service.get_quote(tokens, "AMZN")
+            assert quote.last_price == 2.5
+            assert quote.volume == 150
+            assert service.get_quotes(tokens, ["IBM"]) == {}
+
+    def test_sign_in(self, paper_brokerage):
+        auth_service = AuthenticationService("TEST-paper")
+        try:
+            asyncio.run(
+                run_with_clock(
+                    paper_brokerage,
+                    auth_service.sign_in_async(BrokerageId.PAPER, "paper"),
+                )
+            )
+            assert auth_service.active_brokerage == BrokerageId.PAPER
+        finally:
+            auth_service.sign_out()
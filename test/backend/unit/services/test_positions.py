@@ -0,0 +1,286 @@
+import asyncio
+import datetime
+import logging
+
+import mock
+import pytest
+from confz import ConfZDataSource
+
+from common.config import GlobalConfig
+from common.utils import VirtualClock, run_blocking, use_clock
+from models.authentication import AuthStatus, AuthTokens
+from models.brokerage import BrokerageId
+from models.events import EventType
+from models.trading import Fill, Order, OrderSide
+from services.authentication import AuthenticationService
+from services.brokerage import close_brokerage_services
+from services.events import event_broker
+from services.paper_brokerage import (
+    PaperBrokerageService,
+    paper_exchange,
+    reset_paper_exchange,
+)
+from services.positions import (
+    Position,
+    PositionChange,
+    PositionStore,
+    PositionTracker,
+    apply_fill,
+    position_change,
+    position_store,
+)
+
+START = datetime.datetime(2022, 12, 1, 9, 30)
+
+
+@pytest.fixture(autouse=True)
+def clock(server_config, td_brokerage, tmp_path):
+    paper = {
+        "id": "paper",
+        "name": "Paper",
+        "client_id": "paper",
+        "paper": {"latency_seconds": 0, "volatility": 0, "seed": 7},
+    }
+    with GlobalConfig.change_config_sources(
+        ConfZDataSource(
+            data={
+                "server": server_config,
+                "brokerages": [td_brokerage, paper],
+                "data_dir": str(tmp_path),
+            }
+        )
+    ):
+        reset_paper_exchange()
+        with use_clock(VirtualClock(START)) as clock:
+            yield clock
+        reset_paper_exchange()
+        asyncio.run(close_brokerage_services())
+
+
+def fill(side, quantity, price, minutes=0, commission=0.0, fill_id=None):
+    return Fill(
+        symbol="AMZN",
+        side=side,
+        quantity=quantity,
+        price=price,
+        fill_time=START + datetime.timedelta(minutes=minutes),
+        commission=commission,
+        fill_id=fill_id,
+    )
+
+
+def test_apply_fill():
+    position = apply_fill(None, fill(OrderSide.BUY, 10, 100, commission=1))
+    assert position == Position("AMZN", 10, 100, -1)
+    position = apply_fill(position, fill(OrderSide.BUY, 10, 110))
+    assert position == Position("AMZN", 20, 105, -1)
+    # reducing keeps the entry price
+    position = apply_fill(position, fill(OrderSide.SELL, 5, 115))
+    assert position == Position("AMZN", 15, 105, 49)
+    # selling through flat opens a short at the fill price
+    position = apply_fill(position, fill(OrderSide.SELL, 20, 100, commission=1))
+    assert position == Position("AMZN", -5, 100, -27)
+    position = apply_fill(position, fill(OrderSide.BUY, 5, 90))
+    assert position == Position("AMZN", 0, 0, 23)
+    assert not position.open
+
+
+def test_position_change():
+    long = Position("AMZN", 15, 105, 49)
+    assert position_change(long, fill(OrderSide.BUY, 5, 105)).closed == 0
+    change = position_change(long, fill(OrderSide.SELL, 20, 100))
+    assert change == PositionChange(Position("AMZN", -5, 100, -26), 15, -75)
+    assert change.reversed
+    assert not position_change(long, fill(OrderSide.SELL, 5, 100)).reversed
+
+
+def test_warm_restart(tmp_path):
+    path = tmp_path / "positions.db"
+    store = PositionStore(path)
+    fills = [
+        fill(OrderSide.BUY, 10, 100, minutes=1, fill_id="1"),
+        fill(OrderSide.SELL, 4, 110, minutes=2, fill_id="2", commission=1),
+    ]
+    assert store.record_fills(BrokerageId.PAPER, fills) == fills
+    # fills are recorded once however often they are seen
+    assert store.record_fills(BrokerageId.PAPER, fills) == []
+    store.close()
+
+    restarted = PositionStore(path)
+    restarted.load()
+    portfolio = restarted.portfolio(BrokerageId.PAPER)
+    assert portfolio.positions == {"AMZN": Position("AMZN", 6, 100, 39)}
+    assert portfolio.cash == pytest.approx(-1000 + 440 - 1)
+    assert restarted.reconcile_since(BrokerageId.PAPER) == START + datetime.timedelta(
+        minutes=2
+    ) - datetime.timedelta(minutes=5)
+    assert restarted.reconcile_since(BrokerageId.TD) is None
+    restarted.close()
+
+
+def test_fills_deduplicated_by_id(tmp_path):
+    store = PositionStore(tmp_path / "positions.db")
+    assert store.record_fill(
+        BrokerageId.PAPER, fill(OrderSide.BUY, 1, 100, fill_id="1")
+    )
+    assert not store.record_fill(
+        BrokerageId.PAPER, fill(OrderSide.BUY, 1, 100, fill_id="1")
+    )
+    # the same in every field but the ID
+    assert store.record_fill(
+        BrokerageId.PAPER, fill(OrderSide.BUY, 1, 100, fill_id="2")
+    )
+    with pytest.raises(ValueError, match="no fill ID"):
+        store.record_fill(BrokerageId.PAPER, fill(OrderSide.BUY, 1, 100))
+    assert store.portfolio(BrokerageId.PAPER).position("AMZN") == 2
+    store.close()
+
+
+def test_shared_between_workers(tmp_path):
+    path = tmp_path / "positions.db"
+    first, second = PositionStore(path), PositionStore(path)
+    first.load()
+    second.load()
+    first.record_fill(BrokerageId.PAPER, fill(OrderSide.BUY, 1, 100, fill_id="1"))
+    assert second.portfolio(BrokerageId.PAPER).position("AMZN") == 1
+    # writes start from the other worker's fills
+    second.record_fill(BrokerageId.PAPER, fill(OrderSide.BUY, 1, 110, fill_id="2"))
+    assert first.portfolio(BrokerageId.PAPER).symbols["AMZN"] == Position(
+        "AMZN", 2, 105, 0
+    )
+    first.close()
+    second.close()
+
+
+def test_reconciles_missed_fills(clock):
+    auth_service = AuthenticationService("TEST-positions")
+    auth_service.sign_in(BrokerageId.PAPER, "paper")
+    try:
+        tokens = auth_service.active_tokens
+        service = PaperBrokerageService()
+        first = service.place_order(
+            tokens, Order(symbol="AMZN", side=OrderSide.BUY, quantity=3)
+        )
+        position_store().record_fill(BrokerageId.PAPER, first)
+        # filled while the app was down
+        clock.sleep_blocking(60)
+        service.place_order(tokens, Order(symbol="IBM", side=OrderSide.BUY, quantity=2))
+        service.place_order(
+            tokens, Order(symbol="AMZN", side=OrderSide.SELL, quantity=1)
+        )
+
+        async def recover():
+            tracker = PositionTracker("TEST-positions")
+            tracker.start()
+            try:
+                await tracker.recovered.wait()
+            finally:
+                await tracker.stop()
+
+        asyncio.run(recover())
+        portfolio = position_store().portfolio(BrokerageId.PAPER)
+        assert {s: p.quantity for s, p in portfolio.positions.items()} == {
+            "AMZN": 2,
+            "IBM": 2,
+        }
+        assert portfolio.cash == pytest.approx(paper_exchange().cash)
+    finally:
+        auth_service.sign_out()
+
+
+def test_reconciles_on_sign_in(clock):
+    auth_service = AuthenticationService("TEST-positions")
+
+    async def run():
+        tracker = PositionTracker("TEST-positions")
+        tracker.start()
+        try:
+            await tracker.recovered.wait()
+            await run_blocking(auth_service.sign_in, BrokerageId.PAPER, "paper")
+            service = PaperBrokerageService()
+            tokens = await auth_service.get_active_tokens_async()
+            # placed somewhere other than the order pipeline
+            service.place_order(
+                tokens, Order(symbol="AMZN", side=OrderSide.BUY, quantity=3)
+            )
+            await run_blocking(auth_service.sign_in, BrokerageId.PAPER, "paper")
+            for _ in range(100):
+                if position_store().portfolio(BrokerageId.PAPER).position("AMZN"):
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await tracker.stop()
+
+    try:
+        asyncio.run(run())
+    finally:
+        auth_service.sign_out()
+    assert position_store().portfolio(BrokerageId.PAPER).position("AMZN") == 3
+
+
+def test_reconcile_unsupported_logged(clock, caplog):
+    auth_service = AuthenticationService("TEST-positions")
+    auth_service.set_access_keys(
+        AuthTokens(
+            brokerage_id=BrokerageId.TD,
+            access_token="access_token",
+            access_expiry=START,
+            refresh_token="refresh_token",
+            refresh_expiry=START,
+        )
+    )
+
+    async def recover():
+        tracker = PositionTracker("TEST-positions")
+        tracker.start()
+        try:
+            await tracker.recovered.wait()
+        finally:
+            await tracker.stop()
+
+    try:
+        with caplog.at_level(logging.INFO):
+            asyncio.run(recover())
+    finally:
+        auth_service.sign_out()
+    assert "reconciling positions is unsupported" in caplog.text
+    assert "failed to reconcile" not in caplog.text
+
+
+def test_token_refreshes_not_reconciled(clock):
+    auth_service = AuthenticationService("TEST-positions")
+    status = AuthStatus(id="paper", name="Paper", signed_in=True)
+
+    async def settle():
+        for _ in range(20):
+            await asyncio.sleep(0.01)
+
+    async def run():
+        tracker = PositionTracker("TEST-positions")
+        with mock.patch.object(
+            tracker, "reconcile", mock.AsyncMock(return_value=[])
+        ) as reconcile:
+            tracker.start()
+            try:
+                await tracker.recovered.wait()
+                assert reconcile.await_count == 0
+                # another worker signs in
+                tokens = PaperBrokerageService().get_access_tokens("paper")
+                await run_blocking(auth_service.set_access_keys, tokens)
+                event_broker.publish(EventType.AUTH, status)
+                await settle()
+                assert reconcile.await_count == 1
+                # and refreshes its tokens
+                event_broker.publish(EventType.AUTH, status)
+                await settle()
+                assert reconcile.await_count == 1
+                event_broker.publish(EventType.SIGN_IN, status)
+                await settle()
+                assert reconcile.await_count == 2
+            finally:
+                await tracker.stop()
+
+    try:
+        asyncio.run(run())
+    finally:
+        auth_service.sign_out()
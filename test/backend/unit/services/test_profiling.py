@@ -0,0 +1,74 @@
+import datetime
+import threading
+import time
+
+from models.profiling import ProfileInfo
+from services.profiling import ProfileStore, StackSampler
+
+
+def profile_info(profile_id):
+    return ProfileInfo(
+        id=profile_id,
+        created=datetime.datetime(2022, 12, 1),
+        method="GET",
+        path="/auth/",
+        status="200",
+        duration_ms=12.5,
+        samples=3,
+    )
+
+
+def busy_wait(started, stop):
+    started.set()
+    # no Python calls in the loop, so every sample ends in this frame
+    while not stop:
+        sum(range(1000))
+
+
+def test_stack_sampler():
+    started, stop = threading.Event(), []
+    worker = threading.Thread(target=busy_wait, args=(started, stop), name="busy")
+    worker.start()
+    sampler = StackSampler(lambda: [worker], 0.001)
+    try:
+        assert started.wait(5)
+        # the thread may still be inside Event.set, wait for a sample in busy_wait
+        while not any(
+            "busy_wait" in stack.rsplit(";", 1)[-1] for stack in sampler.stacks
+        ):
+            sampler.sample()
+        sampler.stacks.clear()
+        sampler.start()
+        while sampler.samples == 0:
+            time.sleep(0.001)
+    finally:
+        stacks = sampler.stop()
+        stop.append(True)
+        worker.join()
+
+    assert sampler.samples > 0
+    for stack in stacks:
+        frames = stack.split(";")
+        assert frames[0] == "busy"
+        assert frames[-1].startswith("busy_wait (test/backend/unit/services/")
+
+
+def test_stack_sampler_stops_after_max_seconds():
+    sampler = StackSampler(lambda: [threading.current_thread()], 0.001, 0.01)
+    sampler.start()
+    sampler._thread.join(5)
+    assert not sampler._thread.is_alive()
+    sampler.stop()
+
+
+def test_profile_store_keeps_newest(tmp_path):
+    store = ProfileStore(tmp_path, max_profiles=2)
+    ids = [store.new_id() for _ in range(3)]
+    for profile_id in ids:
+        store.save(profile_info(profile_id), {"main;handler": 2, "main;other": 1})
+
+    assert [info.id for info in store.list()] == ids[:0:-1]
+    assert store.read(ids[0]) is None
+    assert store.read(ids[2]) == b"main;handler 2\nmain;other 1\n"
+    assert store.read("../secrets") is None
+    assert len(list(tmp_path.iterdir())) == 4
@@ -0,0 +1,258 @@
+import asyncio
+import datetime
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+from confz import ConfZDataSource
+
+from common.config import GlobalConfig, RetryConfig
+from common.utils import VirtualClock, use_clock
+from models.authentication import AuthTokens
+from models.brokerage import BrokerageId
+from services.brokerage import (
+    AsyncTDAmeritradeBrokerageService,
+    TDAmeritradeBrokerageService,
+)
+from services.resilience import (
+    BROKERAGE_RETRIES,
+    CIRCUIT_BREAKER_STATE,
+    BreakerState,
+    CircuitOpenError,
+    backoff_delay,
+    retryable_error,
+)
+
+# the stub drops the connection instead of responding
+DROP = "drop"
+
+TOKENS_BODY = {"access_token": "new-access_token", "expires_in": 1800}
+QUOTES_BODY = {"AMZN": {"lastPrice": 1.0, "quoteTimeInLong": 1670000000000}}
+
+
+class FailingBrokerage(ThreadingHTTPServer):
+    """a local brokerage that answers with scripted failures before succeeding"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _FailingBrokerageHandler)
+        self.failures = []
+        self.requests = 0
+
+    @property
+    def uri(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class _FailingBrokerageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FailingBrokerage
+
+    def _respond(self, body):
+        self.server.requests += 1
+        if self.server.failures:
+            failure = self.server.failures.pop(0)
+            if failure == DROP:
+                self.close_connection = True
+                return
+            self.send_response(failure)
+            self.send_header("Content-Length", "0")
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+            return
+        content = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self._respond(QUOTES_BODY)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self._respond(TOKENS_BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def brokerage():
+    server = FailingBrokerage()
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def resilience_config(server_config, td_brokerage, tmp_path):
+    td_brokerage = {
+        **td_brokerage,
+        "retry": {"max_attempts": 3, "base_delay_seconds": 0.01},
+        "circuit_breaker": {"failure_threshold": 3, "reset_timeout_seconds": 30},
+    }
+    with GlobalConfig.change_config_sources(
+        ConfZDataSource(
+            data={
+                "server": server_config,
+                "brokerages": [td_brokerage],
+                "data_dir": str(tmp_path),
+            }
+        )
+    ):
+        yield
+
+
+@pytest.fixture
+def clock():
+    with use_clock(VirtualClock()) as clock:
+        yield clock
+
+
+@pytest.fixture
+def tokens():
+    return AuthTokens(
+        brokerage_id=BrokerageId.TD,
+        access_token="access_token",
+        access_expiry=datetime.datetime.now(),
+        refresh_token="refresh_token",
+        refresh_expiry=datetime.datetime.now() + datetime.timedelta(days=30),
+    )
+
+
+@pytest.fixture
+def service(brokerage):
+    class StubTDAmeritradeBrokerageService(TDAmeritradeBrokerageService):
+        TOKEN_URI = f"{brokerage.uri}/token"
+        QUOTES_URI = f"{brokerage.uri}/quotes"
+
+    service = StubTDAmeritradeBrokerageService()
+    yield service
+    service.close()
+
+
+def breaker_state(endpoint):
+    return CIRCUIT_BREAKER_STATE.labels(BrokerageId.TD, endpoint).value
+
+
+def test_backoff_delay():
+    config = RetryConfig(base_delay_seconds=1, max_delay_seconds=5)
+    rng = random.Random(0)
+    for attempt, cap in [(0, 1), (1, 2), (2, 4), (3, 5), (10, 5)]:
+        delays = [backoff_delay(config, attempt, rng=rng) for _ in range(100)]
+        assert 0 <= min(delays) and max(delays) <= cap
+    assert backoff_delay(config, 0, retry_after=3, rng=rng) >= 3
+    assert backoff_delay(config, 0, retry_after=60, rng=rng) == 5
+
+
+def test_retryable_error():
+    request = httpx.Request("POST", "http://brokerage")
+    refused = httpx.ConnectError("refused", request=request)
+    dropped = httpx.RemoteProtocolError("dropped", request=request)
+    assert retryable_error(refused, idempotent=False)
+    assert retryable_error(dropped, idempotent=True)
+    assert not retryable_error(dropped, idempotent=False)
+    assert not retryable_error(ValueError(), idempotent=True)
+
+
+@pytest.mark.usefixtures("clock")
+def test_retries_until_success(brokerage, service, tokens):
+    retries = BROKERAGE_RETRIES.labels(BrokerageId.TD, "quotes")
+    before = retries.value
+    brokerage.failures = [503, DROP]
+    quotes = service.get_quotes(tokens, ["AMZN"])
+    assert quotes["AMZN"].last_price == 1.0
+    assert brokerage.requests == 3
+    assert retries.value == before + 2
+
+    brokerage.failures = [500, 500, 500]
+    with pytest.raises(RuntimeError):
+        service.get_quotes(tokens, ["AMZN"])
+
+
+@pytest.mark.usefixtures("clock")
+def test_access_code_not_retried(brokerage, service, tokens):
+    brokerage.failures = [503]
+    assert service.refresh_tokens(tokens).access_token == "new-access_token"
+    assert brokerage.requests == 2
+
+    # the code may have been spent by the first attempt
+    brokerage.failures = [503]
+    with pytest.raises(RuntimeError):
+        service.get_access_tokens("code")
+    assert brokerage.requests == 3
+
+    brokerage.failures = [DROP]
+    with pytest.raises(httpx.TransportError):
+        service.get_access_tokens("code")
+    assert brokerage.requests == 4
+
+
+@pytest.mark.usefixtures("clock")
+def test_client_errors_not_retried(brokerage, service, tokens):
+    brokerage.failures = [401] * 5
+    for _ in range(5):
+        with pytest.raises(RuntimeError):
+            service.refresh_tokens(tokens)
+    assert brokerage.requests == 5
+    assert breaker_state("token") == BreakerState.CLOSED.value
+
+
+def test_circuit_breaker(brokerage, service, tokens, clock):
+    # one call's three failed attempts open the breaker
+    brokerage.failures = [503] * 3
+    with pytest.raises(RuntimeError):
+        service.get_quotes(tokens, ["AMZN"])
+    assert breaker_state("quotes") == BreakerState.OPEN.value
+    # other endpoints keep working
+    assert service.refresh_tokens(tokens).access_token == "new-access_token"
+    requests = brokerage.requests
+
+    with pytest.raises(CircuitOpenError):
+        service.get_quotes(tokens, ["AMZN"])
+    assert brokerage.requests == requests
+
+    # a failed trial call opens it for another timeout
+    clock.sleep_blocking(30)
+    brokerage.failures = [503]
+    with pytest.raises(RuntimeError):
+        service.get_quotes(tokens, ["AMZN"])
+    assert brokerage.requests == requests + 1
+    assert breaker_state("quotes") == BreakerState.OPEN.value
+
+    clock.sleep_blocking(30)
+    assert service.get_quotes(tokens, ["AMZN"])
+    assert breaker_state("quotes") == BreakerState.CLOSED.value
+
+
+def test_async_retries(brokerage, tokens):
+    class StubTDAmeritradeBrokerageService(AsyncTDAmeritradeBrokerageService):
+        TOKEN_URI = f"{brokerage.uri}/token"
+        QUOTES_URI = f"{brokerage.uri}/quotes"
+
+    async def run():
+        service = StubTDAmeritradeBrokerageService()
+        try:
+            brokerage.failures = [DROP, 429]
+            new_tokens = await service.refresh_tokens(tokens)
+            assert new_tokens.access_token == "new-access_token"
+            assert brokerage.requests == 3
+
+            brokerage.failures = [503] * 3
+            with pytest.raises(RuntimeError):
+                await service.get_quotes(tokens, ["AMZN"])
+            with pytest.raises(CircuitOpenError):
+                await service.get_quotes(tokens, ["AMZN"])
+        finally:
+            await service.aclose()
+
+    asyncio.run(run())
@@ -0,0 +1,125 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from models.trading import Fill, OrderSide
+from services.strategy import (
+    MarketSnapshot,
+    MovingAverageCrossover,
+    Strategy,
+    TradingSession,
+)
+
+NOW = datetime.datetime(2022, 12, 1, 15)
+
+
+class ScriptedStrategy(Strategy):
+    def __init__(self, *signals):
+        self._signals = list(signals)
+
+    def signals(self, snapshot):
+        return np.array(self._signals.pop(0), dtype=np.float64)
+
+
+def snapshot(*prices, symbols=("AMZN", "IBM")):
+    return MarketSnapshot(
+        NOW, list(symbols), np.array(prices, dtype=np.float64), np.zeros(len(prices))
+    )
+
+
+def fill(order, price):
+    return Fill(
+        symbol=order.symbol,
+        side=order.side,
+        quantity=order.quantity,
+        price=price,
+        fill_time=NOW,
+    )
+
+
+class TestTradingSession:
+    def test_entries_sized_by_position_size(self):
+        session = TradingSession(ScriptedStrategy([1, np.nan]), position_size=100)
+        orders = session.step(snapshot(50, 20))
+
+        assert len(orders) == 1
+        assert orders[0].symbol == "AMZN"
+        assert orders[0].side == OrderSide.BUY
+        assert orders[0].quantity == 2
+        assert not orders[0].is_exit
+
+    def test_holds_until_signal_changes(self):
+        session = TradingSession(ScriptedStrategy([1, 0], [1, 0], [-1, 0]), 100)
+        for order in session.step(snapshot(50, 20)):
+            session.apply_fill(fill(order, 50))
+        assert session.step(snapshot(60, 20)) == []
+
+        exit_order, short_order = session.step(snapshot(25, 20))
+        assert exit_order.is_exit and exit_order.side == OrderSide.SELL
+        assert exit_order.quantity == 2
+        assert short_order.side == OrderSide.SELL and short_order.quantity == 4
+
+    def test_end_of_day_exit(self):
+        session = TradingSession(
+            ScriptedStrategy([1, 1], [1, 1]), 100, end_of_day_exit=True
+        )
+        for order in session.step(snapshot(50, 20)):
+            session.apply_fill(fill(order, 50))
+
+        orders = session.step(snapshot(50, 20), end_of_day=True)
+        assert {o.symbol for o in orders} == {"AMZN", "IBM"}
+        assert all(o.is_exit for o in orders)
+
+    def test_end_of_day_bar_updates_indicators(self):
+        strategy = MovingAverageCrossover(2, 4)
+        session = TradingSession(strategy, 100, end_of_day_exit=True)
+        strategy.set_symbols(["AMZN"])
+        reference = MovingAverageCrossover(2, 4)
+        reference.set_symbols(["AMZN"])
+        for i, price in enumerate([10, 11, 12, 13, 14]):
+            bar = snapshot(price, symbols=("AMZN",))
+            session.step(bar, end_of_day=i == 2)
+            reference.signals(bar)
+
+        for name in ("fast", "slow"):
+            assert strategy.indicators.indicators[name].value == pytest.approx(
+                reference.indicators.indicators[name].value
+            )
+
+    def test_fills_make_trades(self):
+        session = TradingSession(ScriptedStrategy(), 100)
+        buy = session._order("AMZN", 2)
+        session.apply_fill(fill(buy, 50))
+        session.apply_fill(fill(buy, 60))
+        assert session.position("AMZN") == 4
+        assert session.unrealized_pnl({"AMZN": 60}) == 20
+
+        trade = session.apply_fill(fill(session._order("AMZN", -3), 65))
+        assert trade.quantity == 3
+        assert trade.entry_price == 55
+        assert trade.pnl == 30
+        assert session.position("AMZN") == 1
+
+        trade = session.apply_fill(fill(session._order("AMZN", -3), 45))
+        assert trade.pnl == -10
+        assert session.position("AMZN") == -2
+        assert session.realized_pnl == 20
+        assert len(session.trades) == 2
+
+
+class TestMovingAverageCrossover:
+    def test_signals(self):
+        strategy = MovingAverageCrossover(2, 4)
+        strategy.set_symbols(["AMZN"])
+        signals = [
+            strategy.signals(snapshot(price, symbols=["AMZN"]))[0]
+            for price in [10, 10, 10, 11, 12, 13, 9, 8]
+        ]
+        assert np.isnan(signals[:3]).all()
+        assert signals[3:6] == [1, 1, 1]
+        assert signals[-1] == 0
+
+    def test_invalid_periods(self):
+        with pytest.raises(ValueError):
+            MovingAverageCrossover(5, 5)
@@ -0,0 +1,145 @@
+import datetime
+import threading
+
+import keyring
+import pytest
+from confz import ConfZDataSource
+
+from common.config import GlobalConfig
+from models.authentication import AuthTokens, TokenStoreType
+from models.brokerage import BrokerageId
+from services.token_store import (
+    EncryptedFileTokenStore,
+    KeyringTokenStore,
+    TokenFileError,
+    get_token_store,
+)
+
+
+@pytest.fixture
+def tokens():
+    return AuthTokens(
+        brokerage_id=BrokerageId.TD,
+        access_token="access_token",
+        access_expiry=datetime.datetime.now() + datetime.timedelta(minutes=30),
+        refresh_token="refresh_token",
+        refresh_expiry=datetime.datetime.now() + datetime.timedelta(days=30),
+    )
+
+
+@pytest.fixture
+def keyring_store():
+    return KeyringTokenStore("TEST-token-store")
+
+
+@pytest.fixture
+def encrypted_file_store():
+    return EncryptedFileTokenStore(
+        "TEST-token-store", GlobalConfig().data_dir / "test.tokens"
+    )
+
+
+@pytest.mark.parametrize("token_store", ["keyring_store", "encrypted_file_store"])
+def test_round_trip(request, token_store, tokens):
+    token_store = request.getfixturevalue(token_store)
+    assert token_store.get(BrokerageId.TD) is None
+
+    token_store.set(tokens)
+    assert token_store.get(BrokerageId.TD) == tokens
+
+    new_tokens = tokens.copy(update={"access_token": "new-access_token"})
+    token_store.set(new_tokens)
+    assert token_store.get(BrokerageId.TD) == new_tokens
+
+    token_store.delete(BrokerageId.TD)
+    assert token_store.get(BrokerageId.TD) is None
+    token_store.delete(BrokerageId.TD)
+
+
+def test_encrypted_file_is_not_plaintext(encrypted_file_store, tokens):
+    encrypted_file_store.set(tokens)
+    contents = (GlobalConfig().data_dir / "test.tokens").read_bytes()
+    assert tokens.access_token.encode() not in contents
+    assert tokens.refresh_token.encode() not in contents
+    encrypted_file_store.delete(BrokerageId.TD)
+
+
+def test_encrypted_file_wrong_key(encrypted_file_store, tokens):
+    encrypted_file_store.set(tokens)
+    keyring.delete_password("TEST-token-store", "TOKEN_FILE_KEY")
+
+    other_store = EncryptedFileTokenStore(
+        "TEST-token-store", GlobalConfig().data_dir / "test.tokens"
+    )
+    assert other_store.get(BrokerageId.TD) is None
+    # other sessions in the file are kept, not overwritten
+    contents = (GlobalConfig().data_dir / "test.tokens").read_bytes()
+    paper_tokens = tokens.copy(update={"brokerage_id": BrokerageId.PAPER})
+    with pytest.raises(TokenFileError):
+        other_store.set(paper_tokens)
+    with pytest.raises(TokenFileError):
+        other_store.delete(BrokerageId.TD)
+    assert (GlobalConfig().data_dir / "test.tokens").read_bytes() == contents
+    keyring.delete_password("TEST-token-store", "TOKEN_FILE_KEY")
+
+
+def test_encrypted_file_key_created_once(tokens):
+    path = GlobalConfig().data_dir / "test.tokens"
+    # separate stores starting together, as in separate worker processes
+    stores = [EncryptedFileTokenStore("TEST-token-store", path) for _ in range(4)]
+    threads = [threading.Thread(target=lambda s=s: s.fernet) for s in stores]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stores[0].set(tokens)
+        assert all(store.get(BrokerageId.TD) == tokens for store in stores)
+    finally:
+        keyring.delete_password("TEST-token-store", "TOKEN_FILE_KEY")
+
+
+@pytest.mark.parametrize(
+    "store_type, expected_class",
+    [
+        pytest.param(TokenStoreType.KEYRING, KeyringTokenStore, id="keyring"),
+        pytest.param(TokenStoreType.ENCRYPTED_FILE, EncryptedFileTokenStore, id="file"),
+    ],
+)
+def test_get_token_store(server_config, td_brokerage, store_type, expected_class):
+    with GlobalConfig.change_config_sources(
+        ConfZDataSource(
+            data={
+                "server": server_config,
+                "brokerages": [td_brokerage],
+                "authentication": {"token_store": store_type.value},
+            }
+        )
+    ):
+        assert isinstance(get_token_store("TEST"), expected_class)
+        assert get_token_store("TEST") is get_token_store("TEST")
+        assert get_token_store("OTHER") is not get_token_store("TEST")
+
+
+def test_encrypted_file_concurrent_updates(tokens):
+    path = GlobalConfig().data_dir / "test.tokens"
+    # separate stores, as in separate worker processes
+    stores = [EncryptedFileTokenStore("TEST-token-store", path) for _ in range(2)]
+    records = [tokens, tokens.copy(update={"brokerage_id": BrokerageId.PAPER})]
+
+    def update(store, record):
+        for i in range(20):
+            store.set(record.copy(update={"access_token": f"access-{i}"}))
+
+    try:
+        threads = [
+            threading.Thread(target=update, args=pair) for pair in zip(stores, records)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert stores[0].get(BrokerageId.TD).access_token == "access-19"
+        assert stores[0].get(BrokerageId.PAPER).access_token == "access-19"
+    finally:
+        keyring.delete_password("TEST-token-store", "TOKEN_FILE_KEY")
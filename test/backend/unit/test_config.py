@@ -1,7 +1,19 @@
+import time
+
+import mock
 import pytest
+import yaml
+from confz import ConfZDataSource, ConfZFileSource
 from pydantic import ValidationError
 
-from common.config import UserSettings
+from common.config import (
+    GlobalConfig,
+    UserSettings,
+    config_snapshot,
+    reload_global_config,
+)
+from common.utils import atomic_write
+from models.brokerage import BrokerageId
 
 
 class TestUserSettings:
@@ -33,3 +45,168 @@ class TestUserSettings:
         updated_dict = UserSettings().dict()
 
         assert original == updated_dict
+
+    def test_update_persisted(self, user_settings_from_file):
+        settings, path = user_settings_from_file
+        settings.update({"position_size": 3})
+        settings.update({"symbols": ["ge"]})
+        with open(path) as f:
+            assert yaml.safe_load(f)["position_size"] != 3
+
+        with mock.patch("common.config.atomic_write", wraps=atomic_write) as mock_write:
+            UserSettings.flush()
+            mock_write.assert_called_once()
+
+        with open(path) as f:
+            persisted = yaml.safe_load(f)
+        assert persisted["position_size"] == 3
+        assert persisted["symbols"] == ["GE"]
+
+    def test_update_merges_other_writers(self, user_settings_from_file):
+        settings, path = user_settings_from_file
+        with open(path) as f:
+            on_disk = yaml.safe_load(f)
+        # another worker persists a different setting in the meantime
+        on_disk["end_of_day_exit"] = False
+        with open(path, mode="w") as f:
+            yaml.dump(on_disk, f)
+
+        settings.update({"position_size": 3})
+        UserSettings.flush()
+
+        with open(path) as f:
+            persisted = yaml.safe_load(f)
+        assert persisted["position_size"] == 3
+        assert not persisted["end_of_day_exit"]
+        assert UserSettings().position_size == 3
+        assert not UserSettings().end_of_day_exit
+
+    def test_update_debounced(self, global_config, user_settings_from_file):
+        settings, path = user_settings_from_file
+        with GlobalConfig.change_config_sources(
+            ConfZDataSource(
+                data={
+                    **GlobalConfig().dict(),
+                    "user_settings_write_delay_seconds": 0.01,
+                }
+            )
+        ):
+            settings.update({"position_size": 3})
+            for _ in range(100):
+                with open(path) as f:
+                    if yaml.safe_load(f)["position_size"] == 3:
+                        break
+                time.sleep(0.01)
+            else:
+                pytest.fail("settings were not persisted")
+
+
+class TestUserSettingsSubscription:
+    @pytest.fixture
+    def subscriber(self):
+        subscriber = mock.Mock()
+        unsubscribe = UserSettings.subscribe(subscriber)
+        yield subscriber
+        unsubscribe()
+
+    def test_update_publishes_change(self, user_settings_from_file, subscriber):
+        settings, _ = user_settings_from_file
+        settings.update({"position_size": 3, "end_of_day_exit": True})
+
+        subscriber.assert_called_once()
+        change = subscriber.call_args.args[0]
+        assert change.changed == frozenset({"position_size"})
+        assert change.old.position_size == settings.position_size
+        assert change.new.position_size == 3
+        assert change.new is UserSettings()
+
+    def test_no_change_not_published(self, user_settings_from_file, subscriber):
+        settings, _ = user_settings_from_file
+        settings.update({"position_size": settings.position_size})
+        subscriber.assert_not_called()
+
+    def test_field_filter(self, user_settings_from_file):
+        settings, _ = user_settings_from_file
+        subscriber = mock.Mock()
+        unsubscribe = UserSettings.subscribe(subscriber, fields=["symbols"])
+        try:
+            settings.update({"position_size": 3})
+            subscriber.assert_not_called()
+            settings.update({"symbols": ["ge"]})
+            subscriber.assert_called_once()
+        finally:
+            unsubscribe()
+
+        settings.update({"symbols": ["ibm"]})
+        subscriber.assert_called_once()
+
+    def test_external_edit_published(self, user_settings_from_file, subscriber):
+        _, path = user_settings_from_file
+        with open(path) as f:
+            on_disk = yaml.safe_load(f)
+        on_disk["trading_frequency_seconds"] = 30
+        with open(path, mode="w") as f:
+            yaml.dump(on_disk, f)
+
+        UserSettings.reload()
+
+        subscriber.assert_called_once()
+        change = subscriber.call_args.args[0]
+        assert change.changed == frozenset({"trading_frequency_seconds"})
+        assert UserSettings().trading_frequency_seconds == 30
+
+    def test_failing_subscriber(self, user_settings_from_file, subscriber):
+        settings, _ = user_settings_from_file
+        unsubscribe = UserSettings.subscribe(mock.Mock(side_effect=RuntimeError))
+        try:
+            settings.update({"position_size": 3})
+        finally:
+            unsubscribe()
+        subscriber.assert_called_once()
+
+
+class TestConfigSnapshot:
+    @pytest.fixture
+    def config_file(self, server_config, td_brokerage, tmp_path):
+        path = tmp_path / "config.yml"
+        path.write_text(
+            yaml.dump({"server": server_config, "brokerages": [td_brokerage]})
+        )
+        with GlobalConfig.change_config_sources(ConfZFileSource(file=path)):
+            yield path
+
+    def test_snapshot_reused(self):
+        snapshot = config_snapshot()
+        assert config_snapshot() is snapshot
+        assert snapshot.config is GlobalConfig()
+        assert GlobalConfig().brokerage_map is snapshot.brokerage_map
+        assert snapshot.brokerage_map[BrokerageId.TD].name == "TD Ameritrade"
+
+    def test_auth_uri_rendered_once(self):
+        formatter = "https://auth.me/?redirect_uri={redirect_uri}&client_id={client_id}"
+        snapshot = config_snapshot()
+        uri = snapshot.auth_uri(BrokerageId.TD, formatter)
+        assert (
+            uri
+            == "https://auth.me/?redirect_uri=http%3A%2F%2Fmy-site.com%3A9001%2F&client_id=my+id"
+        )
+        assert snapshot.auth_uri(BrokerageId.TD, formatter) is uri
+
+    def test_reload(self, config_file, server_config, td_brokerage):
+        snapshot = config_snapshot()
+        td_brokerage["name"] = "TD"
+        config_file.write_text(
+            yaml.dump({"server": server_config, "brokerages": [td_brokerage]})
+        )
+        assert config_snapshot() is snapshot
+
+        assert reload_global_config()
+        assert config_snapshot() is not snapshot
+        assert GlobalConfig().brokerage_map[BrokerageId.TD].name == "TD"
+
+    def test_reload_invalid(self, config_file):
+        snapshot = config_snapshot()
+        config_file.write_text(yaml.dump({"server": {"port": "not a port"}}))
+
+        assert not reload_global_config()
+        assert config_snapshot() is snapshot
@@ -0,0 +1,52 @@
+import pytest
+
+from common.metrics import Counter, Gauge, Histogram, Registry
+
+
+@pytest.fixture
+def registry():
+    return Registry()
+
+
+def test_counter_and_gauge(registry):
+    requests = Counter("requests_total", "Requests", ["path"], registry=registry)
+    requests.labels("/a").inc()
+    requests.labels("/a").inc(2)
+    requests.labels('say "hi"').inc()
+    depth = Gauge("depth", "Depth", registry=registry, function=lambda: 7)
+
+    assert registry.render() == (
+        "# HELP requests_total Requests\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{path="/a"} 3.0\n'
+        'requests_total{path="say \\"hi\\""} 1.0\n'
+        "# HELP depth Depth\n"
+        "# TYPE depth gauge\n"
+        "depth 7.0\n"
+    )
+    with pytest.raises(ValueError):
+        requests.labels("/a").inc(-1)
+    with pytest.raises(ValueError):
+        requests.labels()
+    with pytest.raises(ValueError):
+        Counter("depth", "Duplicate", registry=registry)
+
+
+def test_histogram(registry):
+    latency = Histogram(
+        "latency_seconds", "Latency", buckets=[1, 0.1], registry=registry
+    )
+    for value in (0.05, 0.1, 0.5, 3):
+        latency.observe(value)
+    with latency.time():
+        pass
+
+    lines = registry.render().splitlines()[2:]
+    assert lines == [
+        'latency_seconds_bucket{le="0.1"} 3.0',
+        'latency_seconds_bucket{le="1.0"} 4.0',
+        'latency_seconds_bucket{le="+Inf"} 5.0',
+        lines[3],
+        "latency_seconds_count 5.0",
+    ]
+    assert float(lines[3].split()[1]) == pytest.approx(3.65, abs=0.01)
@@ -0,0 +1,176 @@
+import asyncio
+import datetime
+import time
+
+import mock
+
+from common.utils import (
+    FileWatcher,
+    LeaderLock,
+    LeaderServices,
+    RealClock,
+    VersionStamp,
+    VirtualClock,
+    get_clock,
+    run_blocking,
+    safe_sleep,
+    use_clock,
+    wait_for_event,
+)
+
+
+def test_version_stamp(tmp_path):
+    stamp = VersionStamp(tmp_path / "stamp")
+    assert stamp.read() == ""
+    version = stamp.bump()
+    assert stamp.read() == version
+    assert stamp.bump() != version
+
+
+def test_leader_lock(tmp_path):
+    leader = LeaderLock(tmp_path / "leader.lock")
+    follower = LeaderLock(tmp_path / "leader.lock")
+    assert leader.try_acquire()
+    assert leader.try_acquire()
+    assert not follower.try_acquire()
+    assert not follower.held
+
+    leader.release()
+    assert not leader.held
+    assert follower.try_acquire()
+    assert not leader.try_acquire()
+    follower.release()
+
+
+def test_leader_services(tmp_path):
+    first_service = mock.Mock(stop=mock.AsyncMock())
+    second_service = mock.Mock(stop=mock.AsyncMock())
+
+    async def run():
+        path = tmp_path / "leader.lock"
+        first = LeaderServices(path, [first_service], poll_seconds=0.01)
+        second = LeaderServices(path, [second_service], poll_seconds=0.01)
+        first.start()
+        await asyncio.sleep(0.01)
+        second.start()
+        await asyncio.sleep(0.05)
+        assert first.leader and not second.leader
+        first_service.start.assert_called_once()
+        second_service.start.assert_not_called()
+
+        await first.stop()
+        first_service.stop.assert_awaited_once()
+        for _ in range(100):
+            if second.leader:
+                break
+            await asyncio.sleep(0.01)
+        second_service.start.assert_called_once()
+        await second.stop()
+        assert not second.leader
+
+    asyncio.run(run())
+
+
+def test_file_watcher(tmp_path):
+    path = tmp_path / "watched.yml"
+    path.write_text("a: 1")
+    on_change = mock.Mock()
+
+    async def run():
+        watcher = FileWatcher(path, on_change, interval_seconds=0.01)
+        watcher.start()
+        await asyncio.sleep(0.05)
+        on_change.assert_not_called()
+
+        path.write_text("a: 22")
+        for _ in range(100):
+            if on_change.called:
+                break
+            await asyncio.sleep(0.01)
+        await watcher.stop()
+
+    asyncio.run(run())
+    on_change.assert_called_once()
+
+
+class TestVirtualClock:
+    START = datetime.datetime(2022, 12, 1, 9, 30)
+
+    def test_use_clock(self):
+        clock = VirtualClock(self.START)
+        assert isinstance(get_clock(), RealClock)
+        with use_clock(clock):
+            assert get_clock() is clock
+            assert get_clock().now() == self.START
+            safe_sleep(60)
+        assert isinstance(get_clock(), RealClock)
+        assert clock.now() == self.START + datetime.timedelta(minutes=1)
+
+    def test_sleepers_wake_in_order(self):
+        clock = VirtualClock(self.START)
+        woken = []
+
+        async def sleeper(name, seconds):
+            await clock.sleep(seconds)
+            woken.append((name, clock.now() - self.START))
+
+        async def run():
+            tasks = [
+                asyncio.create_task(sleeper("hour", 3600)),
+                asyncio.create_task(sleeper("minute", 60)),
+                asyncio.create_task(sleeper("day", 86400)),
+            ]
+            started = time.monotonic()
+            await clock.advance(7200)
+            assert time.monotonic() - started < 1
+            assert [name for name, _ in woken] == ["minute", "hour"]
+            assert clock.now() == self.START + datetime.timedelta(hours=2)
+            await clock.advance(86400)
+            await asyncio.gather(*tasks)
+
+        asyncio.run(run())
+        assert woken[-1] == ("day", datetime.timedelta(days=1))
+
+    def test_wait_for_event(self):
+        clock = VirtualClock(self.START)
+        results = []
+
+        async def waiter(event):
+            with use_clock(clock):
+                results.append(await wait_for_event(event, 30))
+            results.append(clock.now() - self.START)
+
+        async def run():
+            event = asyncio.Event()
+            task = asyncio.create_task(waiter(event))
+            await clock.advance(10)
+            assert not results
+            event.set()
+            await clock.advance(0)
+            assert results == [True, datetime.timedelta(seconds=10)]
+
+            event.clear()
+            task = asyncio.create_task(waiter(event))
+            await clock.advance(60)
+            await task
+            assert results[2:] == [False, datetime.timedelta(seconds=40)]
+
+        asyncio.run(run())
+
+    def test_waits_for_blocking_calls(self):
+        clock = VirtualClock(self.START)
+        done = []
+
+        async def worker():
+            await run_blocking(time.sleep, 0.05)
+            done.append(clock.now())
+            await clock.sleep(1)
+            done.append(clock.now())
+
+        async def run():
+            task = asyncio.create_task(worker())
+            await clock.advance(5)
+            await task
+
+        asyncio.run(run())
+        assert done == [self.START, self.START + datetime.timedelta(seconds=1)]